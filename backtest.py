@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the backtester of the strategies configured in algo_list.txt.
+The candles of the security of an algo are read from a candle store and passed to the same signal(df) function which is
+used by RunAlgo. The signals are then traded as the live system trades them:
+1. An entry signal (LE/SE) buys the option chosen as in zerodhafunctions.get_symbol (CE for long, PE for short): the
+   first expiry of expiry_rule (weekly or monthly) more than days_before_expiry days away, and the strike of moneyness,
+   strike_offset and strike_step, or the strike whose delta or premium is nearest to target_delta or target_premium.
+   Twice the quantity is bought when the boost status is on. The expiries are computed from the calendar of the nifty
+   options, as the expired contracts are not in the instrument master, so an algo whose options this calendar does not
+   know is not backtested.
+2. An exit signal (LX/SX) sells the option bought by the last entry of the same side. A position still open at the
+   expiry of its option is closed at the last candle before expiry.
+3. The orders are limit orders priced as in zerodhafunctions.get_price, placed at the close of the signal candle. An
+   order is filled at its limit price if the option trades at that price in the next candle, else at the close of the
+   next candle, as the order monitor would chase it.
+
+The historical prices of the options are not available from kite once the contracts expire. The price of the option is
+therefore computed from the candle of the security with the Black-Scholes formula, at a constant volatility.
+All the trades of an algo are priced at once with numpy, so one year of candles of one strategy runs in well under a
+second. backtest_many() runs several algos in parallel processes.
+
+usage: python backtest.py --start 2022-01-01 --end 2024-12-31 [algo ...]
+"""
+
+import logsetup
+import candlestore
+import instrumentmaster
+import optionchain
+import greeks
+import scheduler
+import strategies
+
+from datetime import datetime, date, time, timedelta
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import argparse
+import calendar
+import pytz
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# time of the day till which the orders are placed 3% away from the last price (see get_price)
+cool_time = time(9, 20, 0)
+
+# end of market hours in hours after midnight
+end_time_hours = 15.5
+
+# the monthly options of nifty expire on the last thursday of the month till august 2025, on the last tuesday after
+expiry_weekday_change = date(2025, 9, 1)
+
+# candles dropped at the start of the data, while the indicators warm up. same as in RunAlgo.signal_processing.
+warmup_candles = 50
+
+# maximum days of candles returned by one kite.historical_data call, per interval
+history_limits = {'minute': 60, '3minute': 100, '5minute': 100, '10minute': 100, '15minute': 200, '30minute': 200,
+                  '60minute': 400, 'day': 2000}
+
+
+def monthly_expiry(year, month):
+    """returns the expiry date of the monthly nifty options of the month. Holidays move the expiry a day earlier."""
+
+    first = date(year, month, 1)
+    weekday = calendar.TUESDAY if first >= expiry_weekday_change else calendar.THURSDAY
+    expiry = date(year, month, calendar.monthrange(year, month)[1])
+    while expiry.weekday() != weekday:
+        expiry -= timedelta(1)
+    while not scheduler.is_trading_day(expiry):
+        expiry -= timedelta(1)
+    return expiry
+
+
+def weekly_expiry(day):
+    """returns the expiry of the weekly nifty options of the week of the day. Holidays move the expiry a day earlier."""
+
+    monday = day - timedelta(day.weekday())
+    expiry = monday + timedelta(calendar.TUESDAY)
+    if expiry < expiry_weekday_change:
+        expiry = monday + timedelta(calendar.THURSDAY)
+    while not scheduler.is_trading_day(expiry):
+        expiry -= timedelta(1)
+    return expiry
+
+
+def option_expiry(day, days_before_expiry, expiry_rule='monthly'):
+    """returns the expiry of the option bought during the market hours of the day, with the rule of get_symbol
+    (optionchain.first_expiry): the first weekly or monthly expiry more than days_before_expiry days away"""
+
+    if expiry_rule == 'weekly':
+        expiries = [weekly_expiry(day + timedelta(7 * week)) for week in range(10)]
+    else:
+        months = [day.replace(day=1) + timedelta(32 * month) for month in range(3)]
+        expiries = [monthly_expiry(month.year, month.month) for month in months]
+    return optionchain.first_expiry(expiries, days_before_expiry, datetime.combine(day, candlestore.start_time))
+
+
+def option_symbol(underlying, expiry, strike, option_type):
+    # tradingsymbol of kite: NIFTY24MAR22000CE for the monthly expiries, NIFTY2431422000CE (year, month 1-9, O, N, D
+    # and day) for the weekly ones
+    if expiry == monthly_expiry(expiry.year, expiry.month):
+        return '{}{}{}{}'.format(underlying, expiry.strftime('%y%b').upper(), int(strike), option_type)
+    return '{}{}{}{:02d}{}{}'.format(underlying, expiry.strftime('%y'), '123456789OND'[expiry.month - 1], expiry.day,
+                                     int(strike), option_type)
+
+
+def unsupported(algo_details):
+    """returns why the options of the algo can not be chosen as get_symbol chooses them, or None"""
+
+    if algo_details.get('expiry_rule', 'monthly') not in ('monthly', 'weekly'):
+        return 'expiry rule {} is not weekly or monthly'.format(algo_details['expiry_rule'])
+    if algo_details.get('expiry_rule') == 'weekly' and optionchain.underlying_of(algo_details) != 'NIFTY':
+        return 'the weekly expiries of {} are not known'.format(optionchain.underlying_of(algo_details))
+    if algo_details.get('moneyness', 'ITM') not in ('ATM', 'ITM', 'OTM'):
+        return 'moneyness {} is not ATM, ITM or OTM'.format(algo_details['moneyness'])
+    if not algo_details.get('strike_step', 100):
+        return 'the strikes listed in the past are not known, strike_step is needed'
+    return None
+
+
+def option_strikes(spot, is_call, years, algo_details, volatility, rate):
+    """returns the strikes of the options bought at the spot prices, chosen as get_symbol chooses them among the
+    multiples of strike_step: the strike of moneyness and strike_offset (as ExpiryChain.contract), or the strike within
+    greeks.strike_range of the spot whose delta or price at the volatility of the backtest is nearest to target_delta
+    or target_premium (as ChainGreeks.select)."""
+
+    step = algo_details.get('strike_step', 100)
+    floor = step * np.floor(spot / step)
+    target_delta, target_premium = algo_details.get('target_delta'), algo_details.get('target_premium')
+
+    if target_delta is not None or target_premium is not None:
+        n = int(greeks.strike_range // step)
+        candidates = floor[:, None] + step * np.arange(-n, n + 2)[None, :]
+        values = greeks.greeks(spot[:, None], candidates, years[:, None], is_call, volatility, rate)
+        if target_delta is not None:
+            distance = np.abs(np.abs(values['delta']) - abs(target_delta))
+        else:
+            distance = np.abs(values['price'] - target_premium)
+        distance = np.where(np.abs(candidates - spot[:, None]) <= greeks.strike_range, distance, np.inf)
+        return candidates[np.arange(len(spot)), np.argmin(distance, axis=1)]
+
+    # ITM is the nearest strike in the money, OTM the nearest out of the money and ATM the nearest strike. the offset
+    # moves the strike deeper in the money for ITM and ATM, further out of the money for OTM.
+    offset = algo_details.get('strike_offset', 0) * step
+    at_floor = floor == spot
+    if is_call:
+        itm, otm, deeper = floor, floor + step, -1
+    else:
+        itm = np.where(at_floor, floor, floor + step)
+        otm, deeper = itm - step, 1
+
+    moneyness = algo_details.get('moneyness', 'ITM')
+    if moneyness == 'ITM':
+        return itm + deeper * offset
+    if moneyness == 'OTM':
+        return otm - deeper * offset
+    nearest = np.where(floor + step - spot < spot - floor, floor + step, floor)
+    return nearest + deeper * offset
+
+
+def limit_prices(last_price, order_minutes, order_type):
+    """limit prices of the orders as in get_price. order_minutes are the times of the orders in minutes of the day.
+    At candle close the last close of the option is its last price, so the orders after the cool time are 0.20 away
+    from the last price whatever the interval."""
+
+    early_order = order_minutes < cool_time.hour * 60 + cool_time.minute
+    if order_type == 'buy':
+        early = np.ceil(10 * 0.97 * last_price) / 10
+        normal = last_price - 0.20
+    else:
+        early = np.floor(10 * 1.03 * last_price) / 10
+        normal = last_price + 0.20
+    return np.where(early_order, early, normal)
+
+
+def load_candles(algo_details, start=None, end=None, store=None):
+    """returns the stored candles of the security of the algo between start and end (dates)"""
+
+    store = store or candlestore.CandleStore()
+    security = instrumentmaster.get_master().by_symbol(algo_details['security'])
+    df = store.read(security['instrument_token'], algo_details['interval'],
+                    IST.localize(datetime.combine(start, time(0, 0, 0))) if start else None)
+    if end is not None:
+        df = df[df['date'].dt.date <= end].reset_index(drop=True)
+    return df
+
+
+def download(kite, token, interval, moment, end, now):
+    # yields the completed candles from moment to end (datetimes) in the chunks allowed by kite, with the end of the
+    # chunk
+    while moment < end:
+        chunk_end = min(moment + timedelta(history_limits[interval]), end)
+        records = kite.historical_data(token, from_date=moment.strftime('%Y-%m-%d %H:%M:%S'),
+                                       to_date=chunk_end.strftime('%Y-%m-%d %H:%M:%S'), interval=interval)
+        yield [record for record in records
+               if candlestore.candle_end(datetime.fromtimestamp(candlestore.to_epoch(record['date']), IST),
+                                         interval) <= now], chunk_end
+        moment = chunk_end + timedelta(seconds=1)
+
+
+def fetch_history(kite, token, interval, start, store=None):
+    """downloads the candles of the token from start (a date) till now in the store, in the chunks allowed by kite.
+    The candles before the first stored candle and the gaps recorded by the store are downloaded and inserted, and the
+    candles after the last stored candle are appended."""
+
+    store = store or candlestore.CandleStore()
+    moment = IST.localize(datetime.combine(start, time(0, 0, 0)))
+    now = datetime.now(IST)
+
+    # the history missing before the first stored candle and in the gaps after start
+    first = store.first_timestamp(token, interval)
+    missing = []
+    if first is not None and moment.timestamp() < first:
+        missing.append([int(moment.timestamp()), first - 1])
+    missing += [[max(gap_start, int(moment.timestamp())), gap_end]
+                for gap_start, gap_end in store.gaps(token, interval) if gap_end >= moment.timestamp()]
+    for missing_start, missing_end in missing:
+        records = []
+        for completed, chunk_end in download(kite, token, interval, datetime.fromtimestamp(missing_start, IST),
+                                             datetime.fromtimestamp(missing_end, IST), now):
+            records += completed
+        inserted = store.insert(token, interval, records)
+        store.clear_gaps(token, interval, missing_start, missing_end)
+        logger.info('{} candles of {} for interval {} inserted from {} to {}'.format(
+            inserted, token, interval, datetime.fromtimestamp(missing_start, IST),
+            datetime.fromtimestamp(missing_end, IST)))
+
+    last = store.last_timestamp(token, interval)
+    if last is not None:
+        moment = max(moment, datetime.fromtimestamp(last, IST) + timedelta(seconds=1))
+    for completed, chunk_end in download(kite, token, interval, moment, now, now):
+        store.append(token, interval, completed)
+        logger.info('{} candles of {} for interval {} stored till {}'.format(len(completed), token, interval, chunk_end))
+
+
+def pair_trades(signals, entry, exit, expiry_index):
+    """returns the candle indices of the entries and exits of one side.
+    An entry opens a position only when the side has no position. The position is closed by the next exit signal, or
+    at the last candle before the expiry of its option (expiry_index gives that candle for each candle)."""
+
+    entries = np.flatnonzero(signals == entry)
+    exits = np.flatnonzero(signals == exit)
+    last_candle = len(signals) - 1
+
+    trades = []
+    position = 0
+    while True:
+        k = np.searchsorted(entries, position)
+        if k == len(entries) or entries[k] >= last_candle:
+            break
+        opened = entries[k]
+        x = np.searchsorted(exits, opened, side='right')
+        closed = exits[x] if x < len(exits) else last_candle
+        expired = expiry_index[opened] < closed
+        closed = min(closed, expiry_index[opened])
+        trades.append((opened, closed, expired))
+        position = closed + 1
+    return trades
+
+
+def simulate(df, signal, algo_details, volatility=0.15, rate=0.07):
+    """trades the signals of the candles in df. Returns the trades as a dataframe."""
+
+    interval = algo_details['interval']
+    qty = algo_details['baseqty'] * algo_details['lot_size']
+    days_before_expiry = algo_details['days_before_expiry']
+    expiry_rule = algo_details.get('expiry_rule', 'monthly')
+    underlying = optionchain.underlying_of(algo_details)
+
+    # the orders of a candle are placed when the candle closes. day candles close at the end of market hours.
+    minutes = candlestore.interval_minutes(interval)
+    if minutes is None:
+        close_times = df['date'].dt.normalize() + pd.Timedelta(hours=end_time_hours)
+    else:
+        close_times = df['date'] + pd.Timedelta(minutes=minutes)
+    close_epoch = (close_times - pd.Timestamp(0, tz='UTC')).dt.total_seconds().values
+    close_minutes = (close_times.dt.hour * 60 + close_times.dt.minute).values
+
+    days = df['date'].dt.date.values
+    spot_high, spot_low, spot_close = df['high'].values, df['low'].values, df['close'].values
+
+    # expiry of the option bought at each candle, and the last candle before that expiry
+    unique_days = np.unique(days)
+    expiry_of_day = {day: option_expiry(day, days_before_expiry, expiry_rule) for day in unique_days}
+    expiries = np.array([expiry_of_day[day] for day in days])
+    expiry_index = np.searchsorted(days, expiries, side='right') - 1
+
+    sides = [('long', 'long_signal', 'LE', 'LX', True, 1), ('short', 'short_signal', 'SE', 'SX', False, -1)]
+    trades = []
+    for side, column, entry, exit, is_call, boost in sides:
+        signals = signal[column].astype(str).values.copy()
+        signals[:warmup_candles] = ''
+        pairs = pair_trades(signals, entry, exit, expiry_index)
+        if not pairs:
+            continue
+
+        opened, closed, expired = (np.array(values) for values in zip(*pairs))
+        spot = spot_close[opened]
+        expiry = expiries[opened]
+        expiry_close = np.array([IST.localize(datetime.combine(day, candlestore.end_time)).timestamp()
+                                 for day in expiry])
+
+        def years(index):
+            # time to expiry at the close of the candles
+            return (expiry_close - close_epoch[index]) / (365 * 86400)
+
+        strike = option_strikes(spot, is_call, np.maximum(years(opened), 1e-6), algo_details, volatility, rate)
+
+        def price(spot_values, index):
+            return greeks.option_price(spot_values, strike, years(index), is_call, volatility, rate)
+
+        # entry: buy limit at the close of the signal candle, filled in the next candle if the option trades at it
+        entry_last = price(spot, opened)
+        entry_limit = limit_prices(entry_last, close_minutes[opened], 'buy')
+        fill = opened + 1
+        entry_low = price(spot_low[fill] if is_call else spot_high[fill], fill)
+        entry_filled = entry_low <= entry_limit
+        entry_price = np.where(entry_filled, entry_limit, price(spot_close[fill], fill))
+
+        # exit: sell limit at the close of the exit candle. positions closed at expiry are sold at the last close.
+        has_next = closed + 1 < len(df)
+        fill = np.where(has_next & ~expired, closed + 1, closed)
+        exit_last = price(spot_close[closed], closed)
+        exit_limit = limit_prices(exit_last, close_minutes[closed], 'sell')
+        exit_high = price(spot_high[fill] if is_call else spot_low[fill], fill)
+        exit_filled = (exit_high >= exit_limit) & (fill != closed)
+        exit_price = np.where(exit_filled, exit_limit, np.where(fill != closed, price(spot_close[fill], fill),
+                                                                exit_last))
+
+        boosted = signal['boost_status'].values[opened] == boost
+        quantity = np.where(boosted, 2 * qty, qty)
+        option_type = 'CE' if is_call else 'PE'
+        trades.append(pd.DataFrame({
+            'algo': algo_details['algo'],
+            'side': side,
+            'entry_time': df['date'].iloc[opened].reset_index(drop=True),
+            'exit_time': df['date'].iloc[closed].reset_index(drop=True),
+            'tradingsymbol': [option_symbol(underlying, day, k, option_type) for day, k in zip(expiry, strike)],
+            'expiry': expiry,
+            'quantity': quantity,
+            'entry_price': entry_price.round(2),
+            'exit_price': exit_price.round(2),
+            'entry_chased': ~entry_filled,
+            'exit_chased': ~exit_filled & (fill != closed),
+            'expired': expired,
+            'pnl': ((exit_price - entry_price) * quantity).round(2)}))
+
+    if not trades:
+        return pd.DataFrame()
+    return pd.concat(trades, ignore_index=True).sort_values('entry_time', ignore_index=True)
+
+
+def summary(trades):
+    """returns the number of trades, total profit, win rate and maximum drawdown of the trades"""
+
+    if trades.empty:
+        return {'trades': 0, 'pnl': 0.0, 'win_rate': 0.0, 'max_drawdown': 0.0}
+
+    equity = trades.sort_values('exit_time')['pnl'].cumsum().values
+    drawdown = np.maximum.accumulate(np.maximum(equity, 0)) - equity
+    return {'trades': len(trades),
+            'pnl': round(float(trades['pnl'].sum()), 2),
+            'win_rate': round(float((trades['pnl'] > 0).mean()), 3),
+            'max_drawdown': round(float(drawdown.max()), 2)}
+
+
+def backtest(algo_details, start=None, end=None, df=None, volatility=0.15, rate=0.07):
+    """runs the backtest of one algo of algo_list.txt. df are the candles of its security; they are read from the
+    candle store if not given. Returns the trades and their summary."""
+
+    started = datetime.now()
+    if df is None:
+        df = load_candles(algo_details, start, end)
+
+    # the options of the algo must be chosen as get_symbol chooses them
+    reason = unsupported(algo_details)
+    if reason is not None:
+        logger.info('backtest of algo {} not run: {}'.format(algo_details['algo'], reason))
+        return pd.DataFrame(), summary(pd.DataFrame())
+
+    strategy = strategies.get_signal(algo_details['algo'])
+    if strategy is None or len(df) <= warmup_candles:
+        logger.info('backtest of algo {} not run: no strategy or not enough candles'.format(algo_details['algo']))
+        return pd.DataFrame(), summary(pd.DataFrame())
+
+    signal = strategy(df.copy())
+    trades = simulate(df, signal, algo_details, volatility, rate)
+    result = summary(trades)
+    result['candles'] = len(df)
+    result['seconds'] = round((datetime.now() - started).total_seconds(), 3)
+    logger.info('backtest of algo {}: {}'.format(algo_details['algo'], result))
+    return trades, result
+
+
+def backtest_many(algo_config, start=None, end=None, max_workers=None):
+    """runs the backtests of the algos in parallel processes. Returns a dict of algo: (trades, summary)."""
+
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(backtest, algo_details, start, end): algo_details['algo']
+                   for algo_details in algo_config}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='backtest of the strategies of algo_list.txt on the stored candles')
+    parser.add_argument('algos', nargs='*', help='algos to backtest. all algos of algo_list.txt if none.')
+    parser.add_argument('--start', type=lambda text: datetime.strptime(text, '%Y-%m-%d').date())
+    parser.add_argument('--end', type=lambda text: datetime.strptime(text, '%Y-%m-%d').date())
+    parser.add_argument('--trades', help='csv file to write the trades')
+    args = parser.parse_args()
+
+    with open('algo_list.txt', 'r') as file:
+        algo_config = [eval(line) for line in file.read().split('\n') if line.strip()]
+        file.close()
+    if args.algos:
+        algo_config = [algo for algo in algo_config if algo['algo'] in args.algos]
+
+    results = backtest_many(algo_config, args.start, args.end)
+    for algo, (trades, result) in sorted(results.items()):
+        print('{}: {}'.format(algo, result))
+
+    if args.trades:
+        pd.concat([trades for trades, result in results.values()], ignore_index=True).to_csv(args.trades, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the micro benchmarks of the functions run at every candle close and order check.
+The functions are run against the simulated broker of simbroker.py on synthetic data, on a simulated clock, so no kite
+account is needed and the sleeps of the functions take no time. The order store, orderbook, signal journal and candle
+store are kept in a temporary folder.
+The purpose of this module is:
+1. Time each function over many runs and report the median, 95th percentile and best time in milliseconds.
+2. Write the results in benchmarks.json.
+3. Compare the results with the stored baseline (benchmarks_baseline.json) and report the regressions.
+
+usage: python benchmarks.py [--repeat 50] [--save-baseline] [--tolerance 0.25] [name ...]
+The exit code is 1 if a benchmark is slower than its baseline by more than the tolerance.
+The baseline is not part of the repository, as the times depend on the machine. Store one on the machine of the
+comparison with --save-baseline (e.g. before a change), then run the benchmarks again to compare with it.
+"""
+
+import logsetup
+import instrumentmaster
+import multiprocess_functions
+import ordermanagement
+import simbroker
+import strategies
+import supportfunctions
+import zerodhafunctions
+import backtest
+import greeks
+import clock
+
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import argparse
+import tempfile
+import shutil
+import json
+import timeit
+import pytz
+import sys
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# results of the last run and the stored baseline
+results_file = os.path.join(dir_path, 'benchmarks.json')
+baseline_file = os.path.join(dir_path, 'benchmarks_baseline.json')
+
+# the benchmarks run on this day at the close of a 15 minute candle
+bench_time = datetime(2024, 3, 14, 11, 0, 0)
+
+# token of the underlying in the synthetic data
+nifty_token = 256265
+
+# name of the strategy which gives no signal
+noop_algo = 'benchmark_noop'
+
+# options of the synthetic option chain of the greeks benchmarks: calls and puts of 200 strikes
+n_chain_strikes = 200
+
+# instruments of the synthetic instrument master, about the size of the instruments.csv of kite
+n_instruments = 90000
+
+
+def noop_signal(df):
+    # strategy without any signal, so that the benchmarks of signal processing time the system and not a strategy
+    df['long_signal'] = 'NaN'
+    df['short_signal'] = 'NaN'
+    df['boost_status'] = 0
+    return df
+
+
+def synthetic_candles(days=30, seed=1, price=22000.0):
+    """returns the minute candles of a random walk for the trading days before the benchmark day and the day itself"""
+
+    rng = np.random.default_rng(seed)
+    sessions = pd.bdate_range(end=bench_time.date(), periods=days)
+    starts = [session + pd.Timedelta(hours=9, minutes=15) + pd.Timedelta(minutes=minute)
+              for session in sessions for minute in range(375)]
+    close = price + np.cumsum(rng.normal(0, 5, len(starts)))
+    open_ = np.concatenate([[price], close[:-1]])
+    spread = np.abs(rng.normal(0, 3, (2, len(starts))))
+    return pd.DataFrame({'date': pd.DatetimeIndex(starts).tz_localize(IST),
+                         'open': open_,
+                         'high': np.maximum(open_, close) + spread[0],
+                         'low': np.minimum(open_, close) - spread[1],
+                         'close': close,
+                         'volume': rng.integers(1000, 5000, len(starts))})
+
+
+def synthetic_instruments(filename, price=22000.0):
+    # instrument master with the nifty options of the month of the benchmark and the next month, and stocks
+    rows = [{'instrument_token': nifty_token, 'exchange_token': 1001, 'tradingsymbol': 'NIFTY 50', 'name': 'NIFTY 50',
+             'expiry': '', 'strike': 0, 'tick_size': 0, 'lot_size': 0, 'instrument_type': 'EQ',
+             'segment': 'INDICES', 'exchange': 'NSE'}]
+    month = bench_time.date().replace(day=1)
+    for expiry in (backtest.monthly_expiry(month.year, month.month),
+                   backtest.monthly_expiry((month + timedelta(32)).year, (month + timedelta(32)).month)):
+        for strike in range(int(price * 0.8) // 100 * 100, int(price * 1.2), 50):
+            for option_type in ('CE', 'PE'):
+                rows.append({'instrument_token': len(rows) + 10000, 'exchange_token': len(rows),
+                             'tradingsymbol': 'NIFTY' + expiry.strftime('%y%b').upper() + str(strike) + option_type,
+                             'name': 'NIFTY', 'expiry': expiry.strftime('%Y-%m-%d'), 'strike': strike,
+                             'tick_size': 0.05, 'lot_size': 50, 'instrument_type': option_type,
+                             'segment': 'NFO-OPT', 'exchange': 'NFO'})
+    for stock in range(n_instruments - len(rows)):
+        rows.append({'instrument_token': 5000000 + stock, 'exchange_token': stock,
+                     'tradingsymbol': 'STOCK{}'.format(stock), 'name': 'STOCK {}'.format(stock), 'expiry': '',
+                     'strike': 0, 'tick_size': 0.05, 'lot_size': 1, 'instrument_type': 'EQ', 'segment': 'NSE',
+                     'exchange': 'NSE'})
+    pd.DataFrame(rows).to_csv(filename, index=False)
+
+
+def synthetic_chain(price=22000.0, years=30 / 365):
+    # prices of the calls and puts of a chain with a volatility smile, as arrays of the same length
+    strikes = np.tile(price + 25 * (np.arange(n_chain_strikes) - n_chain_strikes // 2), 2).astype(float)
+    is_call = np.repeat([True, False], n_chain_strikes)
+    volatility = 0.13 + 0.5 * (np.log(strikes / price)) ** 2
+    prices = greeks.option_price(price, strikes, years, is_call, volatility, greeks.rate)
+    return {'spot': price, 'strikes': strikes, 'years': years, 'is_call': is_call, 'prices': prices}
+
+
+def measure(function, repeat):
+    # times the function once to warm up and then repeat times. returns the times in milliseconds.
+    function()
+    times = np.array(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+    return {'median': round(float(np.median(times)), 4),
+            'p95': round(float(np.percentile(times, 95)), 4),
+            'best': round(float(times.min()), 4),
+            'runs': repeat}
+
+
+class Benchmarks:
+    """This class prepares the data of the benchmarks and holds the function of each benchmark.
+    Each benchmark is a method named bench_<name> which returns the function to be timed."""
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.kite = simbroker.SimKite({nifty_token: synthetic_candles()}, {'NSE:NIFTY 50': nifty_token})
+
+        # instrument master of the benchmark, in place of instruments.csv
+        self.instrument_files = (instrumentmaster.csv_file, instrumentmaster.binary_file)
+        instrumentmaster.csv_file = os.path.join(workdir, 'instruments.csv')
+        instrumentmaster.binary_file = os.path.join(workdir, 'instruments.npz')
+        synthetic_instruments(instrumentmaster.csv_file)
+
+        self.saved = simbroker.use_stores(workdir, clock.SimClock(bench_time))
+        multiprocess_functions.kite = self.kite
+        instrumentmaster.master = instrumentmaster.InstrumentMaster(
+            instrumentmaster.build(instrumentmaster.csv_file, instrumentmaster.binary_file))
+
+        # no-op strategy in the registry, as if imported from its module
+        strategies.registry.signals[noop_algo] = noop_signal
+        strategies.registry.modules[noop_algo] = None
+
+        self.hist_data = zerodhafunctions.get_candles(self.kite, nifty_token, 25, '15minute')
+        self.option = zerodhafunctions.get_symbol(self.kite, 'LE', 1, 50, 0, 4)['tradingsymbol']
+
+    def close(self):
+        simbroker.restore_stores(self.saved)
+        instrumentmaster.csv_file, instrumentmaster.binary_file = self.instrument_files
+        instrumentmaster.master = None
+
+    def bench_get_historical(self):
+        # historical data of 25 days from the broker and its dataframe
+        return lambda: zerodhafunctions.get_historical(self.kite, nifty_token, 25, '15minute')
+
+    def bench_historical_dataframe(self):
+        # dataframe of the records of kite only
+        records = self.kite.historical_data(nifty_token, '2024-02-18', '2024-03-14', '15minute')
+        return lambda: pd.DataFrame(records)
+
+    def bench_get_candles(self):
+        # historical data of 25 days from the candle store, with the candles missing in the store from the broker
+        return lambda: zerodhafunctions.get_candles(self.kite, nifty_token, 25, '15minute')
+
+    def bench_instruments_load(self):
+        # instruments.csv parsed and indexed, as on the first call of the day
+        return lambda: instrumentmaster.InstrumentMaster(
+            instrumentmaster.build(instrumentmaster.csv_file, instrumentmaster.binary_file))
+
+    def bench_get_symbol(self):
+        return lambda: zerodhafunctions.get_symbol(self.kite, 'LE', 1, 50, 0, 4)
+
+    def bench_get_price(self):
+        return lambda: zerodhafunctions.get_price(self.kite, self.option, '15minute', 'buy')
+
+    def bench_writesignal(self):
+        # one new candle appended to the journal per run, as at every candle close
+        signal = noop_signal(synthetic_candles(days=5))
+        runs = iter(range(1, len(signal)))
+        return lambda: supportfunctions.writesignal(signal.iloc[:next(runs)], 'benchmark_journal')
+
+    def bench_writeorderinfo(self):
+        order = {'order_id': '1', 'status': 'OPEN', 'tradingsymbol': self.option, 'quantity': 50, 'price': 100.0,
+                 'transaction_type': 'BUY', 'tag': None}
+        return lambda: supportfunctions.writeorderinfo(dict(order), 'benchmark_orders', 'LE')
+
+    def bench_monitor_trade(self):
+        # one open order, checked against the orderbook and modified to the last price
+        order_id = self.kite.place_order(variety=self.kite.VARIETY_REGULAR, exchange=self.kite.EXCHANGE_NFO,
+                                         tradingsymbol=self.option, transaction_type=self.kite.TRANSACTION_TYPE_BUY,
+                                         quantity=50, product=self.kite.PRODUCT_NRML,
+                                         order_type=self.kite.ORDER_TYPE_LIMIT, price=0.05,
+                                         validity=self.kite.VALIDITY_DAY)
+        supportfunctions.writeorderinfo(self.kite.order_history(order_id)[-1], noop_algo, 'LE')
+        return lambda: ordermanagement.monitor_trade(self.kite, noop_algo)
+
+    def bench_get_symbol_delta(self):
+        # the call of delta 0.5, with the greeks of the chain near the spot
+        return lambda: zerodhafunctions.get_symbol(self.kite, 'LE', 1, 50, 0, 4, target_delta=0.5)
+
+    def bench_greeks_chain(self):
+        # implied volatility and greeks of all the options of the chain, from their prices
+        chain = synthetic_chain()
+
+        def run():
+            volatility = greeks.implied_volatility(chain['prices'], chain['spot'], chain['strikes'], chain['years'],
+                                                   chain['is_call'])
+            return greeks.greeks(chain['spot'], chain['strikes'], chain['years'], chain['is_call'], volatility)
+        return run
+
+    def bench_greeks_chain_scalar(self):
+        # the same computation with the plain python reference, one option at a time
+        chain = synthetic_chain()
+        options = list(zip(chain['prices'].tolist(), chain['strikes'].tolist(), chain['is_call'].tolist()))
+
+        def run():
+            results = []
+            for price, strike, is_call in options:
+                volatility = greeks.scalar_implied_volatility(price, chain['spot'], strike, chain['years'], is_call)
+                if volatility is not None:
+                    results.append(greeks.scalar_greeks(chain['spot'], strike, chain['years'], is_call, volatility))
+            return results
+        return run
+
+    def bench_signal_processing(self):
+        # signal of the no-op strategy on the shared historical data, written in the journal
+        run_algo = multiprocess_functions.RunAlgo(noop_algo, '15minute', 'NSE:NIFTY 50', self.hist_data)
+        return run_algo.signal_processing
+
+    def bench_noop_signal(self):
+        return lambda: noop_signal(self.hist_data.copy())
+
+
+def benchmark_names():
+    return [name[len('bench_'):] for name in dir(Benchmarks) if name.startswith('bench_')]
+
+
+def run(names=None, repeat=50):
+    """runs the benchmarks and returns a dict of name: times"""
+
+    workdir = tempfile.mkdtemp(prefix='benchmarks_')
+    benchmarks = Benchmarks(workdir)
+    results = {}
+    try:
+        for name in names or benchmark_names():
+            results[name] = measure(getattr(benchmarks, 'bench_' + name)(), repeat)
+            logger.info('benchmark {}: {}'.format(name, results[name]))
+    finally:
+        benchmarks.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """returns the lines of the report and the names of the benchmarks whose median is slower than the baseline by
+    more than the tolerance"""
+
+    lines = ['{:<22}{:>12}{:>12}{:>12}{:>12}{:>10}'.format('benchmark', 'median ms', 'p95 ms', 'best ms',
+                                                           'baseline', 'change')]
+    regressions = []
+    for name, times in results.items():
+        base = baseline.get(name, {}).get('median')
+        change = ''
+        if base:
+            ratio = times['median'] / base - 1
+            change = '{:+.0%}'.format(ratio)
+            if ratio > tolerance:
+                regressions.append(name)
+                change += ' !'
+        lines.append('{:<22}{:>12.3f}{:>12.3f}{:>12.3f}{:>12}{:>10}'.format(name, times['median'], times['p95'],
+                                                                            times['best'],
+                                                                            '{:.3f}'.format(base) if base else '-',
+                                                                            change))
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro benchmarks of the functions of the trading loop')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default: ' + ', '.join(benchmark_names()))
+    parser.add_argument('--repeat', type=int, default=50, help='runs of each benchmark')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown over the baseline reported as regression')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    results = run(args.names, args.repeat)
+    with open(results_file, 'w') as file:
+        json.dump({'run_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, file, indent=2)
+        file.close()
+
+    baseline = {}
+    if os.path.isfile(baseline_file):
+        with open(baseline_file, 'r') as file:
+            baseline = json.load(file)['results']
+            file.close()
+
+    lines, regressions = compare(results, baseline, args.tolerance)
+    print('\n'.join(lines))
+
+    missing = [name for name in results if not baseline.get(name, {}).get('median')]
+    if not baseline and not args.save_baseline:
+        print('no baseline in {}, nothing compared. run python benchmarks.py --save-baseline on this machine to store '
+              'one.'.format(baseline_file))
+    elif missing and not args.save_baseline:
+        print('not in the baseline, not compared: {}'.format(', '.join(missing)))
+
+    if args.save_baseline:
+        shutil.copyfile(results_file, baseline_file)
+        print('baseline saved in {}'.format(baseline_file))
+    elif regressions:
+        print('regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the broker gateway: one process which holds the kite session for all the workers.
+The gateway process opens the authenticated KiteConnect with a pool of keep-alive connections, and serves the API calls
+of the workers over a local unix socket. The workers get a GatewayClient in place of the kite object, which carries
+only the address of the gateway and the constants of kite, so no session is shared with or opened by the workers.
+The purpose of this module is:
+1. Reuse the same https connections of one session for the API calls of all workers.
+2. Merge the ltp and quote calls of the workers which arrive together in one call.
+3. Apply the rate limits of kite (see ratelimiter.py) in one place.
+"""
+
+import logsetup
+import ratelimiter
+
+from multiprocessing.connection import Listener, Client
+from kiteconnect import KiteConnect
+import multiprocessing
+import _pickle as pickle
+import threading
+import tempfile
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# connection pool of the session in the gateway
+pool = {'pool_connections': 4, 'pool_maxsize': 16}
+
+# calls of the workers which are merged when they arrive together
+batched_methods = ('ltp', 'quote')
+
+# methods of kite which the workers call through the gateway. The session itself (login, access token) is managed by
+# the main process only.
+proxied_methods = ('ltp', 'quote', 'ohlc', 'historical_data', 'instruments', 'orders', 'order_history', 'trades',
+                   'order_trades', 'positions', 'holdings', 'margins', 'profile', 'place_order', 'modify_order',
+                   'cancel_order', 'exit_order')
+
+# request to stop the gateway
+stop_request = '__stop__'
+
+
+def error_response(e):
+    # the exception is sent as its type, message and code, so the worker raises it with the code of kite (e.g. 429)
+    # needed by the rate limiting, also when the exception itself can not be pickled
+    return 'error', (type(e), str(e), getattr(e, 'code', None))
+
+
+def rebuild_error(error):
+    # the exception of the gateway, with its type and code
+    error_type, message, code = error
+    try:
+        e = error_type(message, code) if code is not None else error_type(message)
+    except Exception:
+        e = Exception(message)
+    if code is not None:
+        e.code = code
+    return e
+
+
+class Batcher:
+    """This class merges the calls of one method (ltp or quote) made by several workers at the same time.
+    One call is made at a time. The requests which arrive while a call is running or waiting for the rate limiter are
+    sent together in the next call."""
+
+    def __init__(self, method, wait):
+        self.method = method
+        self.wait = wait
+        self.queue = []
+        self.lock = threading.Lock()
+        self.call_lock = threading.Lock()
+
+    def __call__(self, instruments):
+        request = {'instruments': list(instruments), 'done': threading.Event(), 'result': None, 'error': None}
+        with self.lock:
+            self.queue.append(request)
+
+        with self.call_lock:
+            if not request['done'].is_set():
+                # the requests are collected till the call is allowed by the rate limiter
+                self.wait()
+                with self.lock:
+                    batch, self.queue = self.queue, []
+                merged = sorted(set(instrument for queued in batch for instrument in queued['instruments']))
+                try:
+                    prices = self.method(merged)
+                    error = None
+                except Exception as e:
+                    prices = {}
+                    error = e
+                for queued in batch:
+                    queued['result'] = {instrument: prices[instrument] for instrument in queued['instruments']
+                                        if instrument in prices}
+                    queued['error'] = error
+                    queued['done'].set()
+
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+
+def serve(api_key, access_token, limiter, address, authkey, log_queue=None):
+    """runs in the gateway process. Opens the kite session and answers the requests of the workers."""
+
+    session = KiteConnect(api_key=api_key, access_token=access_token, pool=pool)
+    logsetup.attach(log_queue)
+    ratelimiter.limiter = limiter
+    kite = ratelimiter.RateLimitedKite(session, limiter)
+    # the batched calls take their token while the requests are collected, and go through the rate limited kite so
+    # that a call rejected with 429 is retried
+    batchers = {}
+    for method in batched_methods:
+        lane = ratelimiter.endpoints[method]
+        batchers[method] = Batcher(lambda instruments, method=method: kite.invoke(method, instruments, acquired=True),
+                                   lambda lane=lane: limiter.acquire(lane))
+
+    listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    stopped = threading.Event()
+    logger.info('broker gateway listening on {}'.format(address))
+
+    def handle(connection):
+        # one thread per worker connection. the requests of a connection are answered in order.
+        while True:
+            try:
+                method, args, kwargs = connection.recv()
+            except (EOFError, OSError):
+                break
+
+            if method == stop_request:
+                connection.send(('ok', None))
+                stopped.set()
+                break
+
+            try:
+                if method not in proxied_methods:
+                    raise AttributeError('kite method {} is not served by the broker gateway'.format(method))
+                call = batchers[method] if method in batchers else getattr(kite, method)
+                response = ('ok', call(*args, **kwargs))
+            except Exception as e:
+                response = error_response(e)
+
+            try:
+                connection.send(response)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                # the result or the type of the exception can not be sent
+                error = response[1] if response[0] == 'error' else (type(e), str(e), None)
+                connection.send(('error', (Exception, error[1], error[2])))
+        connection.close()
+
+    def accept():
+        while True:
+            try:
+                connection = listener.accept()
+            except OSError:
+                continue
+            threading.Thread(target=handle, args=(connection,), daemon=True).start()
+
+    # the process ends with the stop request. the threads of the connections end with it.
+    threading.Thread(target=accept, daemon=True).start()
+    stopped.wait()
+    listener.close()
+    logger.info('broker gateway stopped')
+
+
+class GatewayClient:
+    """This class is used by the workers in place of the kite object.
+    The constants of kite (e.g. kite.TRANSACTION_TYPE_BUY) are read locally and the methods of proxied_methods are
+    called in the gateway. Each process opens its own connection to the gateway on first use."""
+
+    def __init__(self, address, authkey, constants):
+        self.address = address
+        self.authkey = authkey
+        self.constants = constants
+        self.connection = None
+        self.pid = None
+        self.lock = None
+
+    def __getstate__(self):
+        # connections are not shared between processes
+        state = dict(self.__dict__)
+        state.update({'connection': None, 'pid': None, 'lock': None})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+        return self.connection
+
+    def request(self, method, *args, **kwargs):
+        """sends the call to the gateway and returns its result. Errors of kite are raised in the worker with their type
+        and code."""
+
+        connection = self.connect()
+        with self.lock:
+            try:
+                connection.send((method, args, kwargs))
+                status, result = connection.recv()
+            except (EOFError, OSError):
+                # the next call opens a new connection
+                self.connection = None
+                raise
+        if status == 'error':
+            raise rebuild_error(result)
+        return result
+
+    def __getattr__(self, name):
+        # called only for the names which are not attributes of the client
+        if name.startswith('_') or name in ('address', 'authkey', 'constants', 'connection', 'pid', 'lock'):
+            raise AttributeError(name)
+        if name in self.constants:
+            return self.constants[name]
+        if name not in proxied_methods:
+            raise AttributeError('kite attribute {} is not available through the broker gateway'.format(name))
+
+        def call(*args, **kwargs):
+            return self.request(name, *args, **kwargs)
+        return call
+
+
+class BrokerGateway:
+    """This class starts and stops the gateway process of the trading day.
+    client() returns the GatewayClient to hand to the workers."""
+
+    def __init__(self, kite):
+        self.address = os.path.join(tempfile.gettempdir(), 'brokergateway_{}.sock'.format(os.getpid()))
+        self.authkey = os.urandom(16)
+        # constants of kite, e.g. the exchanges, order types and transaction types
+        self.constants = {name: getattr(KiteConnect, name) for name in dir(KiteConnect) if name.isupper()}
+        self.process = multiprocessing.Process(target=serve, args=(kite.api_key, kite.access_token,
+                                                                   ratelimiter.get_limiter(), self.address,
+                                                                   self.authkey, logsetup.queue), daemon=True)
+
+    def start(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.process.start()
+
+        # wait till the gateway accepts connections
+        client = self.client()
+        for _ in range(100):
+            try:
+                client.connect()
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.process.join(0.05)
+        logger.info('broker gateway started in process {}'.format(self.process.pid))
+
+    def client(self):
+        return GatewayClient(self.address, self.authkey, self.constants)
+
+    def stop(self):
+        try:
+            self.client().request(stop_request)
+        except Exception as e:
+            logger.info('broker gateway not stopped cleanly: {}'.format(e))
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        if os.path.exists(self.address):
+            os.remove(self.address)
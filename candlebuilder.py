@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the candle builder which makes candles from the ticks of the market data feed.
+The purpose of this module is:
+1. Build the OHLCV candles of the configured securities for each interval of the algos (minute, 3minute, 15minute, ...).
+2. Close the candles exactly at the candle boundary and write them in the candle store.
+3. flush() is called by the scheduler of main_chrome.py at every candle boundary, right before the algos of that
+   interval are run on the closed candle.
+
+The candles are aligned to the start of market hours (9:15), same as the candles of kite.
+The first candle after the feed starts is incomplete. It is not stored, and the candle store fills it from kite.
+"""
+
+import logsetup
+import candlestore
+import clock
+
+from datetime import datetime, time, timedelta
+import threading
+import pytz
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# define market hour timings
+start_time = time(9, 15, 0)
+end_time = time(15, 30, 0)
+
+
+def candle_start(moment, interval):
+    """returns the start of the candle of the interval which contains moment (an IST datetime)"""
+
+    session_start = IST.localize(datetime.combine(moment.date(), start_time))
+    minutes = candlestore.interval_minutes(interval)
+    if minutes is None:
+        return IST.localize(datetime.combine(moment.date(), time(0, 0, 0)))
+
+    elapsed = int((moment - session_start).total_seconds() // 60)
+    return session_start + timedelta(minutes=elapsed - elapsed % minutes)
+
+
+def subscriptions(algo_config, master):
+    """returns the intervals to build for each instrument token, as per the securities and intervals of the algos"""
+
+    tokens = {}
+    for algo_details in algo_config:
+        security = master.by_symbol(algo_details['security'])
+        if security is not None:
+            tokens.setdefault(security['instrument_token'], set()).add(algo_details['interval'])
+    return tokens
+
+
+class CandleBuilder:
+    """This class builds candles from the ticks of the feed.
+    add_ticks() is called by the feed with every set of ticks.
+    flush() closes the candles completed at a boundary and stores them, even if no tick arrived after the boundary."""
+
+    def __init__(self, tokens, store):
+        self.tokens = tokens
+        self.store = store
+        self.candles = {}
+        self.volumes = {}
+        self.started_at = clock.now(IST)
+        self.lock = threading.Lock()
+
+    def add_ticks(self, ticks):
+        now = clock.now(IST)
+        with self.lock:
+            # candles which ended before these ticks are closed first
+            self.close_candles(now)
+
+            if not start_time <= now.time() < end_time:
+                return
+
+            for tick in ticks:
+                token = tick['instrument_token']
+                if token not in self.tokens:
+                    continue
+
+                price = tick['last_price']
+                volume = tick.get('volume_traded', tick.get('volume', 0)) or 0
+                # volume of the day traded before this tick
+                previous_volume = self.volumes.get(token, volume)
+                self.volumes[token] = volume
+                for interval in self.tokens[token]:
+                    start = candle_start(now, interval)
+                    candle = self.candles.get((token, interval))
+                    if candle is None or candle['date'] != start:
+                        candle = {'date': start, 'open': price, 'high': price, 'low': price, 'close': price,
+                                  'volume': 0, 'first_volume': previous_volume, 'partial': start < self.started_at}
+                        self.candles[(token, interval)] = candle
+                    candle['high'] = max(candle['high'], price)
+                    candle['low'] = min(candle['low'], price)
+                    candle['close'] = price
+                    candle['volume'] = volume - candle['first_volume']
+
+    def close_candles(self, now):
+        # stores the candles which are completed at now. incomplete candles are left to be filled from kite.
+        for (token, interval), candle in list(self.candles.items()):
+            if candlestore.candle_end(candle['date'], interval) > now:
+                continue
+
+            del self.candles[(token, interval)]
+            if candle['partial']:
+                logger.info('incomplete candle {} of {} for interval {} not stored'.format(candle['date'], token,
+                                                                                           interval))
+                continue
+
+            # a candle is stored only right after the previous candle, so that no gap is left in the store
+            last = self.store.last_timestamp(token, interval)
+            if last is None or candlestore.next_candle_start(datetime.fromtimestamp(last, IST), interval) < candle['date']:
+                logger.info('candle {} of {} for interval {} not stored, earlier candles are missing'.format(
+                    candle['date'], token, interval))
+                continue
+
+            record = {column: candle[column] for column in candlestore.columns}
+            self.store.append(token, interval, [record])
+
+    def flush(self, boundary):
+        """closes the candles completed at the boundary"""
+
+        with self.lock:
+            self.close_candles(boundary)
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the local candle store used by zerodhafunctions.py.
+The candles of each instrument token and interval are kept in append-only columnar files (one file per column),
+which are read back as memory-mapped numpy arrays.
+The purpose of this module is:
+1. Keep the completed candles on disk so that the history does not need to be downloaded every cycle.
+2. Fetch only the candles since the last stored candle from kite and append them to the store.
+3. Return the window of candles needed by the strategy, including the unfinished candle returned by kite.
+4. Record the gaps left when the window is backfilled after a long break, and insert the history before the first
+   stored candle and in the gaps (backtest.fetch_history).
+"""
+
+import logsetup
+import clock
+
+from datetime import datetime, time, timedelta
+import numpy as np
+import pandas as pd
+import json
+import pytz
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # file locking is not available on windows. the store is then used without locks.
+    fcntl = None
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# market hours. the last candle of the day is completed at end_time.
+start_time = time(9, 15, 0)
+end_time = time(15, 30, 0)
+
+# columns stored for each candle and their data types. date is stored as epoch seconds.
+columns = {'date': np.int64,
+           'open': np.float64,
+           'high': np.float64,
+           'low': np.float64,
+           'close': np.float64,
+           'volume': np.int64}
+
+
+def interval_minutes(interval):
+    """returns the length of a candle in minutes for the interval as defined by zerodha. 'day' returns None."""
+
+    if interval == 'day':
+        return None
+    if interval == 'minute':
+        return 1
+    return int(interval.replace('minute', ''))
+
+
+def candle_end(candle_start, interval):
+    """returns the time at which the candle starting at candle_start is completed."""
+
+    session_end = IST.localize(datetime.combine(candle_start.date(), end_time))
+    minutes = interval_minutes(interval)
+    if minutes is None:
+        return session_end
+
+    return min(candle_start + timedelta(minutes=minutes), session_end)
+
+
+def next_candle_start(candle_start, interval):
+    """returns the start of the candle following the candle starting at candle_start.
+    The candle after the last candle of the day starts at 9:15 of the next day (or midnight for 'day' candles)."""
+
+    end = candle_end(candle_start, interval)
+    if end.time() < end_time:
+        return end
+
+    next_day = datetime.combine(candle_start.date() + timedelta(1), time(0, 0, 0) if interval == 'day' else start_time)
+    return IST.localize(next_day)
+
+
+def to_epoch(date):
+    # kite returns timezone aware datetimes. naive datetimes are assumed to be in IST.
+    if isinstance(date, str):
+        date = pd.Timestamp(date).to_pydatetime()
+    if date.tzinfo is None:
+        date = IST.localize(date)
+    return int(date.timestamp())
+
+
+class CandleStore:
+    """This class stores the candles of each instrument token and interval in its own folder.
+    read() returns the stored candles as a dataframe.
+    append() adds the completed candles which are newer than the last stored candle.
+    insert() adds the completed candles which are older than the last stored candle, by rewriting the columns.
+    sync() fetches the missing candles from kite and returns the window of candles needed by the strategy."""
+
+    def __init__(self, root='candles'):
+        self.root = os.path.join(dir_path, root)
+
+    def path(self, token, interval):
+        folder = os.path.join(self.root, '{}_{}'.format(token, interval))
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def lock(self, folder):
+        # lock the folder so that two workers do not append the same candles at the same time
+        lockfile = open(os.path.join(folder, 'lock'), 'w')
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        return lockfile
+
+    def unlock(self, lockfile):
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+
+    def length(self, folder):
+        # number of complete rows. a crash while appending can leave some columns longer than others.
+        lengths = []
+        for column, dtype in columns.items():
+            filename = os.path.join(folder, column + '.bin')
+            size = os.path.getsize(filename) if os.path.isfile(filename) else 0
+            lengths.append(size // np.dtype(dtype).itemsize)
+        return min(lengths)
+
+    def load_column(self, folder, column, nrows):
+        filename = os.path.join(folder, column + '.bin')
+        if nrows == 0:
+            return np.empty(0, dtype=columns[column])
+        return np.memmap(filename, dtype=columns[column], mode='r', shape=(nrows,))
+
+    def last_timestamp(self, token, interval):
+        """returns the epoch seconds of the last stored candle or None if nothing is stored."""
+
+        folder = self.path(token, interval)
+        nrows = self.length(folder)
+        if nrows == 0:
+            return None
+        return int(self.load_column(folder, 'date', nrows)[-1])
+
+    def first_timestamp(self, token, interval):
+        """returns the epoch seconds of the first stored candle or None if nothing is stored."""
+
+        folder = self.path(token, interval)
+        nrows = self.length(folder)
+        if nrows == 0:
+            return None
+        return int(self.load_column(folder, 'date', nrows)[0])
+
+    def gaps(self, token, interval):
+        """returns the gaps of the stored candles as a list of [from, to] epoch seconds. The candles between from and
+        to (both included) were never fetched."""
+
+        filename = os.path.join(self.path(token, interval), 'gaps.json')
+        if not os.path.isfile(filename):
+            return []
+        with open(filename) as file:
+            return json.load(file)
+
+    def write_gaps(self, folder, gaps):
+        filename = os.path.join(folder, 'gaps.json')
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(sorted(gaps), file)
+        os.replace(filename + '.tmp', filename)
+
+    def record_gap(self, token, interval, start, end):
+        """records that the candles from start to end (epoch seconds, both included) are missing. The gaps which
+        overlap or follow each other are merged, so a gap recorded again (e.g. after a failed fetch) is kept once."""
+
+        folder = self.path(token, interval)
+        lockfile = self.lock(folder)
+        try:
+            merged = []
+            for gap_start, gap_end in sorted(self.gaps(token, interval) + [[int(start), int(end)]]):
+                if merged and gap_start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], gap_end)
+                else:
+                    merged.append([gap_start, gap_end])
+            self.write_gaps(folder, merged)
+        finally:
+            self.unlock(lockfile)
+        logger.info('candles of {} for interval {} missing from {} to {}'.format(
+            token, interval, datetime.fromtimestamp(start, IST), datetime.fromtimestamp(end, IST)))
+
+    def clear_gaps(self, token, interval, start, end):
+        """removes the part of the gaps from start to end (epoch seconds, both included), after it was fetched"""
+
+        folder = self.path(token, interval)
+        lockfile = self.lock(folder)
+        try:
+            remaining = []
+            for gap_start, gap_end in self.gaps(token, interval):
+                if gap_start < start:
+                    remaining.append([gap_start, min(gap_end, start - 1)])
+                if gap_end > end:
+                    remaining.append([max(gap_start, end + 1), gap_end])
+            self.write_gaps(folder, remaining)
+        finally:
+            self.unlock(lockfile)
+
+    def is_current(self, token, interval, now=None):
+        """returns True if the store holds all candles completed till now, i.e. kite does not need to be called."""
+
+        last = self.last_timestamp(token, interval)
+        if last is None:
+            return False
+
+        now = now or clock.now(IST)
+        following = next_candle_start(datetime.fromtimestamp(last, IST), interval)
+        return candle_end(following, interval) > now
+
+    def read(self, token, interval, start=None):
+        """returns the stored candles from start (a datetime) onwards as a dataframe."""
+
+        folder = self.path(token, interval)
+        nrows = self.length(folder)
+        dates = self.load_column(folder, 'date', nrows)
+
+        first = 0
+        if start is not None:
+            first = int(np.searchsorted(dates, to_epoch(start), side='left'))
+
+        data = {column: np.array(self.load_column(folder, column, nrows)[first:]) for column in columns}
+        df = pd.DataFrame(data)
+        df['date'] = pd.to_datetime(df['date'], unit='s', utc=True).dt.tz_convert(IST)
+        return df
+
+    def append(self, token, interval, records):
+        """appends the candles newer than the last stored candle. records are in the format returned by kite."""
+
+        if len(records) == 0:
+            return 0
+
+        folder = self.path(token, interval)
+        lockfile = self.lock(folder)
+        try:
+            nrows = self.length(folder)
+
+            # repair the columns if a previous append was interrupted
+            for column, dtype in columns.items():
+                filename = os.path.join(folder, column + '.bin')
+                if os.path.isfile(filename) and os.path.getsize(filename) > nrows * np.dtype(dtype).itemsize:
+                    with open(filename, 'r+b') as file:
+                        file.truncate(nrows * np.dtype(dtype).itemsize)
+
+            last = int(self.load_column(folder, 'date', nrows)[-1]) if nrows else None
+
+            new_rows = [record for record in records if last is None or to_epoch(record['date']) > last]
+            if not new_rows:
+                return 0
+
+            for column, dtype in columns.items():
+                if column == 'date':
+                    values = np.array([to_epoch(record['date']) for record in new_rows], dtype=dtype)
+                else:
+                    values = np.array([record.get(column, 0) for record in new_rows], dtype=dtype)
+                with open(os.path.join(folder, column + '.bin'), 'ab') as file:
+                    file.write(values.tobytes())
+        finally:
+            self.unlock(lockfile)
+
+        return len(new_rows)
+
+    def insert(self, token, interval, records):
+        """stores the candles older than the last stored candle which are not stored yet, i.e. the history before the
+        first stored candle and the candles of the gaps. The columns are rewritten in order and replaced, so it is
+        meant for backfills while the algos are not reading the store. records are in the format returned by kite."""
+
+        if len(records) == 0:
+            return 0
+
+        folder = self.path(token, interval)
+        lockfile = self.lock(folder)
+        try:
+            nrows = self.length(folder)
+            stored = {column: np.array(self.load_column(folder, column, nrows)) for column in columns}
+
+            dates = np.array([to_epoch(record['date']) for record in records], dtype=np.int64)
+            new = ~np.isin(dates, stored['date'])
+            if nrows:
+                # the candles after the last stored candle are added by append()
+                new &= dates < stored['date'][-1]
+            if not new.any():
+                return 0
+
+            merged = {}
+            for column, dtype in columns.items():
+                if column == 'date':
+                    values = dates
+                else:
+                    values = np.array([record.get(column, 0) for record in records], dtype=dtype)
+                merged[column] = np.concatenate([stored[column], values[new]])
+            order = np.argsort(merged['date'], kind='stable')
+
+            for column in columns:
+                filename = os.path.join(folder, column + '.bin')
+                with open(filename + '.tmp', 'wb') as file:
+                    file.write(merged[column][order].tobytes())
+                os.replace(filename + '.tmp', filename)
+        finally:
+            self.unlock(lockfile)
+
+        return int(new.sum())
+
+    def sync(self, kite, token, interval, ndays):
+        """fetches the candles since the last stored candle, stores the completed ones and returns the candles of
+        last ndays. The unfinished candle returned by kite is kept at the end of the dataframe, same as
+        kite.historical_data.
+        kite is not called when the store already holds the last completed candle (e.g. written by the candle builder
+        of the tick feed). The dataframe then ends with the last completed candle."""
+
+        now = clock.now(IST)
+        window_start = IST.localize(datetime.combine((now - timedelta(ndays)).date(), time(0, 0, 0)))
+
+        last = self.last_timestamp(token, interval)
+        if last is not None and last >= window_start.timestamp() and self.is_current(token, interval, now):
+            return self.read(token, interval, window_start)
+
+        if last is None or last < window_start.timestamp():
+            # nothing stored for the window. backfill all the days, and record the candles skipped since the last
+            # stored candle, so that the store is not read as complete.
+            from_date = window_start
+            if last is not None:
+                self.record_gap(token, interval, last + 1, window_start.timestamp() - 1)
+        else:
+            from_date = datetime.fromtimestamp(last, IST) + timedelta(seconds=1)
+
+        try:
+            records = kite.historical_data(token, from_date=from_date.strftime('%Y-%m-%d %H:%M:%S'),
+                                           to_date=now.strftime('%Y-%m-%d %H:%M:%S'), interval=interval)
+        except Exception as e:
+            # the stored candles are returned if kite is not available
+            logger.info('fetching candles of {} for interval {} failed: {}'.format(token, interval, e))
+            records = []
+
+        completed = []
+        unfinished = []
+        for record in records:
+            candle_start = datetime.fromtimestamp(to_epoch(record['date']), IST)
+            if candle_end(candle_start, interval) <= now:
+                completed.append(record)
+            else:
+                unfinished.append(record)
+
+        self.append(token, interval, completed)
+
+        df = self.read(token, interval, window_start)
+        if unfinished:
+            live = pd.DataFrame(unfinished)
+            live['date'] = pd.to_datetime([to_epoch(date) for date in live['date']], unit='s', utc=True)
+            live['date'] = live['date'].dt.tz_convert(IST)
+            df = pd.concat([df, live[list(columns)]], ignore_index=True)
+
+        return df
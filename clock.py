@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the clock of the trading system.
+The modules read the market time and wait through this module instead of datetime.now and time.sleep, so that the
+trading day can be run on a simulated clock (see simbroker.py).
+The purpose of this module is:
+1. Clock: the real clock, used by default.
+2. SimClock: a clock which starts at a given time and moves forward only when the system sleeps or waits. With speed=0
+   the waits take no real time, so a whole session runs in seconds and always sees the same times.
+3. now(), sleep() and wait(): the functions used by the other modules, which call the clock set with set_clock().
+"""
+
+from datetime import datetime
+import threading
+import time
+import pytz
+
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+
+class Clock:
+    """real clock"""
+
+    def now(self, tz=None):
+        return datetime.now(tz)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, timeout=None):
+        return event.wait(timeout)
+
+
+class SimClock:
+    """simulated clock. start is a datetime in IST.
+    speed is the number of simulated seconds per real second. speed=0 moves the clock without waiting at all."""
+
+    def __init__(self, start, speed=0):
+        if start.tzinfo is None:
+            start = IST.localize(start)
+        self.current = start.timestamp()
+        self.speed = speed
+        self.lock = threading.Lock()
+
+    def now(self, tz=None):
+        # a naive datetime is the wall time of IST, same as datetime.now on the trading machine
+        if tz is None:
+            return datetime.fromtimestamp(self.current, IST).replace(tzinfo=None)
+        return datetime.fromtimestamp(self.current, tz)
+
+    def advance(self, seconds):
+        with self.lock:
+            self.current += max(seconds, 0)
+
+    def sleep(self, seconds):
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        self.advance(seconds)
+
+    def wait(self, event, timeout=None):
+        # waits till the event is set or the timeout has passed on the simulated clock
+        if timeout is None:
+            return event.wait()
+        if event.wait(timeout / self.speed if self.speed else 0):
+            return True
+        self.advance(timeout)
+        return False
+
+
+# clock of the process
+clock = Clock()
+
+
+def set_clock(new_clock):
+    """sets the clock used by all the modules"""
+
+    global clock
+    clock = new_clock
+
+
+def now(tz=None):
+    """same as datetime.now(tz) on the clock of the process"""
+
+    return clock.now(tz)
+
+
+def sleep(seconds):
+    """same as time.sleep on the clock of the process"""
+
+    clock.sleep(seconds)
+
+
+def wait(event, timeout=None):
+    """same as event.wait(timeout) on the clock of the process"""
+
+    return clock.wait(event, timeout)
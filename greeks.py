@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the Black-Scholes pricing of the options, their implied volatility and greeks.
+The functions work on numpy arrays, so a whole option chain is priced in one call without a python loop.
+The purpose of this module is:
+1. option_price(), implied_volatility() and greeks(): vectorized Black-Scholes price, implied volatility (safeguarded
+   Newton iterations) and delta, gamma, vega and theta. backtest.py and simbroker.py price their options with
+   option_price().
+2. ChainGreeks: the implied volatility and greeks of the options of one expiry of an option chain (optionchain.py) near
+   the spot. The prices are read from the tick table of the feed (kite.ltp for the options not in it), and only the
+   options whose price, the spot or the time has changed are computed again, starting from their last volatility.
+3. select(): the option of an expiry with the delta or the premium nearest to a target, used by
+   zerodhafunctions.get_symbol when the algo defines target_delta or target_premium.
+4. scalar_greeks() and scalar_implied_volatility(): the same computation for one option in plain python, the
+   reference of the benchmark (python benchmarks.py greeks_chain greeks_chain_scalar).
+"""
+
+import logsetup
+import marketdata
+import clock
+
+from datetime import datetime, time
+import numpy as np
+import math
+import pytz
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# risk free rate of the pricing, same as the backtest
+rate = 0.07
+
+# seconds in a year of the time to expiry
+year_seconds = 365 * 24 * 3600
+
+# bounds and accuracy of the implied volatility. An option out of the money priced below one tick has no volatility.
+min_price = 0.05
+min_volatility = 0.005
+max_volatility = 5.0
+tolerance = 1e-6
+max_iterations = 50
+
+# options of the chain priced around the spot, same as the options subscribed by marketdata.subscription_tokens
+strike_range = 1000
+
+# seconds after which the time to expiry is updated and all the options are computed again
+time_refresh = 60
+
+# greeks of the chains by (underlying, expiry)
+chain_greeks = {}
+
+
+def normal_cdf(x):
+    # cumulative distribution of the standard normal (Abramowitz and Stegun 7.1.26, error below 1.5e-7)
+    z = np.abs(x) / math.sqrt(2)
+    t = 1.0 / (1.0 + 0.3275911 * z)
+    erf = 1 - (((((1.061405429 * t - 1.453152027) * t) + 1.421413741) * t - 0.284496736) * t + 0.254829592) * t * np.exp(
+        -z * z)
+    return 0.5 * (1 + np.sign(x) * erf)
+
+
+def normal_pdf(x):
+    return np.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+
+def d1_d2(spot, strike, years, volatility, rate):
+    deviation = volatility * np.sqrt(years)
+    d1 = (np.log(spot / strike) + (rate + 0.5 * volatility ** 2) * years) / deviation
+    return d1, d1 - deviation
+
+
+def option_price(spot, strike, years, is_call, volatility=0.15, rate=0.07):
+    """Black-Scholes price of european options. The arguments are numpy arrays or numbers."""
+
+    spot, strike, is_call = np.asarray(spot, float), np.asarray(strike, float), np.asarray(is_call, bool)
+    years = np.maximum(np.asarray(years, float), 1e-6)
+    d1, d2 = d1_d2(spot, strike, years, volatility, rate)
+    discount = np.exp(-rate * years)
+    call = spot * normal_cdf(d1) - strike * discount * normal_cdf(d2)
+    put = strike * discount * normal_cdf(-d2) - spot * normal_cdf(-d1)
+    return np.where(is_call, call, put)
+
+
+def greeks(spot, strike, years, is_call, volatility, rate=rate):
+    """returns a dict of arrays of the price, delta, gamma, vega (per 1.00 of volatility) and theta (per day) of the
+    options"""
+
+    spot, strike, is_call = np.asarray(spot, float), np.asarray(strike, float), np.asarray(is_call, bool)
+    years = np.maximum(np.asarray(years, float), 1e-6)
+    volatility = np.asarray(volatility, float)
+    d1, d2 = d1_d2(spot, strike, years, volatility, rate)
+    discount = np.exp(-rate * years)
+    pdf = normal_pdf(d1)
+    cdf_d1, cdf_d2 = normal_cdf(d1), normal_cdf(d2)
+
+    price = np.where(is_call, spot * cdf_d1 - strike * discount * cdf_d2,
+                     strike * discount * (1 - cdf_d2) - spot * (1 - cdf_d1))
+    delta = np.where(is_call, cdf_d1, cdf_d1 - 1)
+    gamma = pdf / (spot * volatility * np.sqrt(years))
+    vega = spot * pdf * np.sqrt(years)
+    decay = -spot * pdf * volatility / (2 * np.sqrt(years))
+    theta = np.where(is_call, decay - rate * strike * discount * cdf_d2,
+                     decay + rate * strike * discount * (1 - cdf_d2)) / 365
+    return {'price': price, 'delta': delta, 'gamma': gamma, 'vega': vega, 'theta': theta}
+
+
+def implied_volatility(price, spot, strike, years, is_call, rate=rate, initial=None):
+    """returns the implied volatility of the options, NaN where the price is outside the bounds of the model or the
+    option out of the money of the strike is priced below min_price.
+    Each option is solved by Newton iterations kept inside a bracket of the volatility, which is halved when a Newton
+    step leaves it. initial is the starting volatility, e.g. the last volatility of the options. The options without
+    it (initial is None or NaN) start from the approximation of Corrado and Miller.
+    Each strike is solved on its option out of the money (the call above the spot, the put below), whose price is
+    all time value: the price of an option deep in the money is mostly its intrinsic value, which tells nothing of the
+    volatility."""
+
+    price, spot, strike, is_call = np.broadcast_arrays(np.asarray(price, float), np.asarray(spot, float),
+                                                       np.asarray(strike, float), np.asarray(is_call, bool))
+    years = np.broadcast_to(np.maximum(np.asarray(years, float), 1e-6), price.shape)
+
+    # the price must be above the intrinsic value and below the price at the maximum volatility
+    discounted = strike * np.exp(-rate * years)
+    intrinsic = np.where(is_call, np.maximum(spot - discounted, 0), np.maximum(discounted - spot, 0))
+    upper = option_price(spot, strike, years, is_call, max_volatility, rate)
+    valid = np.isfinite(price) & (price > intrinsic) & (price < upper)
+    volatility = np.full(price.shape, np.nan)
+
+    # price of the call of the strike by the put-call parity, and price of the option out of the money
+    call = price + np.where(is_call, 0.0, spot - discounted)
+    out_of_money = np.where(discounted >= spot, call, call - spot + discounted)
+    valid &= out_of_money >= min_price
+
+    index = np.flatnonzero(valid)
+    s, kd, t, target = spot[index], discounted[index], years[index], out_of_money[index]
+    # sign is 1 where the call is out of the money, -1 where the put is
+    sign = np.where(kd >= s, 1.0, -1.0)
+    sqrt_t = np.sqrt(t)
+    moneyness = np.log(s / kd)
+
+    sigma = np.full(len(index), np.nan)
+    if initial is not None:
+        sigma = np.broadcast_to(np.asarray(initial, float), price.shape)[index]
+    cold = ~np.isfinite(sigma)
+    if cold.any():
+        half = call[index][cold] - 0.5 * (s[cold] - kd[cold])
+        sigma[cold] = math.sqrt(2 * math.pi) / sqrt_t[cold] / (s[cold] + kd[cold]) * (half + np.sqrt(np.maximum(
+            half * half - (s[cold] - kd[cold]) ** 2 / math.pi, 0)))
+    sigma = np.where(np.isfinite(sigma), np.clip(sigma, min_volatility, max_volatility), 0.2)
+    low = np.full(len(index), min_volatility)
+    high = np.full(len(index), max_volatility)
+
+    for _ in range(max_iterations):
+        if len(index) == 0:
+            break
+        deviation = sigma * sqrt_t
+        d1 = moneyness / deviation + 0.5 * deviation
+        difference = sign * (s * normal_cdf(sign * d1) - kd * normal_cdf(sign * (d1 - deviation))) - target
+        vega = s * normal_pdf(d1) * sqrt_t
+
+        # the price grows with the volatility, so the sign of the difference narrows the bracket
+        above = difference > 0
+        high = np.where(above, sigma, high)
+        low = np.where(above, low, sigma)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = sigma - difference / vega
+        newton = np.isfinite(step) & (step > low) & (step < high)
+
+        # the options solved are set aside with their last Newton step (or their volatility if the step is not inside
+        # the bracket, e.g. when the difference is 0), the others go on with the next iteration
+        done = np.abs(difference) < tolerance * np.maximum(target, 1.0)
+        if done.any():
+            volatility[index[done]] = np.where(newton, step, sigma)[done]
+        sigma = np.where(newton, step, 0.5 * (low + high))
+        if done.any():
+            keep = ~done
+            index, s, kd, target, sign, sqrt_t, moneyness, sigma, low, high = (
+                values[keep] for values in (index, s, kd, target, sign, sqrt_t, moneyness, sigma, low, high))
+
+    # the options not solved within max_iterations keep their last volatility
+    volatility[index] = sigma
+    return volatility
+
+
+def years_to_expiry(expiry, now=None):
+    """years from now to the close of the market on the expiry day"""
+
+    now = now or clock.now(IST)
+    close = IST.localize(datetime.combine(expiry, time(15, 30, 0)))
+    return max((close - now).total_seconds(), 60) / year_seconds
+
+
+class ChainGreeks:
+    """This class holds the implied volatility and greeks of the options of one expiry of an option chain.
+    The arrays hold the calls of all the strikes followed by the puts, aligned with the strikes of the ExpiryChain."""
+
+    def __init__(self, expiry_chain):
+        self.chain = expiry_chain
+        n = len(expiry_chain.strikes)
+        self.strikes = np.tile(np.array(expiry_chain.strikes, float), 2)
+        self.is_call = np.repeat([True, False], n)
+        self.option_types = ['CE', 'PE']
+        self.symbols = expiry_chain.symbols['CE'] + expiry_chain.symbols['PE']
+        self.tokens = np.array([token or 0 for token in expiry_chain.tokens['CE'] + expiry_chain.tokens['PE']],
+                               np.int64)
+
+        # rows of the tick table of the tokens, looked up once (-1 if not in the table)
+        self.table_name = None
+        self.slots = np.full(2 * n, -1, np.int64)
+
+        self.price = np.full(2 * n, np.nan)
+        self.volatility = np.full(2 * n, np.nan)
+        self.values = {name: np.full(2 * n, np.nan) for name in ('delta', 'gamma', 'vega', 'theta')}
+        self.spot = None
+        self.years = None
+        self.updated = 0.0
+
+    def window(self, spot):
+        # the options near the spot which have a contract
+        return (np.abs(self.strikes - spot) <= strike_range) & (self.tokens > 0)
+
+    def quotes(self, kite, rows):
+        """returns the last prices of the options of the rows, from the tick table, or from kite.ltp for the options
+        which are not in the table"""
+
+        prices = np.full(len(rows), np.nan)
+        table = marketdata.tick_table
+        if table is not None and table.alive():
+            if self.table_name != table.name:
+                self.table_name = table.name
+                self.slots[:] = -1
+            for row in rows[self.slots[rows] < 0].tolist():
+                slot = table.slot(int(self.tokens[row]))
+                self.slots[row] = slot if slot is not None else -1
+            slots = self.slots[rows]
+            found = slots >= 0
+            ticked = table.rows['seq'][slots[found]] > 0
+            values = table.rows['last_price'][slots[found]]
+            prices[np.flatnonzero(found)[ticked]] = values[ticked]
+
+        missing = np.flatnonzero(~(prices > 0))
+        if len(missing):
+            instruments = ['NFO:' + self.symbols[row] for row in rows[missing].tolist()]
+            try:
+                last_prices = kite.ltp(instruments)
+            except Exception as e:
+                logger.info('prices of {} options not fetched: {}'.format(len(instruments), e))
+                last_prices = {}
+            for position, instrument in zip(missing.tolist(), instruments):
+                if instrument in last_prices:
+                    prices[position] = last_prices[instrument]['last_price']
+        return prices
+
+    def refresh(self, kite, spot, now=None):
+        """updates the volatility and greeks of the options near the spot. Only the options whose price has changed
+        are computed, unless the spot has moved or the time to expiry is older than time_refresh seconds."""
+
+        now = now or clock.now(IST)
+        rows = np.flatnonzero(self.window(spot))
+        prices = self.quotes(kite, rows)
+
+        stale = now.timestamp() - self.updated > time_refresh
+        if spot != self.spot or stale:
+            changed = np.ones(len(rows), bool)
+        else:
+            changed = ~(prices == self.price[rows])
+        rows, prices = rows[changed], prices[changed]
+        if stale:
+            self.updated = now.timestamp()
+            self.years = years_to_expiry(self.chain.expiry, now)
+        self.spot = spot
+        if len(rows) == 0:
+            return 0
+
+        volatility = implied_volatility(prices, spot, self.strikes[rows], self.years, self.is_call[rows], rate,
+                                        initial=self.volatility[rows])
+        values = greeks(spot, self.strikes[rows], self.years, self.is_call[rows], volatility, rate)
+        self.price[rows] = prices
+        self.volatility[rows] = volatility
+        for name in self.values:
+            self.values[name][rows] = values[name]
+        return len(rows)
+
+    def select(self, spot, option_type, target_delta=None, target_premium=None, step=None):
+        """returns the contract of the type with the delta (in absolute value) or the price nearest to the target, among
+        the options near the spot with a volatility, or None"""
+
+        rows = np.flatnonzero(self.window(spot) & (self.is_call == (option_type == 'CE')) &
+                              np.isfinite(self.volatility))
+        if step:
+            rows = rows[np.isclose(np.mod(self.strikes[rows], step), 0)]
+        if len(rows) == 0:
+            return None
+
+        if target_delta is not None:
+            distance = np.abs(np.abs(self.values['delta'][rows]) - abs(target_delta))
+        else:
+            distance = np.abs(self.price[rows] - target_premium)
+        row = int(rows[np.argmin(distance)])
+
+        contract = self.chain.record(row % len(self.chain.strikes), option_type)
+        contract.update(last_price=float(self.price[row]), volatility=float(self.volatility[row]),
+                        **{name: float(values[row]) for name, values in self.values.items()})
+        return contract
+
+
+def get_chain_greeks(chain, expiry):
+    """returns the greeks of the expiry of the option chain of the process. They are made again when the chain is
+    rebuilt."""
+
+    key = (chain.underlying, expiry)
+    greeks_of_expiry = chain_greeks.get(key)
+    if greeks_of_expiry is None or greeks_of_expiry.chain is not chain.chains[expiry]:
+        greeks_of_expiry = ChainGreeks(chain.chains[expiry])
+        chain_greeks[key] = greeks_of_expiry
+    return greeks_of_expiry
+
+
+def select(kite, chain, spot, option_type, expiry_rule='monthly', days_before_expiry=0, target_delta=None,
+           target_premium=None, step=None):
+    """returns the contract of the expiry of the rule with the delta or premium nearest to the target, or None"""
+
+    expiry = chain.expiry(expiry_rule, days_before_expiry)
+    if expiry is None:
+        return None
+    greeks_of_expiry = get_chain_greeks(chain, expiry)
+    greeks_of_expiry.refresh(kite, spot)
+    return greeks_of_expiry.select(spot, option_type, target_delta, target_premium, step)
+
+
+def scalar_greeks(spot, strike, years, is_call, volatility, rate=rate):
+    """price, delta, gamma, vega and theta of one option in plain python, with the exact normal distribution"""
+
+    years = max(years, 1e-6)
+    deviation = volatility * math.sqrt(years)
+    d1 = (math.log(spot / strike) + (rate + 0.5 * volatility ** 2) * years) / deviation
+    d2 = d1 - deviation
+    cdf_d1 = 0.5 * (1 + math.erf(d1 / math.sqrt(2)))
+    cdf_d2 = 0.5 * (1 + math.erf(d2 / math.sqrt(2)))
+    pdf = math.exp(-0.5 * d1 * d1) / math.sqrt(2 * math.pi)
+    discount = math.exp(-rate * years)
+    decay = -spot * pdf * volatility / (2 * math.sqrt(years))
+    if is_call:
+        price = spot * cdf_d1 - strike * discount * cdf_d2
+        delta = cdf_d1
+        theta = decay - rate * strike * discount * cdf_d2
+    else:
+        price = strike * discount * (1 - cdf_d2) - spot * (1 - cdf_d1)
+        delta = cdf_d1 - 1
+        theta = decay + rate * strike * discount * (1 - cdf_d2)
+    return {'price': price, 'delta': delta, 'gamma': pdf / (spot * deviation), 'vega': spot * pdf * math.sqrt(years),
+            'theta': theta / 365}
+
+
+def scalar_implied_volatility(price, spot, strike, years, is_call, rate=rate):
+    """implied volatility of one option in plain python by bisection, None outside the bounds of the model"""
+
+    low, high = min_volatility, max_volatility
+    if not scalar_greeks(spot, strike, years, is_call, low, rate)['price'] < price < \
+            scalar_greeks(spot, strike, years, is_call, high, rate)['price']:
+        return None
+    while high - low > 1e-7:
+        middle = 0.5 * (low + high)
+        if scalar_greeks(spot, strike, years, is_call, middle, rate)['price'] > price:
+            high = middle
+        else:
+            low = middle
+    return 0.5 * (low + high)
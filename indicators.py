@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains streaming indicators for the strategies which use the streaming api (see strategies.py).
+Each indicator keeps its state and is updated with one new candle at a time in O(1), instead of being recomputed over
+all the candles on every run. The values are the same as the indicators of talib of the same name:
+EMA and SMA are seeded with the simple average of the first period values, RSI and ATR use the smoothing of Wilder.
+The indicators can be pickled, so the state of a strategy is saved between runs.
+series() runs an indicator over whole columns, so that signal(df) of a strategy can use the same indicators as its
+streaming version.
+
+usage: python indicators.py   (compares the indicators with talib on random candles)
+"""
+
+from collections import deque
+import numpy as np
+
+nan = float('nan')
+
+
+class RollingWindow:
+    """Window of the last size values with their sum, mean, max and min.
+    max and min are kept in monotonic queues, so every update is O(1) on average."""
+
+    def __init__(self, size):
+        self.size = size
+        self.values = deque()
+        self.total = 0.0
+        self.count = 0
+        # (position, value) of the candidates for the max and the min of the window
+        self.maxima = deque()
+        self.minima = deque()
+
+    def update(self, value):
+        self.values.append(value)
+        self.total += value
+        self.count += 1
+        if len(self.values) > self.size:
+            self.total -= self.values.popleft()
+
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((self.count, value))
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((self.count, value))
+
+        first = self.count - self.size
+        if self.maxima[0][0] <= first:
+            self.maxima.popleft()
+        if self.minima[0][0] <= first:
+            self.minima.popleft()
+        return self.mean
+
+    @property
+    def full(self):
+        return len(self.values) == self.size
+
+    @property
+    def sum(self):
+        return self.total if self.full else nan
+
+    @property
+    def mean(self):
+        return self.total / self.size if self.full else nan
+
+    @property
+    def max(self):
+        return self.maxima[0][1] if self.full else nan
+
+    @property
+    def min(self):
+        return self.minima[0][1] if self.full else nan
+
+
+class SMA:
+    """simple moving average, same as talib.SMA"""
+
+    def __init__(self, period):
+        self.window = RollingWindow(period)
+
+    def update(self, value):
+        return self.window.update(value)
+
+
+class EMA:
+    """exponential moving average, same as talib.EMA"""
+
+    def __init__(self, period):
+        self.period = period
+        self.alpha = 2.0 / (period + 1)
+        self.count = 0
+        self.total = 0.0
+        self.value = nan
+
+    def update(self, value):
+        self.count += 1
+        if self.count <= self.period:
+            self.total += value
+            if self.count == self.period:
+                self.value = self.total / self.period
+            return self.value
+
+        self.value += self.alpha * (value - self.value)
+        return self.value
+
+
+class Wilder:
+    """smoothing of Wilder used by RSI and ATR: the average of the first period values, then
+    average = (average * (period - 1) + value) / period"""
+
+    def __init__(self, period):
+        self.period = period
+        self.count = 0
+        self.total = 0.0
+        self.value = nan
+
+    def update(self, value):
+        self.count += 1
+        if self.count <= self.period:
+            self.total += value
+            if self.count == self.period:
+                self.value = self.total / self.period
+            return self.value
+
+        self.value = (self.value * (self.period - 1) + value) / self.period
+        return self.value
+
+
+class RSI:
+    """relative strength index of the close, same as talib.RSI"""
+
+    def __init__(self, period=14):
+        self.gains = Wilder(period)
+        self.losses = Wilder(period)
+        self.previous = None
+        self.value = nan
+
+    def update(self, close):
+        if self.previous is None:
+            self.previous = close
+            return nan
+
+        change = close - self.previous
+        self.previous = close
+        gain = self.gains.update(max(change, 0.0))
+        loss = self.losses.update(max(-change, 0.0))
+        if gain != gain:
+            return nan
+
+        self.value = 100.0 * gain / (gain + loss) if gain + loss > 0 else 0.0
+        return self.value
+
+
+class ATR:
+    """average true range, same as talib.ATR"""
+
+    def __init__(self, period=14):
+        self.ranges = Wilder(period)
+        self.previous_close = None
+        self.value = nan
+
+    def update(self, high, low, close):
+        if self.previous_close is None:
+            self.previous_close = close
+            return nan
+
+        true_range = max(high - low, abs(high - self.previous_close), abs(low - self.previous_close))
+        self.previous_close = close
+        self.value = self.ranges.update(true_range)
+        return self.value
+
+
+def series(indicator, *columns):
+    """returns the values of the indicator for each row of the columns, e.g. series(indicators.EMA(20), df['close'])
+    or series(indicators.ATR(14), df['high'], df['low'], df['close'])"""
+
+    columns = [np.asarray(column, dtype=float) for column in columns]
+    return np.array([indicator.update(*values) for values in zip(*columns)])
+
+
+def compare(ncandles=3000, seed=1, tolerance=1e-8):
+    """compares the indicators with talib on ncandles random candles. Returns the largest difference of each indicator
+    and raises AssertionError if a difference is beyond the tolerance, or if the values are nan on different candles."""
+
+    import talib
+
+    random = np.random.default_rng(seed)
+    close = 22000 * np.exp(np.cumsum(random.normal(0, 0.002, ncandles)))
+    high = close * (1 + random.uniform(0, 0.003, ncandles))
+    low = close * (1 - random.uniform(0, 0.003, ncandles))
+
+    checks = {'SMA 20': (series(SMA(20), close), talib.SMA(close, 20)),
+              'EMA 20': (series(EMA(20), close), talib.EMA(close, 20)),
+              'RSI 14': (series(RSI(14), close), talib.RSI(close, 14)),
+              'ATR 14': (series(ATR(14), high, low, close), talib.ATR(high, low, close, 14))}
+
+    differences = {}
+    for name, (streamed, expected) in checks.items():
+        assert np.array_equal(np.isnan(streamed), np.isnan(expected)), '{} is nan on other candles'.format(name)
+        valid = ~np.isnan(expected)
+        differences[name] = float(np.max(np.abs(streamed[valid] - expected[valid])))
+        assert differences[name] <= tolerance, '{} differs from talib by {}'.format(name, differences[name])
+    return differences
+
+
+if __name__ == '__main__':
+    for name, difference in compare().items():
+        print('{}: largest difference from talib {:.2e}'.format(name, difference))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the instrument master used by zerodhafunctions.py to resolve the instruments to trade.
+The instruments.csv file is parsed once and stored in a compact binary file (instruments.npz) of numpy arrays.
+The binary file is loaded once per day by each process and indexed by:
+1. tradingsymbol (with exchange)
+2. instrument token
+3. (underlying, expiry, strike, option type) for options and futures
+
+The binary file is rebuilt by refresh() whenever instruments.csv changes.
+"""
+
+import logsetup
+import clock
+
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import time
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# source and binary files of the instrument master
+csv_file = os.path.join(dir_path, 'instruments.csv')
+binary_file = os.path.join(dir_path, 'instruments.npz')
+
+# columns kept in the binary file and their data types. expiry is stored as yyyymmdd, 0 if there is no expiry.
+columns = {'instrument_token': np.int64,
+           'exchange_token': np.int64,
+           'tradingsymbol': 'S40',
+           'name': 'S40',
+           'expiry': np.int32,
+           'strike': np.float64,
+           'tick_size': np.float64,
+           'lot_size': np.int32,
+           'instrument_type': 'S8',
+           'segment': 'S16',
+           'exchange': 'S8'}
+
+# seconds between two checks of the source file for changes
+check_interval = 60
+
+
+def parse_expiry(expiry):
+    # instruments.csv from kite has expiry as yyyy-mm-dd. files saved by spreadsheets may have dd-mm-yyyy.
+    if not isinstance(expiry, str) or expiry == '':
+        return 0
+    for date_format in ('%Y-%m-%d', '%d-%m-%Y'):
+        try:
+            return int(datetime.strptime(expiry, date_format).strftime('%Y%m%d'))
+        except ValueError:
+            pass
+    return 0
+
+
+def build(source=csv_file, target=binary_file):
+    """parses instruments.csv and writes the binary file. Returns the arrays written."""
+
+    start = time.time()
+    instruments = pd.read_csv(source, dtype={'expiry': str})
+
+    arrays = {}
+    for column, dtype in columns.items():
+        if column == 'expiry':
+            arrays[column] = np.array([parse_expiry(x) for x in instruments['expiry']], dtype=dtype)
+        elif column in instruments:
+            values = instruments[column]
+            if dtype in (np.int64, np.int32, np.float64):
+                values = pd.to_numeric(values, errors='coerce').fillna(0)
+            else:
+                values = values.fillna('').astype(str).str.encode('utf-8')
+            arrays[column] = np.array(values, dtype=dtype)
+        else:
+            arrays[column] = np.zeros(len(instruments), dtype=dtype)
+
+    stat = os.stat(source)
+    arrays['source'] = np.array([stat.st_mtime, stat.st_size], dtype=np.float64)
+    np.savez(target, **arrays)
+
+    logger.info('instrument master of {} instruments built in {:.2f} seconds.'.format(len(instruments),
+                                                                                   time.time() - start))
+    return arrays
+
+
+def download(kite, target=csv_file):
+    """downloads the instruments from kite and writes instruments.csv"""
+
+    instruments = pd.DataFrame(kite.instruments())
+    instruments.to_csv(target, index=False)
+    logger.info('instruments.csv downloaded with {} instruments.'.format(len(instruments)))
+
+
+class InstrumentMaster:
+    """This class holds the arrays of the instrument master and its indexes.
+    The lookups return a dict of the instrument in the same format as a row of instruments.csv,
+    except that expiry is a date."""
+
+    def __init__(self, arrays):
+        self.arrays = {column: arrays[column] for column in columns}
+        self.source = tuple(arrays['source'])
+        self.loaded_on = clock.now().date()
+
+        symbols = self.arrays['tradingsymbol'].tolist()
+        exchanges = self.arrays['exchange'].tolist()
+        self.symbol_index = {}
+        for row, (exchange, symbol) in enumerate(zip(exchanges, symbols)):
+            self.symbol_index[(exchange.decode(), symbol.decode())] = row
+            # kite tradingsymbols are unique within an exchange. the first exchange wins when only the symbol is given.
+            self.symbol_index.setdefault(symbol.decode(), row)
+
+        self.token_index = dict(zip(self.arrays['instrument_token'].tolist(), range(len(symbols))))
+
+        self.contract_index = {}
+        derivatives = np.flatnonzero(self.arrays['expiry'])
+        for row in derivatives.tolist():
+            key = (self.arrays['name'][row].decode(), int(self.arrays['expiry'][row]),
+                   float(self.arrays['strike'][row]), self.arrays['instrument_type'][row].decode())
+            self.contract_index[key] = row
+
+    def record(self, row):
+        if row is None:
+            return None
+        record = {}
+        for column in columns:
+            value = self.arrays[column][row]
+            if isinstance(value, bytes):
+                value = value.decode()
+            elif isinstance(value, np.generic):
+                value = value.item()
+            record[column] = value
+        record['expiry'] = datetime.strptime(str(record['expiry']), '%Y%m%d').date() if record['expiry'] else None
+        return record
+
+    def by_symbol(self, tradingsymbol, exchange=None):
+        """lookup by tradingsymbol. exchange can be given separately or as 'NFO:SYMBOL'."""
+
+        if exchange is None and ':' in tradingsymbol:
+            exchange, tradingsymbol = tradingsymbol.split(':', 1)
+        key = tradingsymbol if exchange is None else (exchange, tradingsymbol)
+        return self.record(self.symbol_index.get(key))
+
+    def by_token(self, instrument_token):
+        return self.record(self.token_index.get(int(instrument_token)))
+
+    def contract(self, underlying, expiry, strike, instrument_type):
+        """lookup of an option or future. expiry is a date, instrument_type is CE, PE or FUT."""
+
+        key = (underlying, int(expiry.strftime('%Y%m%d')), float(strike), instrument_type)
+        return self.record(self.contract_index.get(key))
+
+    def expiries(self, underlying, instrument_type=None):
+        """sorted list of the expiry dates of the contracts of the underlying"""
+
+        expiries = set()
+        for name, expiry, strike, option_type in self.contract_index:
+            if name == underlying and (instrument_type is None or option_type == instrument_type):
+                expiries.add(expiry)
+        return [datetime.strptime(str(expiry), '%Y%m%d').date() for expiry in sorted(expiries)]
+
+
+# instrument master of the process. loaded by get_master.
+master = None
+last_check = 0
+
+
+def refresh(kite=None):
+    """daily refresh job. downloads instruments.csv if kite is given and rebuilds the binary file when the csv has
+    changed. Returns the loaded instrument master."""
+
+    global master, last_check
+
+    if kite is not None:
+        download(kite)
+
+    stat = os.stat(csv_file)
+    arrays = None
+    if os.path.isfile(binary_file):
+        arrays = dict(np.load(binary_file))
+        if tuple(arrays['source']) != (stat.st_mtime, stat.st_size):
+            arrays = None
+
+    if arrays is None:
+        arrays = build()
+
+    master = InstrumentMaster(arrays)
+    last_check = time.time()
+    return master
+
+
+def get_master():
+    """returns the instrument master of the process. It is loaded on first use, and reloaded on a new day or when
+    instruments.csv has changed."""
+
+    global last_check
+
+    if master is None or master.loaded_on != clock.now().date():
+        return refresh()
+
+    if time.time() - last_check > check_interval:
+        last_check = time.time()
+        stat = os.stat(csv_file)
+        if master.source != (stat.st_mtime, stat.st_size):
+            return refresh()
+
+    return master
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the logging setup of the system.
+All the processes (main process, workers of the pool and the broker gateway) put their log records in one queue, and
+one listener process writes them in the log file of the day, logs_<yyyy-mm-dd>.log. Putting a record in the queue does
+not wait for the disk, so logging does not delay the processing of signals and orders, and the lines of the
+processes are not mixed.
+The purpose of this module is:
+1. get_logger(): the logger of the modules. Before start() is called (e.g. when a module is run on its own), the
+   process writes the log file itself.
+2. start(): starts the listener process and sends the records of the process to it. attach() does the same in a child
+   process which did not inherit the queue. stop() writes the remaining records and stops the listener.
+3. The log file is rotated when the day changes and when it is larger than max_bytes (logs_<date>.log.1, .2, ...).
+4. The arguments of the log messages are formatted by the listener. The modules of the trading loop pass their
+   arguments to the logger ('%s') instead of formatting the message. Pandas objects are copied (a dataframe is
+   reduced to its last row) and pickled by the feeder thread of the queue, so a log of a signal neither formats nor
+   converts the series in the process of the algo.
+5. json_lines = True writes each record as a json line with its time, level, process, module and message.
+"""
+
+from logging.handlers import QueueHandler, RotatingFileHandler
+from datetime import datetime, date
+import multiprocessing
+import logging
+import signal
+import copy
+import json
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# level and format of the log
+level = logging.DEBUG
+log_format = '%(asctime)s %(levelname)s %(message)s'
+
+# True to write the records as json lines
+json_lines = False
+
+# size of the log file at which it is rotated, and the number of rotated files kept per day
+max_bytes = 50 * 1024 * 1024
+backup_count = 10
+
+# queue of the records and the listener process, set by start()
+queue = None
+listener = None
+
+# types which are sent to the listener as they are
+plain_types = (str, int, float, bool, type(None), datetime, date, dict, list, tuple)
+
+
+class DailyRotatingFileHandler(RotatingFileHandler):
+    """Writes the records in logs_<date>.log of the current day. The file is rotated by size within the day and a new
+    file is started when the day changes."""
+
+    def __init__(self, folder=dir_path, max_bytes=max_bytes, backup_count=backup_count):
+        self.folder = folder
+        self.day = datetime.now().date()
+        super().__init__(self.day_file(), maxBytes=max_bytes, backupCount=backup_count, delay=True)
+
+    def day_file(self):
+        return os.path.join(self.folder, 'logs_' + self.day.strftime('%Y-%m-%d') + '.log')
+
+    def shouldRollover(self, record):
+        if datetime.now().date() != self.day:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if datetime.now().date() == self.day:
+            super().doRollover()
+            return
+
+        # new day, new file
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.day = datetime.now().date()
+        self.baseFilename = os.path.abspath(self.day_file())
+
+
+class JsonFormatter(logging.Formatter):
+    """formats a record as one json line"""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'process': record.process,
+                 'module': record.module,
+                 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def compact(value):
+    # value of a log argument which can be sent to the listener. pandas objects are copied, as the queue pickles them
+    # later in its feeder thread; a dataframe is reduced to its last row.
+    if isinstance(value, plain_types):
+        return value
+    if hasattr(value, 'to_dict') and hasattr(value, 'ndim'):
+        if value.ndim == 1:
+            return value.copy()
+        return value.iloc[-1:].copy()
+    return str(value)
+
+
+class LazyQueueHandler(QueueHandler):
+    """Puts the records in the queue of the listener. Unlike QueueHandler, the message is not formatted here: the
+    arguments are sent as they are and formatted by the listener."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = compact(record.msg)
+        if isinstance(record.args, tuple):
+            record.args = tuple(compact(arg) for arg in record.args)
+        elif isinstance(record.args, dict):
+            record.args = {key: compact(arg) for key, arg in record.args.items()}
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def file_handler(folder=dir_path):
+    handler = DailyRotatingFileHandler(folder)
+    handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(log_format))
+    return handler
+
+
+def set_handler(handler):
+    # the root logger of the process writes through the given handler only
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def get_logger():
+    """returns the logger of the modules. The process writes the log file itself till start() or attach() is called."""
+
+    root = logging.getLogger()
+    if not root.handlers:
+        set_handler(file_handler())
+    return root
+
+
+def listen(records, folder, json_output):
+    # runs in the listener process. writes the records till None is received.
+    global json_lines
+
+    # ctrl-c stops the main process, which then stops the listener after the last records
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    json_lines = json_output
+    handler = file_handler(folder)
+    while True:
+        record = records.get()
+        if record is None:
+            break
+        try:
+            handler.handle(record)
+        except Exception:
+            handler.handleError(record)
+    handler.close()
+
+
+def start():
+    """starts the listener process and sends the records of this process to it. Returns the queue, which is inherited
+    by the processes started later (or given to attach() in them)."""
+
+    global queue, listener
+
+    if listener is not None and listener.is_alive():
+        return queue
+
+    queue = multiprocessing.Queue()
+    listener = multiprocessing.Process(target=listen, args=(queue, dir_path, json_lines), daemon=True,
+                                       name='log listener')
+    listener.start()
+    set_handler(LazyQueueHandler(queue))
+    return queue
+
+
+def attach(records):
+    """sends the records of a child process to the listener. Does nothing if records is None."""
+
+    global queue
+
+    if records is None:
+        return
+    queue = records
+    set_handler(LazyQueueHandler(records))
+
+
+def stop():
+    """writes the records in the queue, stops the listener and lets the process write the log file itself again"""
+
+    global queue, listener
+
+    if listener is None:
+        return
+    set_handler(file_handler())
+    queue.put(None)
+    listener.join(10)
+    if listener.is_alive():
+        listener.terminate()
+    queue = None
+    listener = None
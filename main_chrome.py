@@ -7,38 +7,46 @@ Created on Fri Jul  9 04:04:04 2021
 This is the main module which kicks off the trade execution algorithm.
 This module performs following tasks:
 1. Startup - Logs in zerodha kite account.
-2. Reads the list of algos (strategies) to run.
-3. calls the strategies to at appropriate time for signal processing and execution of trades.
+2. Reads the list of algos (strategies) to run and warms up the caches of the day in parallel before markets open.
+3. calls the strategies at every candle close (as per the scheduler) for signal processing and execution of trades.
 4. Monitors the open trades and modifies them if required.
 5. Invalidates the zerodha kite session at the end of trading day.
 """
 
 # import modules
+import logsetup
 import zerodhalogin_chrome
-import multiprocess_functions
 import ordermanagement
+import orderstore
+import marketdata
+import candlebuilder
+import instrumentmaster
+import multiprocess_functions
+import zerodhafunctions
+import workerpool
+import ordergateway
+import ratelimiter
+import brokergateway
+import scheduler
+import clock
+import tracing
+import warmup
 
 # import packages
 from datetime import datetime, time
 from time import sleep
-import concurrent.futures
-import _pickle as pickle
 import os
 import pytz
-import logging
 
 
-# set working directory and logging file
+# set working directory
 # use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
 # dir_path = os.path.dirname(os.path.realpath(__file__))
 dir_path = os.getcwd()
 os.chdir(dir_path)
 
-# configure logger
-logfilename = 'logs_' + datetime.strftime(datetime.now(), '%Y-%m-%d') + '.log'
-logfile = os.path.join(dir_path, logfilename)
-logging.basicConfig(filename=logfile, format="%(asctime)s %(levelname)s %(message)s", level=logging.DEBUG)
-logger = logging.getLogger()
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
 
 # set time zone for indian markets
 IST = pytz.timezone('Asia/Kolkata')
@@ -54,7 +62,7 @@ class Startup:
     """
 
     def __init__(self, kite):
-        self.current_time = datetime.time(datetime.now(IST))
+        self.current_time = datetime.time(clock.now(IST))
         self.time_detail_messege = time(10, 0, 0)
         self.kite = kite
 
@@ -73,13 +81,10 @@ class Startup:
             logger.info('last price: {}'.format(position['last_price']))
             logger.info('profit/loss: {}'.format(position['pnl']))
             logger.info('\n')
-            sleep(1)
 
         logger.info('\n')
-        logger.info('Open positions in order_info.txt')
-        with open('order_info.txt', 'rb') as file:
-            order_info = pickle.load(file)
-            file.close()
+        logger.info('Open positions in order store')
+        order_info = orderstore.order_store.all()
 
         for algo, order_info_algo in order_info.items():
             for signal_type in ['LE', 'LX', 'SE', 'SX']:
@@ -94,31 +99,25 @@ class Startup:
                         'execution time of order: {}'.format(order_info_algo[signal_type]['exchange_update_timestamp']))
                     logger.info('\n')
 
-                if self.current_time < self.time_detail_messege:
-                    sleep(1)
-
         return None
 
 
 def start_new_day():
     """
     This function is supposed to run when program starts or just before trading begins.
-    This function initiates kite session and displays startup message.
-    kite object is returned which is used in main code.
+    This function initiates kite session.
+    kite object is returned which is used in main code. The caches of the day are loaded by the warm-up.
     """
 
     # initiate kite
     # kite is initiated during start of session
     ztoken = zerodhalogin_chrome.ZerodhaAccessToken()
-    kite = ztoken.kite
+    # the API calls of the main process and the workers share the rate limits of kite
+    kite = ratelimiter.wrap(ztoken.kite)
     z_access_token = ztoken.get_access_token()
     print('access token from login: {}'.format(z_access_token))
     kite.set_access_token(access_token=z_access_token)
 
-    # display current positions
-    start_day = Startup(kite)
-    start_day.open_positions()
-
     return kite
 
 
@@ -133,17 +132,79 @@ def read_algo_list():
         algo_list = [eval(x) for x in algo_list]
         file.close()
 
-    for item in algo_list:
-        item.update({'kite_obj': kite})
-
     logger.info('The properties of live algos are: \n')
     for details in algo_list:
         logger.info('{} \n'.format(details))
-        sleep(2)
 
     return algo_list
 
 
+def start_market_data(kite, algo_config, feed=None, gateway=None):
+    """
+    This function starts the websocket feed which keeps the last price of the securities and options in shared memory,
+    and the candle builder which closes the candles of the algos from the ticks.
+    The order updates of the feed are passed to the order gateway.
+    The feed of the previous session, if any, is stopped.
+    The trading continues on kite.ltp and historical data if the feed fails to start.
+    """
+    if feed is not None:
+        feed.stop()
+
+    try:
+        feed = marketdata.start_feed(kite, algo_config)
+        builder = candlebuilder.CandleBuilder(candlebuilder.subscriptions(algo_config, instrumentmaster.get_master()),
+                                              zerodhafunctions.candle_store)
+        feed.add_listener(builder.add_ticks)
+        if gateway is not None:
+            feed.add_order_listener(gateway.on_order_update)
+    except Exception as e:
+        logger.info('market data feed not started: {}'.format(e))
+        feed = None
+        builder = None
+
+    return feed, builder
+
+
+def run_algos(kite, pool, algo_config):
+    """
+    This function runs a cycle of the given algos:
+    fetches the historical data once per security and interval and processes the algos in the worker pool.
+    """
+    logger.info('Processing strategies {}...'.format([algo['algo'] for algo in algo_config]))
+
+    # fetch the historical data once per security and interval for all strategies.
+    cycle_config = multiprocess_functions.fetch_cycle_data(kite, algo_config)
+
+    # Multiprocessing all strategies in the worker pool started before trading.
+    pool.run_cycle(cycle_config)
+
+    # calls and waits of the rate limiter so far
+    ratelimiter.log_stats()
+
+
+def start_worker_pool(kite, gateway, algo_config, pool=None, broker=None):
+    """
+    This function starts the broker gateway process which holds the kite session of the workers, and the worker pool
+    which is reused for all the runs of the day.
+    The workers import the strategies of the algos in algo_config when they start.
+    The orders of the algos are placed through the given order gateway.
+    The pool and broker gateway of the previous session, if any, are stopped as they hold the old kite session.
+    Returns the pool and the broker gateway.
+    """
+    if pool is not None:
+        pool.shutdown()
+    if broker is not None:
+        broker.stop()
+
+    broker = brokergateway.BrokerGateway(kite)
+    broker.start()
+
+    pool = workerpool.WorkerPool(broker.client(), gateway, algos=sorted(set(algo['algo'] for algo in algo_config)))
+    pool.start()
+
+    return pool, broker
+
+
 def invalidate_session(kite):
     """
     This function is meant to invalidate active kite session.
@@ -166,90 +227,149 @@ def invalidate_session(kite):
     logger.info('Al-vida!')
 
 
+class TradingDay:
+    """
+    This class holds the state of the trading day and contains the jobs run by the scheduler:
+    start of the day, processing of the algos at candle close, monitoring of orders and end of the day.
+    """
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.kite = None
+        self.algo_config = []
+        self.pool = None
+        self.broker = None
+        self.gateway = None
+        self.feed = None
+        self.builder = None
+        self.readiness = None
+
+    def start(self, deadline=None):
+        """
+        Logs in, reads the algo list, starts the market data feed and the workers, and schedules the jobs of the day.
+        It is run when the program starts during market hours and every day before markets open.
+        """
+        global kite
+
+        # the day is already started if the program was started in the morning.
+        if self.kite is not None and open("access_token.txt", 'r').read() != 'first login':
+            return
+
+        # Starting a new day with new login and startup message.
+        kite = start_new_day()
+        self.kite = kite
+
+        # get the list of algos and its properties to run.
+        self.algo_config = read_algo_list()
+
+        # start the order gateway, then load the caches and start the market data feed and the workers in parallel
+        self.gateway = ordergateway.get_gateway(kite)
+        self.readiness = self.warm_up()
+
+        # run the algos at every candle boundary of their interval
+        self.schedule.cancel(self.run_bar)
+        self.schedule.cancel(self.monitor)
+        for interval in sorted(set(algo['interval'] for algo in self.algo_config)):
+            self.schedule.every_bar(interval, self.run_bar, interval)
+
+        # check the open orders for modifications in price. This operation is performed every 3 minutes.
+        self.schedule.every(3, self.monitor, first=time(9, 33, 0))
+
+        logger.info('Trading commences at {}'.format(datetime.now().strftime("%H:%M:%S")))
+
+    def warm_up(self):
+        """
+        Runs the warm-up of the day: validates the session, loads the instrument master, backfills the candles of the
+        algos, reconciles the orders and positions, and starts the market data feed and the worker pool.
+        Returns the readiness report.
+        """
+        tasks = warmup.day_tasks(self.kite, self.algo_config)
+
+        def start_feed():
+            self.feed, self.builder = start_market_data(self.kite, self.algo_config, self.feed, self.gateway)
+            return 'feed {}'.format('started' if self.feed is not None else 'not started, kite.ltp is used')
+
+        def start_pool():
+            self.pool, self.broker = start_worker_pool(self.kite, self.gateway, self.algo_config, self.pool,
+                                                       self.broker)
+            return '{} workers'.format(self.pool.max_workers)
+
+        # the pool is needed by every bar, so it depends only on the session. It is forked before the threads of the
+        # other tasks start. The workers attach the tick table of the feed when it is started, and build the option
+        # chains they use themselves.
+        tasks.add('worker pool', start_pool, after=['session'], first=True)
+        tasks.add('market data feed', start_feed, after=['instrument master'])
+        tasks.add('positions', Startup(self.kite).open_positions, after=['reconcile orders'])
+        return tasks.run()
+
+    def run_bar(self, deadline, interval):
+        # multi processing of signal and order placement for the algos of the interval at candle close
+        if self.builder is not None:
+            self.builder.flush(deadline)
+        # the algos carry the candle close of the run, which keys their latency trace
+        algo_config = [dict(algo, bar=deadline) for algo in self.algo_config if algo['interval'] == interval]
+        tracing.since_bar('scheduler_wake', [algo['algo'] for algo in algo_config], deadline)
+        # the pool is started again if the warm-up could not start it
+        if self.pool is None:
+            self.pool, self.broker = start_worker_pool(self.kite, self.gateway, self.algo_config, None, self.broker)
+        run_algos(self.kite, self.pool, algo_config)
+
+    def monitor(self, deadline):
+        # check the status of the open orders of all algos in one sweep
+        logger.info('checking placed orders')
+        ordermanagement.monitor_all(self.kite, [algo['algo'] for algo in self.algo_config])
+
+    def end(self, deadline):
+        # ends the kite session and stops the program
+        if self.kite is not None and open("access_token.txt", 'r').read() != 'first login':
+            logger.info('Ending kite session..')
+            invalidate_session(self.kite)
+
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.broker is not None:
+            self.broker.stop()
+        if self.gateway is not None:
+            self.gateway.shutdown()
+        if self.feed is not None:
+            self.feed.stop()
+
+        # latency of the stages of the day
+        tracing.log_summary()
+        self.schedule.stop()
+
+
 # main body of code
 def main():
     """
     The core program which:
         initiates kite instance,
         displays the existing positions
-        processes the signals on loop
+        processes the signals at every candle close
         places and checks orders
         ends kite session when trading time ends
+
+    All the tasks run at their time as jobs of the scheduler.
     """
-    global kite
-    # call the start_new_day function which completes the login, displays startup message
-    # returns the kite object
-    if time(8, 30, 0) < datetime.time(datetime.now(IST)) < time(15, 30, 0):
-        kite = start_new_day()
+    # the main process, the workers and the broker gateway log through one listener process
+    logsetup.start()
 
-        # get the list of algos and its properties to run.
-        algo_config = read_algo_list()
-
-    # start trading
-    logger.info('Trading commences at {}'.format(datetime.now().strftime("%H:%M:%S")))
-    last_run_time = time(0, 0, 0)
-
-    run_on_loop = True
-    while run_on_loop:
-        # Assign the running of below code every 15 minutes
-        # Since the minimum interval being traded is 15 min.
-        current_time = datetime.time(datetime.now(IST))
-
-        if time(8, 55, 0) < current_time < start_time:
-            # if the code is continuously running, this segment is meant to start new day.
-            # it re-logins and gets kite object
-            # displays startup message
-            # get the list of strategies to run
-
-            if open("access_token.txt", 'r').read() == 'first login':
-                # Starting a new day with new login and startup message.
-                kite = start_new_day()
-                # fetch the list of strategies to be run.
-                algo_config = read_algo_list()
-
-        # Prints a message in logger. Used to confirm that the code is running.
-        if current_time.second < 2:
-            logger.info('The current time is {}. Waiting for appropriate time to process the signal'.format(
-                current_time.strftime('%H:%M:%S')))
-
-        if start_time < current_time < end_time:
-            repeat_run = current_time.strftime("%H:%M") == last_run_time.strftime("%H:%M")
-            # multi processing of signal and order placement for each algo every 15 minutes
-            if current_time.minute % 15 == 0 and not repeat_run:
-                logger.info('Processing all strategies...')
-                last_run_time = current_time
-
-                # Multiprocessing all strategies.
-                with concurrent.futures.ProcessPoolExecutor() as executor:
-                    executor.map(multiprocess_functions.use_signal, algo_config)
-
-            # check the open orders for modifications in price. This operation is performed every 3 minutes.
-            if (
-                    current_time.minute > last_run_time.minute and
-                    (current_time.minute - last_run_time.minute) % 3 == 0 and
-                    current_time.second < 2 and
-                    current_time > time(9, 30, 0)
-            ):
-
-                for algo in algo_config:
-                    algo = algo['algo']
-                    logger.info('checking placed orders')
-                    # check order status
-                    ordermanagement.monitor_trade(kite, algo)
-
-            # sleep for 10 seconds to save memory usage.
-            sleep(10 - datetime.now(IST).second % 10)
-
-        elif time(15, 35, 0) < current_time < time(15, 45, 0):
-            if open("access_token.txt", 'r').read() != 'first login':
-                logger.info('Ending kite session..')
-                invalidate_session(kite)
-                run_on_loop = False
-            sleep(120 - datetime.now(IST).second % 60)
-        elif current_time > time(16, 15, 0) or current_time < time(8, 25, 0):
-            sleep(1800 - datetime.now(IST).second % 60)
-        else:
-            sleep(30 - datetime.now(IST).second % 30)
+    schedule = scheduler.Scheduler()
+    trading_day = TradingDay(schedule)
+
+    # call the start of day, which completes the login, displays startup message and starts the jobs of the day
+    if time(8, 30, 0) < datetime.time(clock.now(IST)) < time(15, 30, 0):
+        trading_day.start()
+
+    # if the code is continuously running, this job starts the new day.
+    schedule.daily(time(8, 55, 0), trading_day.start)
+    # end of the trading day
+    schedule.daily(time(15, 35, 0), trading_day.end)
+
+    try:
+        schedule.run()
+    finally:
+        logsetup.stop()
 
 
 if __name__ == '__main__':
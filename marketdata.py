@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the streaming market data used in place of the kite.ltp calls.
+A websocket subscriber (KiteTicker) runs in the main process and writes every tick in a table kept in shared memory.
+The workers attach to the same table, so the last price and market depth are read without any network round trip.
+The purpose of this module is:
+1. TickTable: table of the last tick of each instrument token, shared between processes.
+2. TickerFeed: KiteTicker subscriber which keeps the table updated.
+3. ReplayFeed: stand-in for TickerFeed which feeds recorded ticks, to run the system offline.
+4. ltp(): drop-in for kite.ltp which reads the table and falls back to kite only for the instruments not in the table.
+"""
+
+import logsetup
+import instrumentmaster
+import optionchain
+
+from kiteconnect import KiteTicker
+from multiprocessing import shared_memory
+import _pickle as pickle
+import numpy as np
+import threading
+import time
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# header of the table. heartbeat is the time of the last message received by the feed.
+header_dtype = np.dtype([('heartbeat', np.float64), ('capacity', np.int64)])
+
+# one row per instrument token. seq is odd while the row is being written.
+tick_dtype = np.dtype([('seq', np.int64),
+                       ('instrument_token', np.int64),
+                       ('last_price', np.float64),
+                       ('timestamp', np.float64),
+                       ('volume', np.int64),
+                       ('oi', np.int64),
+                       ('bid', np.float64, 5),
+                       ('bid_qty', np.int64, 5),
+                       ('ask', np.float64, 5),
+                       ('ask_qty', np.int64, 5)])
+
+# the table is used only when the feed has received a message within these many seconds
+max_feed_age = 10
+
+
+class TickTable:
+    """This class keeps the last tick of each instrument token in shared memory.
+    The table has one writer (the feed of the main process) and any number of readers.
+    Rows are found by open addressing on the instrument token."""
+
+    def __init__(self, name=None, capacity=4096):
+        size = header_dtype.itemsize + capacity * tick_dtype.itemsize
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            # the table belongs to the main process. the workers share its resource tracker, so the table is
+            # removed only when the main process unlinks it.
+            self.owner = False
+
+        self.name = self.memory.name
+        self.header = np.ndarray((1,), dtype=header_dtype, buffer=self.memory.buf)
+        if self.owner:
+            self.header['heartbeat'] = 0
+            self.header['capacity'] = capacity
+        self.capacity = int(self.header['capacity'][0])
+        self.rows = np.ndarray((self.capacity,), dtype=tick_dtype, buffer=self.memory.buf,
+                               offset=header_dtype.itemsize)
+        if self.owner:
+            self.rows[:] = 0
+
+    def slot(self, token, insert=False):
+        # position of the token in the table. None if the token is not in the table.
+        position = token % self.capacity
+        for _ in range(self.capacity):
+            row_token = self.rows['instrument_token'][position]
+            if row_token == token:
+                return position
+            if row_token == 0:
+                if insert:
+                    self.rows['instrument_token'][position] = token
+                    return position
+                return None
+            position = (position + 1) % self.capacity
+        if insert:
+            raise MemoryError('tick table is full')
+        return None
+
+    def update(self, ticks):
+        """writes the ticks in kite format in the table"""
+
+        now = time.time()
+        rows = self.rows
+        for tick in ticks:
+            position = self.slot(tick['instrument_token'], insert=True)
+            rows['seq'][position] += 1
+            rows['last_price'][position] = tick.get('last_price', 0)
+            rows['timestamp'][position] = now
+            rows['volume'][position] = tick.get('volume_traded', tick.get('volume', 0)) or 0
+            rows['oi'][position] = tick.get('oi', 0) or 0
+            depth = tick.get('depth')
+            if depth:
+                for level, (buy, sell) in enumerate(zip(depth['buy'][:5], depth['sell'][:5])):
+                    rows['bid'][position][level] = buy['price']
+                    rows['bid_qty'][position][level] = buy['quantity']
+                    rows['ask'][position][level] = sell['price']
+                    rows['ask_qty'][position][level] = sell['quantity']
+            rows['seq'][position] += 1
+        self.beat(now)
+
+    def beat(self, now=None):
+        self.header['heartbeat'] = now or time.time()
+
+    def alive(self, max_age=max_feed_age):
+        return time.time() - float(self.header['heartbeat'][0]) < max_age
+
+    def get(self, token):
+        """returns the last tick of the token as a dict, or None if the token is not in the table"""
+
+        position = self.slot(int(token))
+        if position is None:
+            return None
+
+        # retry if the row was being written while it was read
+        while True:
+            seq = self.rows['seq'][position]
+            row = self.rows[position].copy()
+            if seq % 2 == 0 and seq == self.rows['seq'][position]:
+                break
+        if seq == 0:
+            return None
+
+        return {'instrument_token': int(row['instrument_token']),
+                'last_price': float(row['last_price']),
+                'timestamp': float(row['timestamp']),
+                'volume': int(row['volume']),
+                'oi': int(row['oi']),
+                'depth': {'buy': [{'price': float(p), 'quantity': int(q)} for p, q in zip(row['bid'], row['bid_qty'])],
+                          'sell': [{'price': float(p), 'quantity': int(q)} for p, q in zip(row['ask'], row['ask_qty'])]}}
+
+    def close(self):
+        self.header = None
+        self.rows = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class TickerFeed:
+    """This class subscribes to the kite websocket and writes the ticks in the tick table.
+    Ticks can also be recorded in a file to be replayed later with ReplayFeed."""
+
+    def __init__(self, kite, table, record_file=None):
+        self.table = table
+        self.tokens = set()
+        self.listeners = []
+        self.record_file = open(record_file, 'ab') if record_file else None
+        self.ticker = KiteTicker(kite.api_key, kite.access_token)
+        self.ticker.on_ticks = self.on_ticks
+        self.ticker.on_message = self.on_message
+        self.ticker.on_connect = self.on_connect
+        self.ticker.on_close = self.on_close
+        self.ticker.on_error = self.on_error
+        self.ticker.on_order_update = self.on_order_update
+        self.order_listeners = []
+
+    def on_ticks(self, ws, ticks):
+        self.table.update(ticks)
+        for listener in self.listeners:
+            listener(ticks)
+        if self.record_file is not None:
+            pickle.dump((time.time(), ticks), self.record_file)
+
+    def add_listener(self, listener):
+        # listener is called with every set of ticks, e.g. the candle builder
+        self.listeners.append(listener)
+
+    def on_order_update(self, ws, order_update):
+        for listener in self.order_listeners:
+            listener(order_update)
+
+    def add_order_listener(self, listener):
+        # listener is called with every order update of the account, e.g. the order gateway
+        self.order_listeners.append(listener)
+
+    def on_message(self, ws, payload, is_binary):
+        # every message, including the heartbeats of kite, shows that the feed is alive
+        self.table.beat()
+
+    def on_connect(self, ws, response):
+        logger.info('ticker connected. subscribing {} instruments.'.format(len(self.tokens)))
+        if self.tokens:
+            ws.subscribe(list(self.tokens))
+            ws.set_mode(ws.MODE_FULL, list(self.tokens))
+
+    def on_close(self, ws, code, reason):
+        logger.info('ticker closed: {} {}'.format(code, reason))
+
+    def on_error(self, ws, code, reason):
+        logger.info('ticker error: {} {}'.format(code, reason))
+
+    def subscribe(self, tokens):
+        new_tokens = [int(token) for token in tokens if int(token) not in self.tokens]
+        self.tokens.update(new_tokens)
+        if new_tokens and self.ticker.is_connected():
+            self.ticker.subscribe(new_tokens)
+            self.ticker.set_mode(self.ticker.MODE_FULL, new_tokens)
+
+    def start(self):
+        self.ticker.connect(threaded=True)
+
+    def stop(self):
+        self.ticker.close()
+        if self.record_file is not None:
+            self.record_file.close()
+
+
+class ReplayFeed:
+    """This class feeds the ticks recorded by TickerFeed in the tick table.
+    speed is the replay speed relative to real time. speed=0 feeds all ticks without waiting."""
+
+    def __init__(self, table, record_file, speed=1.0):
+        self.table = table
+        self.record_file = record_file
+        self.speed = speed
+        self.tokens = set()
+        self.listeners = []
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def records(self):
+        with open(self.record_file, 'rb') as file:
+            while True:
+                try:
+                    yield pickle.load(file)
+                except EOFError:
+                    return
+
+    def subscribe(self, tokens):
+        self.tokens.update(int(token) for token in tokens)
+
+    def run(self):
+        previous = None
+        for received_at, ticks in self.records():
+            if self.stopped.is_set():
+                return
+            if previous is not None and self.speed:
+                self.stopped.wait(max(0.0, (received_at - previous) / self.speed))
+            previous = received_at
+            self.table.update(ticks)
+            for listener in self.listeners:
+                listener(ticks)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def add_order_listener(self, listener):
+        # recorded ticks have no order updates
+        pass
+
+    def start(self, threaded=True):
+        if not threaded:
+            self.run()
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+# tick table of the process. created by start_feed in the main process and attached by the workers.
+tick_table = None
+
+
+def attach(name):
+    """attaches the process to the tick table created by the main process, if it is not attached to it already"""
+
+    global tick_table
+    if name is not None and (tick_table is None or tick_table.name != name):
+        tick_table = TickTable(name)
+
+
+def subscription_tokens(kite, algo_config, strike_range=1000):
+    """returns the tokens to subscribe: the securities of the algos, the options traded by each algo near the spot of
+    its security (the underlying and the expiry of its rule, see optionchain.py), and the instruments of the open
+    positions. The options are subscribed within strike_range of the spot, or further if the strike_offset of the algo
+    reaches further."""
+
+    master = instrumentmaster.get_master()
+    tokens = set()
+
+    securities = sorted(set(algo_details['security'] for algo_details in algo_config))
+    resolved = [security for security in securities if master.by_symbol(security) is not None]
+    tokens.update(master.by_symbol(security)['instrument_token'] for security in resolved)
+    spots = {security: quote['last_price'] for security, quote in kite.ltp(resolved).items()} if resolved else {}
+
+    for algo_details in algo_config:
+        spot = spots.get(algo_details['security'])
+        chain = optionchain.get_chain(optionchain.underlying_of(algo_details))
+        expiry = chain.expiry(algo_details.get('expiry_rule', 'monthly'), algo_details['days_before_expiry'])
+        if spot is None or expiry is None:
+            logger.info('options of algo {} not subscribed: no spot or no expiry'.format(algo_details['algo']))
+            continue
+
+        expiry_chain = chain.chains[expiry]
+        reach = max(strike_range, (abs(algo_details.get('strike_offset', 0)) + 2) *
+                    (algo_details.get('strike_step') or 100))
+        for option_type in ('CE', 'PE'):
+            tokens.update(token for strike, token in zip(expiry_chain.strikes, expiry_chain.tokens[option_type])
+                          if token is not None and abs(strike - spot) <= reach)
+
+    for position in kite.positions()['net']:
+        tokens.add(position['instrument_token'])
+
+    return tokens
+
+
+def start_feed(kite, algo_config, replay_file=None):
+    """creates the tick table and starts the feed in the main process. Returns the feed."""
+
+    global tick_table
+    if tick_table is None:
+        tick_table = TickTable()
+
+    if replay_file is not None:
+        feed = ReplayFeed(tick_table, replay_file)
+    else:
+        feed = TickerFeed(kite, tick_table)
+    feed.subscribe(subscription_tokens(kite, algo_config))
+    feed.start()
+    logger.info('market data feed started with {} instruments.'.format(len(feed.tokens)))
+    return feed
+
+
+def ltp(kite, instruments):
+    """returns the last price of the instruments in the same format as kite.ltp.
+    The prices are read from the tick table. kite.ltp is called only for the instruments not in the table."""
+
+    prices = {}
+    missing = []
+    if tick_table is not None and tick_table.alive():
+        master = instrumentmaster.get_master()
+        for instrument in instruments:
+            record = master.by_symbol(instrument)
+            tick = tick_table.get(record['instrument_token']) if record is not None else None
+            if tick is None:
+                missing.append(instrument)
+            else:
+                prices[instrument] = {'instrument_token': tick['instrument_token'], 'last_price': tick['last_price']}
+    else:
+        missing = list(instruments)
+
+    if missing:
+        prices.update(kite.ltp(missing))
+
+    return prices
+
+
+def quote(token):
+    """returns the last tick of the token, including market depth, or None if the token is not in the table"""
+
+    if tick_table is None:
+        return None
+    return tick_table.get(token)
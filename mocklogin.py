@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains a local mock of the kite login, to test the login of zerodhalogin_http.py without a kite account.
+MockLoginServer answers the login of kite web (connect login, api/login, api/twofa) and the kite connect session and
+profile calls. It serves both on the same url, which is given as the base of HttpLogin and the root of KiteConnect.
+It is not imported by the live login.
+
+usage: python mocklogin.py --runs 5   (login against the mock server and print the timings)
+"""
+
+import logsetup
+import zerodhalogin_http
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.parse as urlparse
+import threading
+import argparse
+import secrets
+import json
+import time
+import os
+import pyotp
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+
+class MockLoginHandler(BaseHTTPRequestHandler):
+    # answers the requests of the login in the same format as kite
+    # keep-alive as kite, so the session reuses its connection
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def reply(self, status, body=None, headers=()):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def error(self, status, error_type, message):
+        self.reply(status, {'status': 'error', 'error_type': error_type, 'message': message, 'data': None})
+
+    def form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return {key: values[0] for key, values in urlparse.parse_qs(self.rfile.read(length).decode()).items()}
+
+    def cookie(self, name):
+        for part in (self.headers.get('Cookie') or '').split(';'):
+            key, _, value = part.strip().partition('=')
+            if key == name:
+                return value
+        return None
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        query = {key: values[0] for key, values in urlparse.parse_qs(url.query).items()}
+
+        if url.path == '/connect/login':
+            if query.get('api_key') != server.api_key:
+                self.error(400, 'InputException', 'Invalid `api_key`.')
+            elif self.cookie('enctoken') in server.enctokens:
+                self.reply(302, headers=[('Location', '/connect/finish?api_key={}&sess_id={}'.format(
+                    server.api_key, secrets.token_hex(8)))])
+            else:
+                self.reply(200, {'status': 'success', 'data': 'login form'},
+                           headers=[('Set-Cookie', 'kf_session={}; Path=/'.format(secrets.token_hex(8)))])
+        elif url.path == '/connect/finish':
+            request_token = secrets.token_hex(16)
+            server.request_tokens.add(request_token)
+            self.reply(302, headers=[('Location', '{}?action=login&type=login&status=success&request_token={}'.format(
+                server.redirect_url, request_token))])
+        elif url.path == '/user/profile':
+            if self.headers.get('Authorization', '').split(':')[-1] not in server.access_tokens:
+                self.error(403, 'TokenException', 'Incorrect `api_key` or `access_token`.')
+            else:
+                self.reply(200, {'status': 'success', 'data': {'user_id': server.uid, 'user_name': 'mock user'}})
+        else:
+            self.error(404, 'GeneralException', 'Route not found')
+
+    def do_POST(self):
+        server = self.server
+        form = self.form()
+
+        if self.path == '/api/login':
+            if form.get('user_id') != server.uid or form.get('password') != server.pws:
+                self.error(403, 'InputException', 'Invalid `user_id` or `password`.')
+                return
+            request_id = secrets.token_hex(8)
+            server.request_ids.add(request_id)
+            self.reply(200, {'status': 'success', 'data': {'user_id': server.uid, 'request_id': request_id,
+                                                           'twofa_type': 'totp'}})
+        elif self.path == '/api/twofa':
+            if form.get('request_id') not in server.request_ids or \
+                    not pyotp.TOTP(server.totp_secret).verify(form.get('twofa_value', ''), valid_window=1):
+                self.error(403, 'TwoFAException', 'Invalid TOTP.')
+                return
+            enctoken = secrets.token_hex(16)
+            server.enctokens.add(enctoken)
+            self.reply(200, {'status': 'success', 'data': {}},
+                       headers=[('Set-Cookie', 'enctoken={}; Path=/'.format(enctoken))])
+        elif self.path == '/session/token':
+            if form.get('request_token') not in server.request_tokens:
+                self.error(403, 'TokenException', 'Token is invalid or has expired.')
+                return
+            server.request_tokens.discard(form['request_token'])
+            access_token = secrets.token_hex(16)
+            server.access_tokens.add(access_token)
+            self.reply(200, {'status': 'success', 'data': {'user_id': server.uid, 'access_token': access_token,
+                                                           'public_token': secrets.token_hex(8),
+                                                           'login_time': time.strftime('%Y-%m-%d %H:%M:%S')}})
+        else:
+            self.error(404, 'GeneralException', 'Route not found')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockLoginServer(ThreadingHTTPServer):
+    """local server of the kite login for tests. It serves both the login of kite web and the kite connect api, so
+    the same url is given as the base of HttpLogin and the root of KiteConnect."""
+
+    def __init__(self, api_key, uid, pws, totp_secret, port=0, redirect_url='http://127.0.0.1/redirect'):
+        super().__init__(('127.0.0.1', port), MockLoginHandler)
+        self.api_key = api_key
+        self.uid = uid
+        self.pws = pws
+        self.totp_secret = totp_secret
+        self.redirect_url = redirect_url
+        self.request_ids = set()
+        self.enctokens = set()
+        self.request_tokens = set()
+        self.access_tokens = set()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='login of the zerodha kite account over http against a local mock')
+    parser.add_argument('--runs', type=int, default=5, help='number of logins against the mock server')
+    args = parser.parse_args()
+
+    totp_secret = pyotp.random_base32()
+    server = MockLoginServer('mock_api_key', 'AB1234', 'password', totp_secret).start()
+    try:
+        for run in range(args.runs):
+            login = zerodhalogin_http.HttpLogin('mock_api_key', 'AB1234', 'password', totp_secret, base=server.url)
+            request_token = login.request_token()
+            print('run {}: request token {} in {:.3f} s ({})'.format(
+                run + 1, request_token, login.timings['total'],
+                ', '.join('{} {:.3f} s'.format(name, seconds) for name, seconds in login.timings.items()
+                          if name != 'total')))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
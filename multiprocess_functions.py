@@ -4,37 +4,39 @@ The purpose of this module is:
 1. Fetch historical data
 2. Call the strategy for signal processing at appropriate time as per the configuration of the strategy in algo_list.txt file.
 3. Send entry/exit orders as per the generated signal.
-4. Write the signals and orders in respective txt/pickle files for the record.
+4. Write the signals and orders in the signal journal and order store for the record.
 """
 
 # Import modules
+import logsetup
 import zerodhafunctions
+import optionchain
 import supportfunctions
 import ordermanagement
+import orderstore
+import marketdata
+import scheduler
+import ordergateway
+import clock
+import tracing
 
-# Import strategies
-import strategy1
-import strategy2
+# strategies are imported on first use by the strategy registry
+import strategies
 
 # Import required packages
 from datetime import datetime, time
-from time import sleep
-import _pickle as pickle
-import logging
+import concurrent.futures
 import os
 import pytz
 
-# set working directory and logging file
+# set working directory
 # use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
 # dir_path = os.path.dirname(os.path.realpath(__file__))
 dir_path = os.getcwd()
 os.chdir(dir_path)
 
-logfilename = 'logs_' + datetime.strftime(datetime.now(), '%Y-%m-%d') + '.log'
-logfile = os.path.join(dir_path, logfilename)
-
-logging.basicConfig(filename=logfile, format="%(asctime)s %(levelname)s %(message)s", level=logging.DEBUG)
-logger = logging.getLogger()
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
 
 # set time zone for indian markets
 IST = pytz.timezone('Asia/Kolkata')
@@ -50,6 +52,10 @@ signal_text = {'LE': 'long signal', 'LX': 'exit long', 'SE': 'short signal', 'SX
 # False for normal run, fetches data only at appropriate interval as per configuration in algo_list.txt.
 isdebug = False
 
+# kite object of the worker. It is set once per worker by workerpool.init_worker.
+# in the workers, it is the client of the broker gateway, which calls kite in the gateway process.
+kite = None
+
 
 class RunAlgo:
     """This class is designed as general algorithm executor.
@@ -57,11 +63,13 @@ class RunAlgo:
     retrieves historical data as per interval.
     processes the signal."""
 
-    def __init__(self, algo, interval, security):
-        self.current_time = datetime.time(datetime.now(IST))
+    def __init__(self, algo, interval, security, hist_data=None):
+        self.current_time = datetime.time(clock.now(IST))
         self.algo = algo
         self.interval = interval
         self.security = security
+        # historical data fetched once for all algos of the cycle, if available
+        self.hist_data = hist_data
 
     def is_run_time(self):
         # this function checks if the current time is appropriate to run the algo
@@ -71,18 +79,9 @@ class RunAlgo:
             return False
 
         # check if the time is to kick off signal processing
-        # include other relevant intervals if the strategies are configured for different candles.
-        # the text of the intervals are possible values as defined by zerodha
-        if self.interval == '15minute':
-            run = self.current_time.minute % 15 == 0
-            return run
-
-        if self.interval == '60minute':
-            run = self.current_time.minute == 15
-            return run
-
-        # returns false if no conditions are met
-        return False
+        # the candle boundaries of all intervals defined by zerodha (minute, 3minute, ..., 60minute, day) are known
+        # to the scheduler
+        return scheduler.is_bar_close(self.current_time, self.interval)
 
     def signal_processing(self):
         # this function processes signal
@@ -95,48 +94,58 @@ class RunAlgo:
                 logger.info('Issues in retrieving historical data. check for errors.\n')
                 return None
             else:
-                logger.info('processing signal for algo {}.'.format(self.algo))
-
-                # the below component should contain all the strategies configured in algo_list.txt file.
-                # in order to include a new strategy, it should be added in below lines.
-                if self.algo == 'strategy1':
-                    signal = strategy1.signal(hist_data)
-                    signal = signal.iloc[50:]
-                elif self.algo == 'strategy2':
-                    signal = strategy2.signal(hist_data)
-                    signal = signal.iloc[50:]
-                else:
-                    logger.info('algo {} is not configured in RunAlgo class'.format(self.algo))
+                logger.info('processing signal for algo %s.', self.algo)
+
+                with tracing.span('signal'):
+                    # strategies with the streaming api process only the new candles.
+                    signal = strategies.stream_signals(self.algo, hist_data)
+
+                    # the strategy module has the same name as the algo in algo_list.txt file.
+                    if signal is None:
+                        strategy = strategies.get_signal(self.algo)
+                        if strategy is None:
+                            logger.info('algo %s has no strategy module', self.algo)
+                            return None
+                        signal = strategy(hist_data)
+                        signal = signal.iloc[50:]
+
+                if signal.empty:
+                    logger.info('no new candle for algo %s.', self.algo)
                     return None
 
-                # store the data. the data is appended in pickle file using writesignal function.
-                supportfunctions.writesignal(signal, self.algo)
+                # store the data. the data is appended in the signal journal using writesignal function.
+                with tracing.span('writesignal'):
+                    supportfunctions.writesignal(signal, self.algo)
 
                 # get the latest signal
                 latest_signal = signal.iloc[-1]
-                logger.info(latest_signal)
+                # the signal is formatted by the log listener, not in the worker
+                logger.info('latest signal of algo %s: %s', self.algo, latest_signal)
                 return latest_signal
         else:
             return None
 
     def retrieve_data(self):
         # this function retrieves historical data of given security when isruntime is true
+        # the data shared by the fetch stage of the cycle is used when it exists
 
-        logger.info('retrieving historical data for algo {} and time interval {}.'.format(self.algo, self.interval))
+        if self.hist_data is not None:
+            logger.info('using shared historical data for algo %s and time interval %s.', self.algo, self.interval)
+            return self.hist_data
+
+        logger.info('retrieving historical data for algo %s and time interval %s.', self.algo, self.interval)
 
         # get instrument token as per the security
-        security_ltp = kite.ltp([self.security])
+        with tracing.span('ltp'):
+            security_ltp = marketdata.ltp(kite, [self.security])
         security_token = security_ltp[self.security]['instrument_token']
 
         # wait for few sec before getting data to ensure full candle is retrieved.
-        sleep(1.5)
-
-        hist_data = zerodhafunctions.get_historical(kite, security_token, 25, self.interval)
+        with tracing.span('wait'):
+            clock.sleep(1.5)
 
-        # drop the latest candle which has just begun
-        # this is to ensure analysis on the candle which was just completed
-        if hist_data['date'].iloc[-1].strftime("%H:%M") == self.current_time.strftime("%H:%M"):
-            hist_data = hist_data[:-1]
+        with tracing.span('historical'):
+            hist_data = completed_candles(kite, security_token, self.interval, self.current_time)
 
         logger.info('Data retrieved...')
         return hist_data
@@ -174,15 +183,91 @@ class RunAlgo:
             return False
 
 
-def use_signal(algo_details):
+def completed_candles(kite, security_token, interval, current_time):
+    # fetches the historical data and drops the latest candle which has just begun
+    # this is to ensure analysis on the candle which was just completed
+    # returns None if no candle is stored or fetched (e.g. a new token, a holiday or a failed fetch)
+
+    hist_data = zerodhafunctions.get_candles(kite, security_token, 25, interval)
+
+    if hist_data.empty:
+        logger.info('no candles of %s for interval %s.', security_token, interval)
+        return None
+
+    if hist_data['date'].iloc[-1].strftime("%H:%M") == current_time.strftime("%H:%M"):
+        hist_data = hist_data[:-1]
+
+    return hist_data
+
+
+def fetch_cycle_data(kite, algo_config):
+    """This function is the fetch stage of a cycle. It is called in main_chrome.py before the algos are sent to workers.
+    The historical data is fetched once per (security, interval) for the algos due to run, and the same data is
+    handed to every algo subscribed to it.
+
+    Returns a copy of algo_config where each algo due to run carries its data under the key 'hist_data'."""
+
+    current_time = datetime.time(clock.now(IST))
+
+    # group the algos due to run by security and interval
+    groups = {}
+    for algo_details in algo_config:
+        run_algo = RunAlgo(algo_details['algo'], algo_details['interval'], algo_details['security'])
+        if run_algo.is_run_time() or isdebug:
+            groups.setdefault((algo_details['security'], algo_details['interval']), []).append(algo_details['algo'])
+
+    if not groups:
+        return algo_config
+
+    # the shared stages are traced for each algo which waits on them
+    bar = algo_config[0].get('bar')
+    cycle_data = {}
+    try:
+        # one ltp call for the tokens of all securities
+        securities = list(set(security for security, interval in groups))
+        with tracing.trace(sum(groups.values(), []), bar):
+            with tracing.span('ltp'):
+                security_ltp = marketdata.ltp(kite, securities)
+
+            # wait for few sec before getting data to ensure full candle is retrieved.
+            # no wait is needed when the candle builder has already stored the closed candles.
+            if not all(zerodhafunctions.candle_store.is_current(security_ltp[security]['instrument_token'], interval)
+                       for security, interval in groups):
+                with tracing.span('wait'):
+                    clock.sleep(1.5)
+
+        for (security, interval), algos in groups.items():
+            logger.info('retrieving historical data of %s for interval %s shared by algos %s.',
+                        security, interval, algos)
+            security_token = security_ltp[security]['instrument_token']
+            with tracing.trace(algos, bar), tracing.span('historical'):
+                cycle_data[(security, interval)] = completed_candles(kite, security_token, interval, current_time)
+    except Exception as e:
+        # the algos without shared data fetch it themselves in the worker
+        logger.info('shared fetch of historical data failed: %s', e)
+
+    cycle_config = []
+    for algo_details in algo_config:
+        algo_details = dict(algo_details)
+        hist_data = cycle_data.get((algo_details['security'], algo_details['interval']))
+        if hist_data is not None:
+            algo_details['hist_data'] = hist_data
+        cycle_config.append(algo_details)
+
+    return cycle_config
+
+
+def use_signal(algo_details, place_orders=True):
     """This function is designed to be called by futures executor for multi processing of the algos
     The algo_details is the dict of details like algo, interval, security, etc of each algo.
 
     This function initiates the run_algo class and its methods
     It gathers the signal after processing
-    It places the order if market is open."""
+    It places the order if market is open.
 
-    global kite
+    When place_orders is False, the orders are not placed but returned, so that the orders of all algos are placed
+    together by the order gateway of the main process.
+    Returns the list of orders prepared for the signal."""
 
     algo = algo_details['algo']
     interval = algo_details['interval']
@@ -190,16 +275,19 @@ def use_signal(algo_details):
     lot_size = algo_details['lot_size']
     baseqty = algo_details['baseqty']
     days_before_expiry = algo_details['days_before_expiry']
-    kite = algo_details['kite_obj']
 
     # Initiate class
-    logger.info('Initiating processing of signals for algo {} and interval {}.\n'.format(algo, interval))
-    run_algo = RunAlgo(algo, interval, security)
-    logger.info('is_run_time for algo {} and interval {}: {}.\n'.format(algo, interval, run_algo.is_run_time()))
+    logger.info('Initiating processing of signals for algo %s and interval %s.\n', algo, interval)
+    run_algo = RunAlgo(algo, interval, security, algo_details.get('hist_data'))
+    logger.info('is_run_time for algo %s and interval %s: %s.\n', algo, interval, run_algo.is_run_time())
+
+    orders = []
 
     # get signal
     if run_algo.is_run_time() or isdebug:
         signal_algo = run_algo.signal_processing()
+        if signal_algo is None:
+            return orders
 
         # for entry orders
         if run_algo.is_entry_order(signal_algo):
@@ -207,39 +295,63 @@ def use_signal(algo_details):
 
             signal_type = run_algo.entry_order(signal_algo)
             logger.info(
-                '{} signal received for algo {} and security {}'.format(signal_text[signal_type], algo, security))
+                '%s signal received for algo %s and security %s', signal_text[signal_type], algo, security)
 
             boost_status = signal_algo['boost_status']
 
             # get the qty and symbol for the order
-            new_position = zerodhafunctions.get_symbol(kite, signal_type, baseqty, lot_size, boost_status,
-                                                       days_before_expiry)
-
-            logger.info('based on ltp, order symbol is {} and quantity is {}'.format(new_position['tradingsymbol'],
-                                                                                     new_position['quantity']))
-            logger.info('Placing {} order for algo {}.\n'.format(signal_type, algo))
-
-            # place order
-            ordermanagement.trade(kite, new_position, algo, interval, signal_type)
+            # the algo can choose the expiry rule and strike of its options, see optionchain.py
+            with tracing.span('get_symbol'):
+                new_position = zerodhafunctions.get_symbol(kite, signal_type, baseqty, lot_size, boost_status,
+                                                           days_before_expiry,
+                                                           expiry_rule=algo_details.get('expiry_rule', 'monthly'),
+                                                           moneyness=algo_details.get('moneyness', 'ITM'),
+                                                           strike_offset=algo_details.get('strike_offset', 0),
+                                                           strike_step=algo_details.get('strike_step', 100),
+                                                           underlying=optionchain.underlying_of(algo_details),
+                                                           spot_symbol=security,
+                                                           target_delta=algo_details.get('target_delta'),
+                                                           target_premium=algo_details.get('target_premium'))
+
+            logger.info('based on ltp, order symbol is %s and quantity is %s', new_position['tradingsymbol'],
+                        new_position['quantity'])
+            logger.info('Placing %s order for algo %s.\n', signal_type, algo)
+
+            # prepare order
+            orders.append(ordermanagement.prepare_order(kite, new_position, algo, interval, signal_type,
+                                                        signal_algo['date']))
 
         # for exit order
         if run_algo.is_exit_order(signal_algo):
             signal_type = run_algo.exit_order(signal_algo)
 
-            with open('order_info.txt', 'rb') as file:
-                positions = pickle.load(file)
-                positions = positions[algo]
-                file.close()
-
             entry_signal_type = 'LE' if signal_type == 'LX' else 'SE'
-            positions = positions[entry_signal_type]
+            positions = orderstore.order_store.get(algo, entry_signal_type)
             order_exists_for_exit = positions['status'] == 'COMPLETE'
 
             if order_exists_for_exit:
                 logger.info(
-                    '{} signal received for algo {} and security {}'.format(signal_text[signal_type], algo, security))
+                    '%s signal received for algo %s and security %s', signal_text[signal_type], algo, security)
                 logger.info(
-                    'exiting {} position of quantity {}.\n'.format(positions['tradingsymbol'], positions['quantity']))
+                    'exiting %s position of quantity %s.\n', positions['tradingsymbol'], positions['quantity'])
+
+                # prepare order
+                orders.append(ordermanagement.prepare_order(kite, positions, algo, interval, signal_type,
+                                                            signal_algo['date']))
+
+    orders = [order for order in orders if order is not None]
+
+    # the orders carry the bar of the run, so that their placement is traced with it
+    for order in orders:
+        order['bar'] = algo_details.get('bar')
+
+    # place orders. the orders are sent together and confirmed by the order gateway.
+    if place_orders and orders:
+        gateway = ordergateway.get_gateway(kite)
+        confirmations = [gateway.submit(order) for order in orders]
+        done, not_done = concurrent.futures.wait(confirmations, timeout=ordergateway.result_timeout)
+        if not_done:
+            logger.info('%s orders of algo %s not confirmed within %s seconds',
+                        len(not_done), algo, ordergateway.result_timeout)
 
-                # place order
-                ordermanagement.trade(kite, positions, algo, interval, signal_type)
+    return orders
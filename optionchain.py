@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the option chains used by zerodhafunctions.get_symbol to choose the option to trade.
+The chain of an underlying is built once from the instrument master (at the warm-up of the day, see warmup.py) and
+holds its expiries in order, the strikes of each expiry and the tradingsymbol, token and lot size of each contract.
+The purpose of this module is:
+1. expiry(): the expiry of a rule, 'weekly' (the nearest expiry) or 'monthly' (the last expiry of a month), skipping the
+   expiries within days_before_expiry days. The expiries are the ones listed by kite, so weekly contracts and holidays
+   need no calendar.
+2. contract(): the option at the money (ATM), in the money (ITM) or out of the money (OTM), k strikes further, for the
+   expiry of a rule. The position of the spot in the strikes is kept from the last call and moved by the strikes the
+   spot has crossed since, so a call costs no search and no I/O.
+3. get_chain(): the chain of the process, rebuilt when the instrument master is reloaded.
+"""
+
+import logsetup
+import instrumentmaster
+import clock
+
+from datetime import datetime, time
+import numpy as np
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# underlying of the options of the securities, used when the algo does not define 'underlying'
+underlyings = {'NSE:NIFTY 50': 'NIFTY',
+               'NSE:NIFTY BANK': 'BANKNIFTY',
+               'NSE:NIFTY FIN SERVICE': 'FINNIFTY'}
+
+# option chains of the process by underlying
+chains = {}
+
+
+def underlying_of(algo_details):
+    """returns the underlying of the options traded by the algo"""
+
+    return algo_details.get('underlying') or underlyings.get(algo_details['security'], 'NIFTY')
+
+
+def first_expiry(expiries, days_before_expiry=0, now=None):
+    """returns the first of the expiries (in order) which is more than days_before_expiry days away, as get_symbol has
+    always counted them: whole days from now to the start of the expiry day. None if there is none. The backtest
+    chooses its expiries with it too."""
+
+    now = now or clock.now()
+    for expiry in expiries:
+        if (datetime.combine(expiry, time(0, 0, 0)) - now).days > days_before_expiry:
+            return expiry
+    return None
+
+
+class ExpiryChain:
+    """This class holds the contracts of one expiry, aligned with its sorted strikes.
+    symbols, tokens and lot_sizes are lists by option type, with None where a strike has no contract of the type."""
+
+    def __init__(self, expiry, strikes, symbols, tokens, lot_sizes):
+        self.expiry = expiry
+        self.strikes = strikes
+        self.symbols = symbols
+        self.tokens = tokens
+        self.lot_sizes = lot_sizes
+        # strikes of each step (e.g. only the multiples of 100) and the last position of the spot in them
+        self.steps = {}
+        self.cursors = {}
+
+    def stepped(self, step):
+        # indexes of the strikes which are multiples of the step. all the strikes if step is None.
+        if step not in self.steps:
+            strikes = np.array(self.strikes)
+            keep = np.ones(len(strikes), dtype=bool) if not step else np.isclose(np.mod(strikes, step), 0)
+            self.steps[step] = np.flatnonzero(keep).tolist()
+        return self.steps[step]
+
+    def position(self, spot, step):
+        """index in stepped(step) of the highest strike at or below spot, -1 if spot is below all the strikes.
+        The search starts from the position of the last call, so it moves only by the strikes crossed since."""
+
+        indexes = self.stepped(step)
+        strikes = self.strikes
+        i = self.cursors.get(step, len(indexes) // 2 - 1)
+        while i + 1 < len(indexes) and strikes[indexes[i + 1]] <= spot:
+            i += 1
+        while i >= 0 and strikes[indexes[i]] > spot:
+            i -= 1
+        self.cursors[step] = i
+        return i
+
+    def contract(self, spot, option_type, moneyness='ITM', offset=0, step=None):
+        """returns the contract as a dict, or None if there is no such strike.
+        ITM is the nearest strike in the money (at or below spot for CE, at or above for PE), OTM the nearest strike
+        out of the money and ATM the nearest strike. offset moves the strike further from the spot: deeper in the money
+        for ITM and ATM, further out of the money for OTM. A negative offset moves it the other way."""
+
+        indexes = self.stepped(step)
+        strikes = self.strikes
+        floor = self.position(spot, step)
+
+        at_floor = floor >= 0 and strikes[indexes[floor]] == spot
+        if option_type == 'CE':
+            itm, otm, deeper = floor, floor + 1, -1
+        else:
+            itm = floor if at_floor else floor + 1
+            otm, deeper = itm - 1, 1
+
+        if moneyness == 'ITM':
+            i = itm + deeper * offset
+        elif moneyness == 'OTM':
+            i = otm - deeper * offset
+        elif moneyness == 'ATM':
+            nearest = floor
+            if floor < 0 or (floor + 1 < len(indexes) and
+                             strikes[indexes[floor + 1]] - spot < spot - strikes[indexes[floor]]):
+                nearest = floor + 1
+            i = nearest + deeper * offset
+        else:
+            raise ValueError('moneyness {} is not ATM, ITM or OTM'.format(moneyness))
+
+        if not 0 <= i < len(indexes):
+            return None
+        return self.record(indexes[i], option_type)
+
+    def record(self, strike, option_type):
+        """returns the contract of the type at the index of the strike as a dict, or None if there is no contract"""
+
+        if self.symbols[option_type][strike] is None:
+            return None
+        return {'tradingsymbol': self.symbols[option_type][strike],
+                'instrument_token': self.tokens[option_type][strike],
+                'lot_size': self.lot_sizes[option_type][strike],
+                'strike': self.strikes[strike],
+                'expiry': self.expiry,
+                'instrument_type': option_type}
+
+
+class OptionChain:
+    """This class holds the option chain of an underlying: its expiries in order and the ExpiryChain of each."""
+
+    def __init__(self, master, underlying):
+        self.master = master
+        self.underlying = underlying
+
+        arrays = master.arrays
+        rows = np.flatnonzero((arrays['name'] == underlying.encode()) &
+                              np.isin(arrays['instrument_type'], [b'CE', b'PE']) & (arrays['expiry'] > 0))
+
+        self.chains = {}
+        for expiry in np.unique(arrays['expiry'][rows]).tolist():
+            expiry_rows = rows[arrays['expiry'][rows] == expiry]
+            strikes = np.unique(arrays['strike'][expiry_rows])
+            symbols, tokens, lot_sizes = {}, {}, {}
+            for option_type in ('CE', 'PE'):
+                type_rows = expiry_rows[arrays['instrument_type'][expiry_rows] == option_type.encode()]
+                positions = np.searchsorted(strikes, arrays['strike'][type_rows]).tolist()
+                symbols[option_type] = [None] * len(strikes)
+                tokens[option_type] = [None] * len(strikes)
+                lot_sizes[option_type] = [None] * len(strikes)
+                for position, symbol, token, lot_size in zip(positions,
+                                                             arrays['tradingsymbol'][type_rows].tolist(),
+                                                             arrays['instrument_token'][type_rows].tolist(),
+                                                             arrays['lot_size'][type_rows].tolist()):
+                    symbols[option_type][position] = symbol.decode()
+                    tokens[option_type][position] = token
+                    lot_sizes[option_type][position] = lot_size
+            expiry_date = datetime.strptime(str(expiry), '%Y%m%d').date()
+            self.chains[expiry_date] = ExpiryChain(expiry_date, strikes.tolist(), symbols, tokens, lot_sizes)
+
+        self.expiries = sorted(self.chains)
+
+        # the monthly expiry is the last expiry of its month
+        last_of_month = {}
+        for expiry in self.expiries:
+            last_of_month[(expiry.year, expiry.month)] = expiry
+        self.monthly = sorted(last_of_month.values())
+
+    def expiry(self, rule='monthly', days_before_expiry=0, now=None):
+        """returns the first expiry of the rule ('weekly' or 'monthly') which is more than days_before_expiry days
+        away, as get_symbol has always counted them: whole days from now to the start of the expiry day."""
+
+        if rule == 'weekly':
+            expiries = self.expiries
+        elif rule == 'monthly':
+            expiries = self.monthly
+        else:
+            raise ValueError('expiry rule {} is not weekly or monthly'.format(rule))
+
+        return first_expiry(expiries, days_before_expiry, now)
+
+    def contract(self, spot, option_type, expiry_rule='monthly', days_before_expiry=0, moneyness='ITM', offset=0,
+                 step=None):
+        """returns the contract of the option as a dict (see ExpiryChain.contract), or None if there is no such
+        contract"""
+
+        expiry = self.expiry(expiry_rule, days_before_expiry)
+        if expiry is None:
+            return None
+        return self.chains[expiry].contract(spot, option_type, moneyness, offset, step)
+
+
+def get_chain(underlying='NIFTY'):
+    """returns the option chain of the underlying. It is built on first use, and rebuilt when the instrument master of
+    the process is reloaded."""
+
+    master = instrumentmaster.get_master()
+    chain = chains.get(underlying)
+    if chain is None or chain.master is not master:
+        chain = OptionChain(master, underlying)
+        chains[underlying] = chain
+    return chain
+
+
+def build(algo_config):
+    """builds the option chains of the underlyings of the algos. Used by the warm-up of the day."""
+
+    built = []
+    for underlying in sorted(set(underlying_of(algo_details) for algo_details in algo_config)):
+        chain = get_chain(underlying)
+        built.append('{} {} expiries'.format(underlying, len(chain.expiries)))
+    return ', '.join(built)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the local orderbook of the orders placed by the algos.
+Every order is sent with a tag made from the algo, the signal type and the timestamp of the candle of the signal,
+so the same signal always gives the same tag. The orderbook keeps the orders by tag and by order id in the order
+database (order_info.db), and is kept up to date from the order updates of the websocket and the orderbook polls of the
+order gateway.
+The purpose of this module is:
+1. Find the order of a signal by its tag after a place_order call timed out, without scanning the orderbook of kite or
+   mistaking the order of another algo for it.
+2. Make sure the order of a signal is sent only once, even if the signal is processed again.
+"""
+
+import logsetup
+
+from datetime import timedelta
+import _pickle as pickle
+import threading
+import hashlib
+import sqlite3
+import time
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# kite accepts alphanumeric tags of up to 20 characters
+tag_length = 20
+
+# status of an order which is being sent and of an order which could not be sent
+sent_status = 'SENT'
+failed_status = 'FAILED'
+
+
+def make_tag(algo, signal_type, bar):
+    """returns the tag of the order of the signal. bar is the timestamp of the candle of the signal."""
+
+    key = '{}|{}|{}'.format(algo, signal_type, bar.isoformat() if hasattr(bar, 'isoformat') else bar)
+    return hashlib.sha1(key.encode()).hexdigest()[:tag_length]
+
+
+class OrderBook:
+    """This class keeps the orders sent by the algos in the table orderbook of the order database.
+    The tag is the primary key and the order id is indexed, so both lookups read a single row."""
+
+    def __init__(self, filename='order_info.db'):
+        self.filename = os.path.join(dir_path, filename)
+        self.connection = None
+        self.pid = None
+        self.lock = threading.RLock()
+
+    def connect(self):
+        # each process opens its own connection
+        with self.lock:
+            if self.connection is not None and self.pid == os.getpid():
+                return self.connection
+
+            connection = sqlite3.connect(self.filename, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS orderbook ('
+                               'tag TEXT PRIMARY KEY, '
+                               'order_id TEXT, '
+                               'algo TEXT, '
+                               'signal_type TEXT, '
+                               'status TEXT, '
+                               'updated_at REAL, '
+                               'detail BLOB)')
+            connection.execute('CREATE INDEX IF NOT EXISTS orderbook_order_id ON orderbook (order_id)')
+
+            self.connection = connection
+            self.pid = os.getpid()
+            return connection
+
+    def row(self, query, values):
+        # returns the row as a dict of the order, or None
+        with self.lock:
+            row = self.connect().execute('SELECT tag, order_id, algo, signal_type, status, detail FROM orderbook ' + query,
+                                         values).fetchone()
+        if row is None:
+            return None
+
+        tag, order_id, algo, signal_type, status, detail = row
+        order = pickle.loads(detail) if detail is not None else {}
+        order.update({'tag': tag, 'order_id': order_id, 'algo': algo, 'signal_type': signal_type, 'status': status})
+        return order
+
+    def by_tag(self, tag):
+        """returns the order with the tag, or None"""
+
+        return self.row('WHERE tag = ?', (tag,))
+
+    def by_order_id(self, order_id):
+        """returns the order with the order id, or None"""
+
+        return self.row('WHERE order_id = ?', (str(order_id),))
+
+    def reserve(self, order):
+        """records that the order is being sent. Returns the order already recorded with the same tag, if any.
+        An order which could not be sent earlier is sent again."""
+
+        with self.lock:
+            existing = self.by_tag(order['tag'])
+            if existing is not None and existing['status'] != failed_status:
+                return existing
+
+            self.connect().execute('INSERT OR REPLACE INTO orderbook (tag, order_id, algo, signal_type, status, '
+                                   'updated_at, detail) VALUES (?, NULL, ?, ?, ?, ?, NULL)',
+                                   (order['tag'], order['algo'], order['signal_type'], sent_status, time.time()))
+            return None
+
+    def sent(self, tag, order_id):
+        """records the order id returned by kite for the tag"""
+
+        with self.lock:
+            self.connect().execute('UPDATE orderbook SET order_id = ?, updated_at = ? WHERE tag = ? AND order_id IS NULL',
+                                   (str(order_id), time.time(), tag))
+
+    def failed(self, tag):
+        """records that the order of the tag could not be sent"""
+
+        with self.lock:
+            self.connect().execute('UPDATE orderbook SET status = ?, updated_at = ? WHERE tag = ? AND order_id IS NULL',
+                                   (failed_status, time.time(), tag))
+
+    def update(self, orders):
+        """updates the orderbook with orders in kite format, from the websocket or kite.orders().
+        Only the orders with a tag recorded in the orderbook are kept."""
+
+        values = [(str(order['order_id']), order['status'], time.time(), pickle.dumps(order), order['tag'])
+                  for order in orders if order.get('tag')]
+        if not values:
+            return
+
+        with self.lock:
+            self.connect().executemany('UPDATE orderbook SET order_id = ?, status = ?, updated_at = ?, detail = ? '
+                                       'WHERE tag = ?', values)
+
+    def prune(self, days=7):
+        """removes the orders older than the given number of days"""
+
+        before = time.time() - timedelta(days=days).total_seconds()
+        with self.lock:
+            self.connect().execute('DELETE FROM orderbook WHERE updated_at < ?', (before,))
+
+
+# orderbook of the process
+order_book = OrderBook()
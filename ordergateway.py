@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the order gateway which places the orders of all algos.
+The orders are sent concurrently from a pool of threads and confirmed without fixed waits:
+the gateway listens to the order updates of the kite websocket and polls the orderbook in batches (one kite.orders() call
+for all pending orders) until each order is acknowledged by the exchange.
+Every order gets a future, which is resolved with the order details when the order is confirmed.
+The order info is written in the order store when the order is confirmed.
+Orders are sent with their tag and recorded in the local orderbook, so an order is never sent twice for the same signal
+and an order whose response timed out is found by its tag.
+"""
+
+import logsetup
+import supportfunctions
+import ordermanagement
+import orderbook
+import tracing
+
+import concurrent.futures
+import threading
+import time
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# status of orders which are not yet acknowledged by the exchange
+pending_status = ('PUT ORDER REQ RECEIVED', 'VALIDATION PENDING', 'OPEN PENDING', 'MODIFY VALIDATION PENDING',
+                  'MODIFY PENDING', 'CANCEL PENDING', 'AMO REQ RECEIVED')
+
+# seconds the callers wait for the confirmation of an order: the retries of the placement and the confirm timeout
+result_timeout = 60
+
+
+class OrderGateway:
+    """This class places orders and confirms them.
+    submit() sends an order prepared by ordermanagement.prepare_order and returns a future of the confirmed order.
+    on_order_update() is called with the order updates of the kite websocket.
+    The poller thread calls kite.orders() once per poll for all orders which are not confirmed yet. An order which is
+    not confirmed within confirm_timeout seconds is resolved with its last details in the orderbook of kite, or with
+    None if kite does not list it."""
+
+    def __init__(self, kite, max_workers=8, poll_interval=0.25, confirm_timeout=10):
+        self.kite = kite
+        self.poll_interval = poll_interval
+        self.confirm_timeout = confirm_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.poller = threading.Thread(target=self.poll, daemon=True)
+        self.poller.start()
+
+    def submit(self, order):
+        """sends the order from the thread pool. Returns a future resolved with the confirmed order details,
+        or with None if the order could not be placed or was not found in the orderbook of kite."""
+
+        confirmation = concurrent.futures.Future()
+        self.executor.submit(self.place, order, confirmation)
+        return confirmation
+
+    def place(self, order, confirmation):
+        kite = self.kite
+        n_tries = 0
+        sent_at = time.time()
+
+        # the order of the signal may have been sent already, e.g. if the signal was processed again
+        trade_id = None
+        existing = orderbook.order_book.reserve(order)
+        if existing is not None:
+            logger.info('%s order for algo %s with tag %s was already sent', order['signal_type'], order['algo'],
+                        order['tag'])
+            trade_id = existing['order_id'] or self.recover(order)
+            if trade_id is None:
+                # the order may still reach kite. it is not sent again with the same tag, which would duplicate it.
+                logger.info('%s order for algo %s with tag %s not found in the orderbook, it is not sent again',
+                            order['signal_type'], order['algo'], order['tag'])
+                confirmation.set_result(None)
+                return
+
+        while trade_id is None:
+            try:
+                with tracing.trace(order['algo'], order.get('bar')), tracing.span('place_order'):
+                    trade_id = kite.place_order(variety=kite.VARIETY_REGULAR,
+                                                exchange=kite.EXCHANGE_NFO,
+                                                tradingsymbol=order['tradingsymbol'],
+                                                transaction_type=order['transaction_type'],
+                                                quantity=order['quantity'],
+                                                product=kite.PRODUCT_NRML,
+                                                order_type=kite.ORDER_TYPE_LIMIT,
+                                                price=order['price'],
+                                                validity=kite.VALIDITY_DAY,
+                                                tag=order['tag'])
+            except Exception as e:
+                logger.info(e)
+
+                # check whether order was placed and response timed out
+                logger.info('re-checking if the order was placed')
+                trade_id = self.recover(order)
+                if trade_id is not None:
+                    break
+
+                # retry trades if trade_id is none
+                n_tries += 1
+                if n_tries > 3:
+                    logger.info('Maximum tries exhausted.... proceeding without placing the order')
+                    orderbook.order_book.failed(order['tag'])
+                    confirmation.set_result(None)
+                    return
+
+                # check internet connection
+                if not supportfunctions.is_connected():
+                    logger.info('Internet connection broken, retrying order in 5 seconds')
+                    time.sleep(5)
+
+        orderbook.order_book.sent(order['tag'], trade_id)
+        logger.info('%s order %s for algo %s sent in %.3f seconds', order['signal_type'], trade_id, order['algo'],
+                    time.time() - sent_at)
+        with self.lock:
+            self.pending[trade_id] = (order, confirmation, time.time())
+        self.wakeup.set()
+
+    def recover(self, order, wait=5, step=0.5):
+        # the order may have reached the exchange even if the response timed out.
+        # the local orderbook, updated by the websocket, is checked by tag every step seconds for up to wait seconds.
+        # the orderbook of kite is fetched once at the end if the order is not found.
+        deadline = time.time() + wait
+        while time.time() < deadline:
+            time.sleep(step)
+            recorded = orderbook.order_book.by_tag(order['tag'])
+            if recorded is not None and recorded['order_id'] is not None:
+                return recorded['order_id']
+        return ordermanagement.check_order_placement(self.kite, order['tag'])
+
+    def confirm(self, order_update):
+        # resolves the future of the order if it is acknowledged by the exchange
+        if order_update['status'] in pending_status:
+            return
+
+        with self.lock:
+            entry = self.pending.pop(order_update['order_id'], None)
+        if entry is None:
+            return
+
+        order, confirmation, sent_at = entry
+        bar = order.get('bar') or tracing.current_bar()
+        tracing.record('confirm', time.time() - sent_at, order['algo'], bar, sent_at)
+        tracing.since_bar('bar_to_ack', order['algo'], bar)
+        logger.info('order placed. Details of the order:')
+        logger.info(order_update)
+
+        # amend order info to reflect the new order
+        supportfunctions.writeorderinfo(order_update, order['algo'], order['signal_type'])
+        confirmation.set_result(order_update)
+
+    def on_order_update(self, order_update):
+        """order update of the kite websocket"""
+
+        orderbook.order_book.update([order_update])
+        self.confirm(order_update)
+
+    def poll(self):
+        while not self.stopped:
+            if not self.pending:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            time.sleep(self.poll_interval)
+            try:
+                # one orderbook call confirms all pending orders
+                orders = self.kite.orders()
+            except Exception as e:
+                logger.info('orderbook not fetched: %s', e)
+                orders = []
+
+            orderbook.order_book.update(orders)
+            orders = {order['order_id']: order for order in orders}
+            for order_id in list(self.pending):
+                if order_id in orders:
+                    self.confirm(orders[order_id])
+
+            # orders which stay pending are confirmed with their last known details. the orders which kite does not
+            # list are given up, so that no caller waits on them for ever.
+            for order_id, (order, confirmation, sent_at) in list(self.pending.items()):
+                if time.time() - sent_at <= self.confirm_timeout:
+                    continue
+                # the order may have been confirmed by the websocket meanwhile
+                with self.lock:
+                    if self.pending.pop(order_id, None) is None:
+                        continue
+                if order_id in orders:
+                    logger.info('order %s is still pending at the exchange', order_id)
+                    supportfunctions.writeorderinfo(orders[order_id], order['algo'], order['signal_type'])
+                    confirmation.set_result(orders[order_id])
+                else:
+                    logger.info('order %s of algo %s not found in the orderbook of kite within %s seconds', order_id,
+                                order['algo'], self.confirm_timeout)
+                    confirmation.set_result(None)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.stopped = True
+        self.wakeup.set()
+
+
+# gateway of the process. created by get_gateway on first use.
+gateway = None
+
+
+def get_gateway(kite):
+    """returns the order gateway of the process for the kite object"""
+
+    global gateway
+    if gateway is None or gateway.kite is not kite:
+        # the gateway of the previous session holds the old kite object
+        if gateway is not None:
+            gateway.shutdown()
+        gateway = OrderGateway(kite)
+    return gateway
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the order state store which replaces the order_info.txt pickle.
+The orders of each algo and signal type ('LE', 'LX', 'SE', 'SX') are kept as rows of a SQLite database (order_info.db).
+The purpose of this module is:
+1. Let the workers of all algos update their orders at the same time without losing each other's updates.
+2. Update and read one algo/signal row without reading or writing the orders of other algos.
+3. Keep the order state durable through the write-ahead log of SQLite.
+
+On first use, the orders stored in order_info.txt are imported in the database.
+"""
+
+import logsetup
+import clock
+
+import _pickle as pickle
+import threading
+import sqlite3
+import pytz
+import time
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# signal types stored for each algo
+signal_types = ['LE', 'LX', 'SE', 'SX']
+
+# order status which do not need any monitoring
+closed_status = ('none', 'COMPLETE', 'REJECTED', 'CANCELLED')
+
+
+def sample_order():
+    # order info of an algo/signal which has no order
+    return {'order_id': 'none',
+            'order_type': 'none',
+            'status': 'none',
+            'tradingsymbol': 'none',
+            'instrument_token': 'none',
+            'quantity': 0,
+            'order_time': clock.now(IST),
+            'execution_time': clock.now(IST),
+            'signal': 'none'}
+
+
+class OrderStore:
+    """This class keeps the order info of all algos in a SQLite database.
+    Each (algo, signal_type) is one row. The full order dict is stored along with the columns used for lookups."""
+
+    def __init__(self, filename='order_info.db', legacy_file='order_info.txt'):
+        self.filename = os.path.join(dir_path, filename)
+        self.legacy_file = os.path.join(dir_path, legacy_file)
+        self.connection = None
+        self.pid = None
+        # the connection is shared by the threads of the process, e.g. the order gateway
+        self.lock = threading.RLock()
+
+    def connect(self):
+        # sqlite connections can not be shared with forked workers. each process opens its own connection.
+        with self.lock:
+            if self.connection is not None and self.pid == os.getpid():
+                return self.connection
+            return self.open()
+
+    def open(self):
+
+        connection = sqlite3.connect(self.filename, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS order_info ('
+                           'algo TEXT NOT NULL, '
+                           'signal_type TEXT NOT NULL, '
+                           'order_id TEXT, '
+                           'status TEXT, '
+                           'tradingsymbol TEXT, '
+                           'quantity INTEGER, '
+                           'updated_at REAL, '
+                           'detail BLOB NOT NULL, '
+                           'PRIMARY KEY (algo, signal_type))')
+        connection.execute('CREATE INDEX IF NOT EXISTS order_info_status ON order_info (status)')
+
+        self.connection = connection
+        self.pid = os.getpid()
+        self.import_legacy()
+        return connection
+
+    def import_legacy(self):
+        # import the orders of order_info.txt when the database is empty
+        connection = self.connection
+        if connection.execute('SELECT COUNT(*) FROM order_info').fetchone()[0] > 0:
+            return
+        if not os.path.isfile(self.legacy_file):
+            return
+
+        with open(self.legacy_file, 'rb') as file:
+            order_info = pickle.load(file)
+            file.close()
+
+        rows = {}
+        for algo, order_info_algo in order_info.items():
+            for signal_type, order in order_info_algo.items():
+                rows[(algo, signal_type)] = order
+        self.write(rows)
+        logger.info('order info of {} algos imported from {}'.format(len(order_info), self.legacy_file))
+
+    def write(self, rows):
+        # rows is a dict of {(algo, signal_type): order}. all rows are written in one transaction.
+        connection = self.connect()
+        values = [(algo, signal_type, str(order.get('order_id')), order.get('status'), order.get('tradingsymbol'),
+                   order.get('quantity'), time.time(), pickle.dumps(order))
+                  for (algo, signal_type), order in rows.items()]
+
+        with self.lock:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany('INSERT OR REPLACE INTO order_info '
+                                       '(algo, signal_type, order_id, status, tradingsymbol, quantity, updated_at, detail) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', values)
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+
+    def put(self, algo, signal_type, order):
+        """stores the order of the algo and signal type"""
+
+        self.write({(algo, signal_type): order})
+
+    def reset(self, algo, *reset_types):
+        """sets the given signal types of the algo to no order, in one transaction"""
+
+        self.write({(algo, signal_type): sample_order() for signal_type in reset_types})
+
+    def get(self, algo, signal_type):
+        """returns the order of the algo and signal type. An algo without orders returns the sample order."""
+
+        with self.lock:
+            row = self.connect().execute('SELECT detail FROM order_info WHERE algo = ? AND signal_type = ?',
+                                         (algo, signal_type)).fetchone()
+        return pickle.loads(row[0]) if row is not None else sample_order()
+
+    def get_algo(self, algo):
+        """returns the orders of all signal types of the algo as a dict"""
+
+        order_info_algo = {signal_type: sample_order() for signal_type in signal_types}
+        with self.lock:
+            rows = self.connect().execute('SELECT signal_type, detail FROM order_info WHERE algo = ?',
+                                          (algo,)).fetchall()
+        for signal_type, detail in rows:
+            order_info_algo[signal_type] = pickle.loads(detail)
+        return order_info_algo
+
+    def all(self):
+        """returns the orders of all algos in the same format as order_info.txt. The signal types without a stored
+        order have the sample order."""
+
+        order_info = {}
+        with self.lock:
+            rows = self.connect().execute('SELECT algo, signal_type, detail FROM order_info ORDER BY algo').fetchall()
+        for algo, signal_type, detail in rows:
+            if algo not in order_info:
+                order_info[algo] = {signal_type: sample_order() for signal_type in signal_types}
+            order_info[algo][signal_type] = pickle.loads(detail)
+        return order_info
+
+    def open_orders(self):
+        """returns the orders which are not complete, rejected or cancelled as a list of (algo, signal_type, order)"""
+
+        with self.lock:
+            rows = self.connect().execute('SELECT algo, signal_type, detail FROM order_info WHERE status NOT IN ({})'.format(
+                ', '.join('?' * len(closed_status))), closed_status).fetchall()
+        return [(algo, signal_type, pickle.loads(detail)) for algo, signal_type, detail in rows]
+
+
+# order store of the process
+order_store = OrderStore()
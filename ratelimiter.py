@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the rate limiter of the kite API calls, shared by the main process and all the workers.
+Kite limits the requests per second of each class of endpoints. The limiter keeps one token bucket per class in shared
+memory, so that the calls of all processes together stay within the limits instead of being rejected with HTTP 429.
+The purpose of this module is:
+1. Keep a token bucket per endpoint class (orders, quotes, historical data and the other endpoints), with the limits
+   of each class documented by kite. Kite documents no limit of all the calls together.
+2. Give priority to the order calls: the lower classes wait while a higher class is waiting for a token.
+3. Count the calls, the time spent waiting, the throttled calls and the calls rejected by kite with 429.
+4. RateLimitedKite: drop-in for the kite object which takes a token before every API call.
+"""
+
+import logsetup
+
+import multiprocessing
+import time
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# endpoint classes in order of priority, with their limit of requests per second
+lanes = ['order', 'quote', 'default', 'historical']
+limits = {'order': 10, 'quote': 1, 'default': 10, 'historical': 3}
+
+# class of the kite methods. the methods not listed are in the default class.
+endpoints = {'place_order': 'order',
+             'modify_order': 'order',
+             'cancel_order': 'order',
+             'exit_order': 'order',
+             'ltp': 'quote',
+             'ohlc': 'quote',
+             'quote': 'quote',
+             'historical_data': 'historical'}
+
+# methods of kite which do not call the API
+local_methods = ('login_url', 'set_access_token', 'set_session_expiry_hook')
+
+# fields of each bucket in the shared array
+fields = ['tokens', 'updated', 'waiting', 'calls', 'wait_time', 'throttled', 'rejected']
+
+# number of retries of a call rejected by kite with 429
+max_retries = 3
+
+
+class RateLimiter:
+    """This class keeps the token buckets in a shared array protected by a shared lock.
+    It is created in the main process and handed to the workers through the initializer of the pool."""
+
+    def __init__(self, limits=limits):
+        self.limits = dict(limits)
+        self.buckets = list(lanes)
+        self.lock = multiprocessing.Lock()
+        self.state = multiprocessing.RawArray('d', len(self.buckets) * len(fields))
+        now = time.time()
+        for bucket in self.buckets:
+            self.set(bucket, 'tokens', self.limits[bucket])
+            self.set(bucket, 'updated', now)
+
+    def index(self, bucket, field):
+        return self.buckets.index(bucket) * len(fields) + fields.index(field)
+
+    def get(self, bucket, field):
+        return self.state[self.index(bucket, field)]
+
+    def set(self, bucket, field, value):
+        self.state[self.index(bucket, field)] = value
+
+    def add(self, bucket, field, value=1):
+        self.state[self.index(bucket, field)] += value
+
+    def refill(self, bucket, now):
+        # the bucket holds at most one second of requests
+        elapsed = now - self.get(bucket, 'updated')
+        tokens = min(self.limits[bucket], self.get(bucket, 'tokens') + elapsed * self.limits[bucket])
+        self.set(bucket, 'tokens', tokens)
+        self.set(bucket, 'updated', now)
+
+    def acquire(self, lane):
+        """waits till a call of the lane is allowed. Returns the time waited in seconds."""
+
+        started = time.time()
+        waiting = False
+        try:
+            while True:
+                with self.lock:
+                    now = time.time()
+                    self.refill(lane, now)
+
+                    # a call waits while a call of a higher priority is waiting
+                    higher_waiting = any(self.get(higher, 'waiting') > 0 for higher in lanes[:lanes.index(lane)])
+                    if not higher_waiting and self.get(lane, 'tokens') >= 1:
+                        self.add(lane, 'tokens', -1)
+                        self.add(lane, 'calls')
+                        waited = now - started
+                        if waiting:
+                            self.add(lane, 'wait_time', waited)
+                        return waited
+
+                    if not waiting:
+                        waiting = True
+                        self.add(lane, 'waiting')
+                        self.add(lane, 'throttled')
+
+                    # time till the next token of the lane
+                    delay = max((1 - self.get(lane, 'tokens')) / self.limits[lane], 0.005)
+                time.sleep(delay)
+        finally:
+            # the call is no longer waiting, also when the wait is interrupted, so that the lower classes do not wait
+            # for it
+            if waiting:
+                with self.lock:
+                    self.add(lane, 'waiting', -1)
+
+    def rejected(self, lane):
+        with self.lock:
+            self.add(lane, 'rejected')
+
+    def stats(self):
+        """returns the counters of each lane as a dict"""
+
+        with self.lock:
+            return {lane: {field: self.get(lane, field) for field in ['calls', 'wait_time', 'throttled', 'rejected']}
+                    for lane in lanes}
+
+
+def is_rate_limited(e):
+    # kite raises NetworkException with code 429 when the rate limit is exceeded
+    return getattr(e, 'code', None) == 429
+
+
+class RateLimitedKite:
+    """This class wraps the kite object. Every API call takes a token of its endpoint class from the limiter before it
+    is sent. The calls rejected by kite with 429 are retried after a new token is taken.
+    The attributes and constants of kite are read from the wrapped object."""
+
+    def __init__(self, kite, limiter):
+        self.kite = kite
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        # called only for the names which are not attributes of the wrapper
+        if name in ('kite', 'limiter'):
+            raise AttributeError(name)
+        attribute = getattr(self.kite, name)
+        if not callable(attribute) or name.startswith('_') or name in local_methods:
+            return attribute
+
+        def call(*args, **kwargs):
+            return self.invoke(name, *args, **kwargs)
+        return call
+
+    def invoke(self, name, *args, acquired=False, **kwargs):
+        """calls the method of kite with a token of its class. acquired is True when the caller has already taken the
+        token of the first try (e.g. the batched calls of brokergateway.py). The calls rejected by kite with 429 are
+        retried after a new token is taken."""
+
+        attribute = getattr(self.kite, name)
+        lane = endpoints.get(name, 'default')
+        tries = 0
+        while True:
+            if not acquired:
+                self.limiter.acquire(lane)
+            acquired = False
+            try:
+                return attribute(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e) or tries >= max_retries:
+                    raise
+                tries += 1
+                self.limiter.rejected(lane)
+                logger.info('{} call rejected by rate limit of kite, retrying'.format(name))
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+# rate limiter of the processes. created by the main process and handed to the workers.
+limiter = None
+
+
+def get_limiter():
+    """returns the rate limiter of the process"""
+
+    global limiter
+    if limiter is None:
+        limiter = RateLimiter()
+    return limiter
+
+
+def wrap(kite):
+    """returns the kite object with its API calls rate limited"""
+
+    if isinstance(kite, RateLimitedKite):
+        return kite
+    return RateLimitedKite(kite, get_limiter())
+
+
+def log_stats():
+    if limiter is None:
+        return
+    for lane, stats in limiter.stats().items():
+        logger.info('api {} calls: {:.0f}, throttled: {:.0f}, waited: {:.3f} seconds, rejected by kite: {:.0f}'.format(
+            lane, stats['calls'], stats['throttled'], stats['wait_time'], stats['rejected']))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the scheduler which runs the jobs of the trading day at exact times.
+The jobs are kept in a heap ordered by their deadline. The scheduler sleeps until the earliest deadline, runs the job and
+schedules its next run, so that no time slot is missed and no polling is needed.
+The purpose of this module is:
+1. Know the NSE session (9:15 to 15:30 on weekdays, except holidays) and the candle boundaries of every kite interval
+   (minute, 3minute, 5minute, 10minute, 15minute, 30minute, 60minute and day).
+2. Run the algos of each interval at every candle boundary.
+3. Run the order monitoring and the daily start and end of session jobs at their times.
+"""
+
+import logsetup
+import candlestore
+import clock
+
+from datetime import datetime, time, timedelta
+import threading
+import heapq
+import pytz
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# define market hour timings
+start_time = time(9, 15, 0)
+end_time = time(15, 30, 0)
+
+# trading holidays of NSE as dates. the file holidays.txt, if present, has one date (yyyy-mm-dd) per line.
+holidays = set()
+if os.path.isfile(os.path.join(dir_path, 'holidays.txt')):
+    with open(os.path.join(dir_path, 'holidays.txt'), 'r') as file:
+        holidays = set(datetime.strptime(line.strip(), '%Y-%m-%d').date() for line in file if line.strip())
+        file.close()
+
+
+def is_trading_day(day):
+    return day.weekday() < 5 and day not in holidays
+
+
+def session_times(minutes, first=start_time):
+    """returns the times from first till the end of market hours (excluded), every given minutes"""
+
+    times = []
+    moment = datetime.combine(clock.now(), first)
+    end = datetime.combine(clock.now(), end_time)
+    while moment < end:
+        times.append(moment.time())
+        moment += timedelta(minutes=minutes)
+    return times
+
+
+def bar_close_times(interval):
+    """returns the times of the day at which the algos of the interval run.
+    The algos run at every candle boundary from the open of the market, when the previous candle has just closed.
+    The 'day' algos run at the open of the market on the candle of the previous day."""
+
+    minutes = candlestore.interval_minutes(interval)
+    if minutes is None:
+        return [start_time]
+    return session_times(minutes)
+
+
+def is_bar_close(moment, interval):
+    """returns True if moment (a datetime or time) is in the minute of a candle boundary of the interval"""
+
+    moment = moment.time() if isinstance(moment, datetime) else moment
+    return moment.replace(second=0, microsecond=0) in bar_close_times(interval)
+
+
+def next_time(after, times):
+    """returns the first datetime after the given datetime, on a trading day, at one of the given times of day"""
+
+    day = after.date()
+    while True:
+        if is_trading_day(day):
+            for moment in sorted(times):
+                deadline = IST.localize(datetime.combine(day, moment))
+                if deadline > after:
+                    return deadline
+        day += timedelta(1)
+
+
+class Job:
+    """A job runs callback(deadline, *args) at each of the given times of day, on trading days."""
+
+    def __init__(self, name, times, callback, args):
+        self.name = name
+        self.times = times
+        self.callback = callback
+        self.args = args
+
+
+class Scheduler:
+    """This class keeps the jobs in a heap ordered by deadline and runs them at their deadline.
+    every_bar() schedules a job at the candle boundaries of an interval.
+    every() schedules a job every given minutes in market hours.
+    daily() schedules a job at a time of day.
+    run() blocks and runs the jobs till stop() is called."""
+
+    def __init__(self):
+        self.heap = []
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+    def add(self, job, after=None):
+        deadline = next_time(after or clock.now(IST), job.times)
+        with self.lock:
+            self.counter += 1
+            heapq.heappush(self.heap, (deadline, self.counter, job))
+        self.wakeup.set()
+        return deadline
+
+    def every_bar(self, interval, callback, *args):
+        job = Job('{} candle'.format(interval), bar_close_times(interval), callback, args)
+        return self.add(job)
+
+    def every(self, minutes, callback, *args, first=start_time):
+        job = Job('every {} minutes'.format(minutes), session_times(minutes, first), callback, args)
+        return self.add(job)
+
+    def daily(self, at_time, callback, *args):
+        job = Job('daily at {}'.format(at_time.strftime('%H:%M')), [at_time], callback, args)
+        return self.add(job)
+
+    def cancel(self, callback):
+        """removes all jobs of the callback"""
+
+        with self.lock:
+            self.heap = [entry for entry in self.heap if entry[2].callback != callback]
+            heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            with self.lock:
+                deadline = self.heap[0][0] if self.heap else None
+
+            self.wakeup.clear()
+            if deadline is None:
+                self.wakeup.wait()
+                continue
+
+            wait = (deadline - clock.now(IST)).total_seconds()
+            if wait > 0:
+                logger.info('Next job at {}'.format(deadline.strftime('%Y-%m-%d %H:%M:%S')))
+                # a new job or stop() wakes the scheduler before the deadline
+                if clock.wait(self.wakeup, wait):
+                    continue
+
+            with self.lock:
+                if not self.heap or self.heap[0][0] != deadline:
+                    continue
+                deadline, counter, job = heapq.heappop(self.heap)
+
+            logger.info('Running job {} of {} ({:.3f} seconds late)'.format(
+                job.name, deadline.strftime('%H:%M:%S'), (clock.now(IST) - deadline).total_seconds()))
+            try:
+                job.callback(deadline, *job.args)
+            except Exception as e:
+                logger.info('job {} failed: {}'.format(job.name, e))
+
+            # the next run is after the current time, so that a job which ran late does not run twice
+            self.add(job, after=max(deadline, clock.now(IST)))
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the signal journal used by supportfunctions.writesignal.
+The journal of each algo is kept in the folder signals/<algo>, with one append-only file per candle date.
+Every write appends one segment holding only the candles newer than the last journaled candle, stored by column.
+The purpose of this module is:
+1. Record the signals of every run without rewriting or duplicating the signals already stored.
+2. Read back the signals of a day or of a range of days without loading the rest of the journal.
+"""
+
+import logsetup
+import clock
+
+from datetime import datetime, timedelta
+import _pickle as pickle
+import numpy as np
+import pandas as pd
+import struct
+import pytz
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# columns journaled for every candle, if present in the signal data
+candle_columns = ['open', 'high', 'low', 'close', 'volume']
+signal_columns = ['long_signal', 'short_signal', 'boost_status']
+
+# each segment is written as its length followed by the pickled columns
+header = struct.Struct('<Q')
+
+
+def localize(bound):
+    # the bound of a range as an IST datetime, to be compared with the stored dates. dates are returned as they are.
+    if not isinstance(bound, datetime):
+        return bound
+    if bound.tzinfo is None:
+        return IST.localize(bound)
+    return bound.astimezone(IST)
+
+
+class SignalJournal:
+    """This class appends the signals of an algo to its journal and reads them back.
+    append() writes the candles newer than the last journaled candle.
+    read_day() and read_range() return the journaled signals as a dataframe."""
+
+    def __init__(self, root='signals'):
+        self.root = os.path.join(dir_path, root)
+
+    def folder(self, algo):
+        folder = os.path.join(self.root, algo)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def last_candle(self, algo):
+        # epoch seconds of the last journaled candle. kept in a small file so that the journal is not read.
+        filename = os.path.join(self.folder(algo), 'last')
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'r') as file:
+            return int(file.read())
+
+    def append(self, algo, signal_data):
+        """appends the candles of signal_data which are newer than the last journaled candle.
+        Returns the number of candles written."""
+
+        if len(signal_data) == 0:
+            return 0
+
+        dates = np.array([int(date.timestamp()) for date in signal_data['date']], dtype=np.int64)
+        last = self.last_candle(algo)
+        new_rows = dates > last if last is not None else np.ones(len(dates), dtype=bool)
+        if not new_rows.any():
+            return 0
+
+        written_at = clock.now(IST)
+        new_data = signal_data[new_rows]
+        new_dates = dates[new_rows]
+        days = np.array([datetime.fromtimestamp(date, IST).strftime('%Y%m%d') for date in new_dates])
+
+        folder = self.folder(algo)
+        for day in np.unique(days):
+            in_day = days == day
+            segment = {'written_at': written_at, 'date': new_dates[in_day]}
+            for column in candle_columns + signal_columns:
+                if column in new_data:
+                    segment[column] = new_data[column].to_numpy()[in_day]
+
+            data = pickle.dumps(segment)
+            with open(os.path.join(folder, day + '.journal'), 'ab') as file:
+                file.write(header.pack(len(data)) + data)
+
+        with open(os.path.join(folder, 'last'), 'w') as file:
+            file.write(str(int(new_dates[-1])))
+
+        return int(new_rows.sum())
+
+    def empty(self):
+        return pd.DataFrame(columns=['date', 'written_at'] + candle_columns + signal_columns)
+
+    def read_segments(self, filename):
+        segments = []
+        with open(filename, 'rb') as file:
+            while True:
+                size = file.read(header.size)
+                if len(size) < header.size:
+                    break
+                data = file.read(header.unpack(size)[0])
+                try:
+                    segments.append(pickle.loads(data))
+                except Exception:
+                    # an incomplete segment at the end of the file is left by an interrupted write
+                    logger.info('incomplete segment ignored in signal journal {}'.format(filename))
+                    break
+        return segments
+
+    def read_day(self, algo, day):
+        """returns the signals of the candles of the given day (a date or datetime) as a dataframe."""
+
+        filename = os.path.join(self.folder(algo), day.strftime('%Y%m%d') + '.journal')
+        if not os.path.isfile(filename):
+            return self.empty()
+
+        frames = []
+        for segment in self.read_segments(filename):
+            written_at = segment.pop('written_at')
+            frame = pd.DataFrame(segment)
+            frame['written_at'] = written_at
+            frames.append(frame)
+
+        if not frames:
+            return self.empty()
+
+        df = pd.concat(frames, ignore_index=True)
+        df['date'] = pd.to_datetime(df['date'], unit='s', utc=True).dt.tz_convert(IST)
+        return df
+
+    def read_range(self, algo, start, end):
+        """returns the signals of the candles from start to end (both dates or datetimes, inclusive). Naive datetimes
+        are assumed to be in IST."""
+
+        start, end = (localize(bound) for bound in (start, end))
+        frames = []
+        day = start.date() if isinstance(start, datetime) else start
+        last_day = end.date() if isinstance(end, datetime) else end
+        while day <= last_day:
+            df = self.read_day(algo, day)
+            if len(df):
+                frames.append(df)
+            day += timedelta(1)
+
+        if not frames:
+            return self.empty()
+
+        df = pd.concat(frames, ignore_index=True)
+        if isinstance(start, datetime):
+            df = df[df['date'] >= start]
+        if isinstance(end, datetime):
+            df = df[df['date'] <= end]
+        return df.reset_index(drop=True)
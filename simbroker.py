@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains a simulated broker, used to run a whole trading day offline on recorded minute candles.
+SimKite has the methods of KiteConnect used by the system (ltp, historical_data, place_order, modify_order,
+cancel_order, order_history, orders and positions) and answers them from the minute candles at the time of the clock
+of the process (see clock.py). With a SimClock the session runs in seconds and gives the same orders and fills on
+every run.
+The purpose of this module is:
+1. Prices: the last price of an instrument is the open of the minute in progress, or the close of the last minute.
+   historical_data builds the candles of any interval from the minute candles, with the unfinished candle at the end
+   as kite does. The options are priced from the candles of the underlying with the Black-Scholes formula of
+   greeks.py, as the recorded data has no options.
+2. Fills: a limit order is filled at the last price when it is placed or modified at a marketable price, else at its
+   price in the first following minute which trades at that price (low for buy orders, high for sell orders).
+   The fills are matched when the orders are read, so no thread runs in the background.
+3. replay_session(): runs the jobs of the trading day of main_chrome.py (algos at every candle close, order monitor
+   every 3 minutes) on a simulated clock, with the order store, orderbook, signal journal, candle store and
+   strategy states in a separate folder.
+
+usage: python simbroker.py --day 2024-03-15 --workdir replay
+The minute candles of the securities of algo_list.txt are read from the candle store (see candlestore.py).
+"""
+
+import logsetup
+import backtest
+import candlestore
+import clock
+import greeks
+import instrumentmaster
+import multiprocess_functions
+import ordergateway
+import orderbook
+import ordermanagement
+import orderstore
+import scheduler
+import signaljournal
+import strategies
+import supportfunctions
+import tracing
+import zerodhafunctions
+
+from kiteconnect import KiteConnect
+from datetime import datetime, date, time, timedelta
+import numpy as np
+import pandas as pd
+import threading
+import argparse
+import time as timer
+import pytz
+import re
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# option symbols of the monthly contracts, e.g. NIFTY24MAR22000CE
+option_symbol = re.compile(r'^([A-Z]+)(\d{2})([A-Z]{3})(\d+)(CE|PE)$')
+
+# tokens given to the options which are not in the instrument master
+first_option_token = 900000000
+
+# order ids start after this number
+first_order_id = 260000000000000
+
+# price step of the options
+tick_size = 0.05
+
+
+def parse_time(value, end_of_day=False):
+    # the dates of historical_data are strings ('yyyy-mm-dd' or 'yyyy-mm-dd hh:mm:ss'), dates or datetimes
+    if isinstance(value, str):
+        only_date = len(value) == 10
+        value = pd.Timestamp(value).to_pydatetime()
+        if only_date and end_of_day:
+            value = value.replace(hour=23, minute=59, second=59)
+    elif isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime.combine(value, time(23, 59, 59) if end_of_day else time(0, 0, 0))
+    return candlestore.to_epoch(value)
+
+
+def minute_arrays(df):
+    # arrays of the minute candles of one instrument, sorted by the epoch of the candle start
+    df = df.sort_values('date')
+    dates = pd.to_datetime(df['date'])
+    if dates.dt.tz is None:
+        dates = dates.dt.tz_localize(IST)
+    return {'start': ((dates - pd.Timestamp(0, tz='UTC')).dt.total_seconds()).to_numpy(np.int64),
+            'open': df['open'].to_numpy(float),
+            'high': df['high'].to_numpy(float),
+            'low': df['low'].to_numpy(float),
+            'close': df['close'].to_numpy(float),
+            'volume': df['volume'].to_numpy(np.int64) if 'volume' in df else np.zeros(len(df), np.int64)}
+
+
+class SimKite:
+    """This class is used in place of the kite object on recorded data.
+    candles is a dict of instrument_token: dataframe of minute candles (date, open, high, low, close, volume).
+    symbols is a dict of 'EXCHANGE:TRADINGSYMBOL': instrument_token of the recorded instruments.
+    The options of the underlying are priced from its candles at the given volatility."""
+
+    def __init__(self, candles, symbols, underlying='NSE:NIFTY 50', volatility=0.15, rate=0.07):
+        # constants of kite, e.g. kite.TRANSACTION_TYPE_BUY
+        for name in dir(KiteConnect):
+            if name.isupper():
+                setattr(self, name, getattr(KiteConnect, name))
+        self.api_key = 'sim'
+        self.access_token = 'sim'
+
+        self.arrays = {int(token): minute_arrays(df) for token, df in candles.items()}
+        self.symbols = dict(symbols)
+        self.underlying = underlying
+        self.volatility = volatility
+        self.rate = rate
+        self.contracts = {}
+        self.order_book = {}
+        self.order_listeners = []
+        self.lock = threading.RLock()
+
+    def set_access_token(self, access_token):
+        self.access_token = access_token
+
+    def add_order_listener(self, listener):
+        """listener(order) is called with every new order, modification and fill, as the order updates of the
+        websocket"""
+
+        self.order_listeners.append(listener)
+
+    def notify(self, updates):
+        for update in updates:
+            for listener in self.order_listeners:
+                listener(dict(update))
+
+    # prices
+
+    def token(self, instrument):
+        # token of 'EXCHANGE:SYMBOL'. the options are added on first use.
+        if instrument in self.symbols:
+            return self.symbols[instrument]
+
+        exchange, symbol = instrument.split(':', 1)
+        contract = self.option_contract(symbol)
+        if exchange != 'NFO' or contract is None:
+            raise KeyError('instrument {} is not in the recorded data'.format(instrument))
+
+        token = contract['instrument_token'] or first_option_token + len(self.contracts)
+        self.contracts[token] = contract
+        self.symbols[instrument] = token
+        return token
+
+    def option_contract(self, symbol):
+        # strike, type and expiry of the option, from the instrument master or else from the symbol
+        try:
+            record = instrumentmaster.get_master().by_symbol(symbol, 'NFO')
+        except Exception:
+            record = None
+        if record is not None and record['instrument_type'] in ('CE', 'PE'):
+            return {'instrument_token': record['instrument_token'], 'strike': record['strike'],
+                    'expiry': record['expiry'], 'is_call': record['instrument_type'] == 'CE'}
+
+        match = option_symbol.match(symbol)
+        if match is None:
+            return None
+        month = datetime.strptime(match.group(2) + match.group(3).title(), '%y%b')
+        return {'instrument_token': None, 'strike': float(match.group(4)),
+                'expiry': backtest.monthly_expiry(month.year, month.month), 'is_call': match.group(5) == 'CE'}
+
+    def candles(self, token):
+        # minute candles of the token. the candles of an option are computed once from the underlying.
+        if token in self.arrays:
+            return self.arrays[token]
+
+        contract = self.contracts[token]
+        spot = self.arrays[self.token(self.underlying)]
+        expiry = IST.localize(datetime.combine(contract['expiry'], time(15, 30, 0))).timestamp()
+        years = (expiry - spot['start'] - 60) / (365 * 24 * 3600)
+
+        def price(values):
+            value = greeks.option_price(values, contract['strike'], years, contract['is_call'], self.volatility,
+                                          self.rate)
+            return np.maximum(np.round(value / tick_size) * tick_size, tick_size)
+
+        # the high of a put is at the low of the underlying
+        high, low = (spot['high'], spot['low']) if contract['is_call'] else (spot['low'], spot['high'])
+        self.arrays[token] = {'start': spot['start'], 'open': price(spot['open']), 'high': price(high),
+                              'low': price(low), 'close': price(spot['close']),
+                              'volume': np.zeros(len(spot['start']), np.int64)}
+        return self.arrays[token]
+
+    def last_price(self, token, moment):
+        arrays = self.candles(token)
+        row = int(np.searchsorted(arrays['start'], moment, side='right')) - 1
+        if row < 0:
+            return float(arrays['open'][0])
+        if arrays['start'][row] + 60 > moment:
+            return float(arrays['open'][row])
+        return float(arrays['close'][row])
+
+    def ltp(self, instruments):
+        if isinstance(instruments, str):
+            instruments = [instruments]
+        moment = clock.now(IST).timestamp()
+        with self.lock:
+            prices = {}
+            for instrument in instruments:
+                token = self.token(instrument)
+                prices[instrument] = {'instrument_token': token, 'last_price': self.last_price(token, moment)}
+        return prices
+
+    def historical_data(self, instrument_token, from_date, to_date, interval, continuous=False, oi=False):
+        """candles of the interval between the dates, till the current time of the clock. The candle in progress
+        has the minutes completed so far and the open of the minute in progress."""
+
+        now = clock.now(IST).timestamp()
+        start = parse_time(from_date)
+        end = min(parse_time(to_date, end_of_day=True), now)
+        with self.lock:
+            arrays = self.candles(int(instrument_token))
+        first = int(np.searchsorted(arrays['start'], start, side='left'))
+        last = int(np.searchsorted(arrays['start'], end, side='right'))
+        if last <= first:
+            return []
+
+        df = pd.DataFrame({column: arrays[column][first:last] for column in arrays})
+        if df['start'].iloc[-1] + 60 > now:
+            # only the open of the minute in progress is known
+            df.loc[df.index[-1], ['high', 'low', 'close']] = df['open'].iloc[-1]
+            df.loc[df.index[-1], 'volume'] = 0
+
+        dates = pd.to_datetime(df['start'], unit='s', utc=True).dt.tz_convert(IST)
+        minutes = candlestore.interval_minutes(interval)
+        if minutes is None:
+            df['date'] = dates.dt.normalize()
+        else:
+            session_start = dates.dt.normalize() + pd.Timedelta(hours=9, minutes=15)
+            df['date'] = session_start + ((dates - session_start) // pd.Timedelta(minutes=minutes)) * pd.Timedelta(
+                minutes=minutes)
+
+        df = df.groupby('date', sort=True).agg({'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last',
+                                                'volume': 'sum'}).reset_index()
+        records = df.to_dict('records')
+        for record in records:
+            record['date'] = record['date'].to_pydatetime()
+        return records
+
+    # orders
+
+    def place_order(self, variety, exchange, tradingsymbol, transaction_type, quantity, product, order_type,
+                    price=None, validity=None, tag=None, **kwargs):
+        now = clock.now(IST)
+        with self.lock:
+            order_id = str(first_order_id + len(self.order_book) + 1)
+            instrument = exchange + ':' + tradingsymbol
+            order = {'order_id': order_id,
+                     'exchange_order_id': order_id,
+                     'status': 'OPEN',
+                     'status_message': None,
+                     'variety': variety,
+                     'exchange': exchange,
+                     'tradingsymbol': tradingsymbol,
+                     'instrument_token': self.token(instrument),
+                     'transaction_type': transaction_type,
+                     'order_type': order_type,
+                     'product': product,
+                     'validity': validity,
+                     'quantity': int(quantity),
+                     'price': float(price or 0),
+                     'trigger_price': 0,
+                     'average_price': 0,
+                     'filled_quantity': 0,
+                     'pending_quantity': int(quantity),
+                     'cancelled_quantity': 0,
+                     'tag': tag,
+                     'order_timestamp': now.replace(tzinfo=None),
+                     'exchange_timestamp': now.replace(tzinfo=None),
+                     'exchange_update_timestamp': now.replace(tzinfo=None),
+                     # fills are matched on the minutes starting from this epoch
+                     'matched_till': now.timestamp()}
+            self.order_book[order_id] = order
+            updates = [self.public(order)]
+            updates.extend(self.fill_marketable(order, now.timestamp()))
+        self.notify(updates)
+        return order_id
+
+    def modify_order(self, variety, order_id, parent_order_id=None, quantity=None, price=None, order_type=None,
+                     trigger_price=None, validity=None, disclosed_quantity=None):
+        now = clock.now(IST)
+        updates = self.match()
+        with self.lock:
+            order = self.order_book[str(order_id)]
+            if order['status'] != 'OPEN':
+                raise ValueError('order {} is {} and can not be modified'.format(order_id, order['status']))
+            if quantity is not None:
+                order['quantity'] = order['pending_quantity'] = int(quantity)
+            if price is not None:
+                order['price'] = float(price)
+            order['exchange_update_timestamp'] = now.replace(tzinfo=None)
+            order['matched_till'] = now.timestamp()
+            updates.append(self.public(order))
+            updates.extend(self.fill_marketable(order, now.timestamp()))
+        self.notify(updates)
+        return str(order_id)
+
+    def cancel_order(self, variety, order_id, parent_order_id=None):
+        now = clock.now(IST)
+        updates = self.match()
+        with self.lock:
+            order = self.order_book[str(order_id)]
+            if order['status'] == 'OPEN':
+                order['status'] = 'CANCELLED'
+                order['cancelled_quantity'], order['pending_quantity'] = order['pending_quantity'], 0
+                order['exchange_update_timestamp'] = now.replace(tzinfo=None)
+                updates.append(self.public(order))
+        self.notify(updates)
+        return str(order_id)
+
+    def public(self, order):
+        return {key: value for key, value in order.items() if key != 'matched_till'}
+
+    def fill(self, order, price, moment):
+        order['status'] = 'COMPLETE'
+        order['average_price'] = round(price, 2)
+        order['filled_quantity'] = order['quantity']
+        order['pending_quantity'] = 0
+        order['exchange_update_timestamp'] = datetime.fromtimestamp(moment, IST).replace(tzinfo=None)
+        return self.public(order)
+
+    def fill_marketable(self, order, moment):
+        # a limit order at or through the last price is filled at once at the last price
+        last_price = self.last_price(order['instrument_token'], moment)
+        if order['transaction_type'] == self.TRANSACTION_TYPE_BUY and order['price'] >= last_price:
+            return [self.fill(order, last_price, moment)]
+        if order['transaction_type'] == self.TRANSACTION_TYPE_SELL and order['price'] <= last_price:
+            return [self.fill(order, last_price, moment)]
+        return []
+
+    def match(self):
+        # fills the open orders on the minutes completed since they were placed or last checked
+        now = clock.now(IST).timestamp()
+        updates = []
+        with self.lock:
+            for order in self.order_book.values():
+                if order['status'] != 'OPEN':
+                    continue
+                arrays = self.candles(order['instrument_token'])
+                first = int(np.searchsorted(arrays['start'], order['matched_till'], side='left'))
+                last = int(np.searchsorted(arrays['start'], now - 60, side='right'))
+                if order['transaction_type'] == self.TRANSACTION_TYPE_BUY:
+                    traded = np.flatnonzero(arrays['low'][first:last] <= order['price'])
+                else:
+                    traded = np.flatnonzero(arrays['high'][first:last] >= order['price'])
+                if len(traded):
+                    row = first + int(traded[0])
+                    updates.append(self.fill(order, order['price'], arrays['start'][row] + 60))
+                elif last > first:
+                    order['matched_till'] = float(arrays['start'][last - 1] + 60)
+        return updates
+
+    def orders(self):
+        updates = self.match()
+        self.notify(updates)
+        with self.lock:
+            return [self.public(order) for order in self.order_book.values()]
+
+    def order_history(self, order_id):
+        updates = self.match()
+        self.notify(updates)
+        with self.lock:
+            return [self.public(self.order_book[str(order_id)])]
+
+    def positions(self):
+        """net positions of the filled orders, valued at the last price"""
+
+        updates = self.match()
+        self.notify(updates)
+        moment = clock.now(IST).timestamp()
+        with self.lock:
+            net = {}
+            for order in self.order_book.values():
+                if order['status'] != 'COMPLETE':
+                    continue
+                position = net.setdefault(order['tradingsymbol'], {'tradingsymbol': order['tradingsymbol'],
+                                                                   'exchange': order['exchange'],
+                                                                   'instrument_token': order['instrument_token'],
+                                                                   'product': order['product'],
+                                                                   'quantity': 0, 'buy_quantity': 0,
+                                                                   'sell_quantity': 0, 'buy_value': 0.0,
+                                                                   'sell_value': 0.0})
+                value = order['average_price'] * order['filled_quantity']
+                if order['transaction_type'] == self.TRANSACTION_TYPE_BUY:
+                    position['buy_quantity'] += order['filled_quantity']
+                    position['buy_value'] += value
+                else:
+                    position['sell_quantity'] += order['filled_quantity']
+                    position['sell_value'] += value
+
+            for position in net.values():
+                position['quantity'] = position['buy_quantity'] - position['sell_quantity']
+                position['last_price'] = self.last_price(position['instrument_token'], moment)
+                position['pnl'] = round(position['sell_value'] - position['buy_value'] +
+                                        position['quantity'] * position['last_price'], 2)
+                position['average_price'] = round((position['buy_value'] - position['sell_value']) /
+                                                  position['quantity'], 2) if position['quantity'] else 0
+        positions = list(net.values())
+        return {'net': positions, 'day': [dict(position) for position in positions]}
+
+
+def from_store(symbols, day, ndays=30, store=None):
+    """returns a SimKite with the minute candles of the instruments for ndays till the end of day, read from the
+    candle store. symbols is a list of 'EXCHANGE:TRADINGSYMBOL' in the instrument master."""
+
+    store = store or candlestore.CandleStore()
+    master = instrumentmaster.get_master()
+    start = IST.localize(datetime.combine(day - timedelta(ndays), time(0, 0, 0)))
+    end = IST.localize(datetime.combine(day, time(23, 59, 59)))
+    candles = {}
+    tokens = {}
+    for symbol in symbols:
+        token = master.by_symbol(symbol)['instrument_token']
+        df = store.read(token, 'minute', start)
+        candles[token] = df[df['date'] <= end]
+        tokens[symbol] = token
+    return SimKite(candles, tokens)
+
+
+class ReplayDay:
+    """This class runs the jobs of main_chrome.TradingDay on the simulated broker, in the process:
+    the algos of each interval at every candle close and the order monitor every 3 minutes.
+    The orders are sent one after the other through the order gateway, so the order ids are the same on every run."""
+
+    def __init__(self, kite, algo_config, schedule, gateway):
+        self.kite = kite
+        self.algo_config = algo_config
+        self.schedule = schedule
+        self.gateway = gateway
+        self.signals = 0
+
+    def run_bar(self, deadline, interval):
+        algo_config = [dict(algo, bar=deadline) for algo in self.algo_config if algo['interval'] == interval]
+        tracing.since_bar('scheduler_wake', [algo['algo'] for algo in algo_config], deadline)
+        cycle_config = multiprocess_functions.fetch_cycle_data(self.kite, algo_config)
+        for algo_details in cycle_config:
+            with tracing.trace(algo_details['algo'], deadline):
+                orders = multiprocess_functions.use_signal(algo_details, place_orders=False)
+            self.signals += len(orders)
+            for order in orders:
+                self.gateway.submit(order).result()
+
+    def monitor(self, deadline):
+        ordermanagement.monitor_all(self.kite, [algo['algo'] for algo in self.algo_config])
+
+    def end(self, deadline):
+        self.schedule.stop()
+
+
+def use_stores(workdir, new_clock):
+    """sets the clock of the process and the stores of the system (order store, orderbook, signal journal, candle store,
+    strategy states and latency traces) in workdir, in place of the stores of the live system. Returns the replaced objects, to be
+    passed to restore_stores()."""
+
+    saved = {'clock': clock.clock,
+             'order_store': orderstore.order_store,
+             'order_book': orderbook.order_book,
+             'signal_journal': supportfunctions.signal_journal,
+             'candle_store': zerodhafunctions.candle_store,
+             'state_dir': strategies.state_dir,
+             'metrics_dir': tracing.metrics_dir,
+             'kite': multiprocess_functions.kite,
+             'gateway': ordergateway.gateway}
+
+    clock.set_clock(new_clock)
+    orderstore.order_store = supportfunctions.order_store = orderstore.OrderStore(
+        os.path.join(workdir, 'order_info.db'), os.path.join(workdir, 'order_info.txt'))
+    orderbook.order_book = orderbook.OrderBook(os.path.join(workdir, 'order_info.db'))
+    supportfunctions.signal_journal = signaljournal.SignalJournal(os.path.join(workdir, 'signals'))
+    zerodhafunctions.candle_store = candlestore.CandleStore(os.path.join(workdir, 'candles'))
+    strategies.state_dir = os.path.join(workdir, 'strategy_state')
+    tracing.metrics_dir = os.path.join(workdir, 'metrics')
+    return saved
+
+
+def restore_stores(saved):
+    """sets back the clock and the stores replaced by use_stores()"""
+
+    clock.set_clock(saved['clock'])
+    orderstore.order_store = supportfunctions.order_store = saved['order_store']
+    orderbook.order_book = saved['order_book']
+    supportfunctions.signal_journal = saved['signal_journal']
+    zerodhafunctions.candle_store = saved['candle_store']
+    strategies.state_dir = saved['state_dir']
+    tracing.metrics_dir = saved['metrics_dir']
+    multiprocess_functions.kite = saved['kite']
+    ordergateway.gateway = saved['gateway']
+
+
+def replay_session(kite, algo_config, day, workdir, speed=0):
+    """runs the trading day of the given date on the simulated broker and returns its summary.
+    The order store, orderbook, signal journal, candle store and strategy states are kept in workdir, which should be
+    empty for a reproducible run. speed is the number of simulated seconds per real second (0 runs at full speed)."""
+
+    os.makedirs(workdir, exist_ok=True)
+    workdir = os.path.abspath(workdir)
+    started = timer.time()
+
+    saved = use_stores(workdir, clock.SimClock(datetime.combine(day, time(8, 55, 0)), speed))
+    multiprocess_functions.kite = kite
+    gateway = ordergateway.gateway = ordergateway.OrderGateway(kite, poll_interval=0.01)
+    kite.add_order_listener(gateway.on_order_update)
+
+    schedule = scheduler.Scheduler()
+    replay = ReplayDay(kite, algo_config, schedule, gateway)
+    try:
+        for interval in sorted(set(algo['interval'] for algo in algo_config)):
+            schedule.every_bar(interval, replay.run_bar, interval)
+        schedule.every(3, replay.monitor, first=time(9, 33, 0))
+        schedule.daily(time(15, 35, 0), replay.end)
+        schedule.run()
+
+        # the orders and positions at the end of the session, on the simulated clock
+        orders = kite.orders()
+        positions = kite.positions()['net']
+    finally:
+        gateway.shutdown()
+        restore_stores(saved)
+
+    result = {'day': day.strftime('%Y-%m-%d'),
+              'orders': len(orders),
+              'filled': sum(1 for order in orders if order['status'] == 'COMPLETE'),
+              'pnl': round(sum(position['pnl'] for position in positions), 2),
+              'seconds': round(timer.time() - started, 3)}
+    logger.info('replay of {}: {}'.format(result['day'], result))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay a trading day of the algos of algo_list.txt on recorded candles')
+    parser.add_argument('--day', required=True, help='date of the session (yyyy-mm-dd)')
+    parser.add_argument('--workdir', default='replay', help='folder of the stores of the replay')
+    parser.add_argument('--speed', type=float, default=0, help='simulated seconds per real second, 0 for no waits')
+    args = parser.parse_args()
+
+    with open('algo_list.txt', 'r') as file:
+        algo_config = [eval(x) for x in file.read().split('\n') if x.strip()]
+        file.close()
+
+    day = datetime.strptime(args.day, '%Y-%m-%d').date()
+    kite = from_store(sorted(set(algo['security'] for algo in algo_config)), day)
+    print(replay_session(kite, algo_config, day, args.workdir, args.speed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the registry of the strategies configured in algo_list.txt.
+The module of a strategy has the same name as the algo and defines signal(df) (see strategy1.py).
+A strategy module is imported only when its algo is run or preloaded, so a worker imports only the strategies it runs
+and a new strategy does not slow down the workers of the other strategies.
+The purpose of this module is:
+1. Import the module of an algo on first use and keep its signal function for the life of the process.
+2. Record the import time of each strategy.
+3. Preload the configured strategies in the workers when the pool starts.
+4. Run the strategies which also define the streaming api on the new candles only, with their state saved per algo.
+
+Streaming api (optional, beside signal(df)):
+    init_state() returns the state of the strategy, e.g. the indicators of indicators.py. The state must be picklable.
+    on_bar(state, bar) updates the state with one completed candle (dict of date, open, high, low, close, volume) and
+    returns a dict of 'long_signal', 'short_signal' and 'boost_status' for that candle.
+When the state is built from all the candles (first run, or a saved state older than the data), the streaming signals
+are checked against the signals of signal(df). The algo uses signal(df) for the rest of the day if they differ.
+"""
+
+import logsetup
+
+import _pickle as pickle
+import pandas as pd
+import importlib
+import time
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# folder of the saved states of the streaming strategies
+state_dir = os.path.join(dir_path, 'strategy_state')
+
+# columns given by the strategies for each candle
+signal_columns = ['long_signal', 'short_signal', 'boost_status']
+
+# candles dropped at the start of the data, while the indicators warm up. same as in RunAlgo.signal_processing.
+warmup_candles = 50
+
+
+class StrategyRegistry:
+    """This class imports the strategy modules by algo name and keeps their signal function.
+    get() returns the signal function of an algo, or None if the algo has no strategy module.
+    import_times has the seconds taken to import each strategy in this process."""
+
+    def __init__(self):
+        self.signals = {}
+        self.modules = {}
+        self.import_times = {}
+        # algos whose streaming signals differ from signal(df). they use signal(df).
+        self.streaming_disabled = set()
+
+    def load(self, algo):
+        # import the strategy module. a missing module is remembered so that it is not imported again.
+        started = time.time()
+        try:
+            module = importlib.import_module(algo)
+            signal = getattr(module, 'signal')
+        except (ImportError, AttributeError) as e:
+            logger.info('strategy of algo {} not loaded: {}'.format(algo, e))
+            module = None
+            signal = None
+
+        self.modules[algo] = module
+        self.signals[algo] = signal
+        self.import_times[algo] = time.time() - started
+        logger.info('strategy {} loaded in {:.3f} seconds in process {}'.format(algo, self.import_times[algo],
+                                                                              os.getpid()))
+        return signal
+
+    def get(self, algo):
+        """returns the signal function of the algo"""
+
+        if algo in self.signals:
+            return self.signals[algo]
+        return self.load(algo)
+
+    def preload(self, algos):
+        """imports the strategies of the given algos"""
+
+        for algo in algos:
+            self.get(algo)
+
+    def streaming(self, algo):
+        """returns the strategy module of the algo if it defines the streaming api, else None"""
+
+        if self.get(algo) is None or algo in self.streaming_disabled:
+            return None
+        module = self.modules[algo]
+        if hasattr(module, 'init_state') and hasattr(module, 'on_bar'):
+            return module
+        return None
+
+
+# registry of the process
+registry = StrategyRegistry()
+
+
+def get_signal(algo):
+    """returns the signal function of the algo, or None if the algo has no strategy module"""
+
+    return registry.get(algo)
+
+
+def load_state(algo):
+    # returns the saved state of the algo as a dict of 'state' and 'last' (date of the last candle), or None
+    filename = os.path.join(state_dir, algo + '.pkl')
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename, 'rb') as file:
+            return pickle.load(file)
+    except Exception as e:
+        logger.info('state of algo {} not read: {}'.format(algo, e))
+        return None
+
+
+def save_state(algo, state, last):
+    # the state is written in a temporary file and renamed, so that a saved state is never partly written
+    os.makedirs(state_dir, exist_ok=True)
+    filename = os.path.join(state_dir, algo + '.pkl')
+    with open(filename + '.tmp', 'wb') as file:
+        pickle.dump({'state': state, 'last': last}, file)
+        file.close()
+    os.replace(filename + '.tmp', filename)
+
+
+def verify(module, hist_data, streamed):
+    """returns the number of candles whose streaming signals differ from the signals of signal(df)"""
+
+    full = module.signal(hist_data.copy()).iloc[warmup_candles:]
+    streamed = streamed.iloc[warmup_candles:]
+    mismatches = 0
+    for column in signal_columns:
+        full_values = full[column].reset_index(drop=True)
+        streamed_values = streamed[column].reset_index(drop=True)
+        same = (full_values == streamed_values) | (full_values.isna() & streamed_values.isna())
+        mismatches = max(mismatches, int((~same).sum()))
+    return mismatches
+
+
+def stream_signals(algo, hist_data):
+    """runs the streaming strategy of the algo on the candles of hist_data which are not processed yet.
+    Returns the signals of the new candles in the same format as signal(df), or None if the algo does not use the
+    streaming api. The state is built from all the candles if it is missing or older than hist_data."""
+
+    module = registry.streaming(algo)
+    if module is None:
+        return None
+
+    saved = load_state(algo)
+    if saved is not None and saved['last'] >= hist_data['date'].iloc[0]:
+        state = saved['state']
+        new_data = hist_data[hist_data['date'] > saved['last']]
+        rebuilt = False
+    else:
+        state = module.init_state()
+        new_data = hist_data
+        rebuilt = True
+
+    started = time.time()
+    rows = []
+    for bar in new_data.to_dict('records'):
+        bar.update(module.on_bar(state, dict(bar)))
+        rows.append(bar)
+    signal = pd.DataFrame(rows, columns=list(hist_data.columns) + signal_columns)
+    logger.info('streaming strategy {} processed {} candles in {:.3f} seconds'.format(algo, len(rows),
+                                                                                     time.time() - started))
+
+    if rebuilt:
+        mismatches = verify(module, hist_data, signal)
+        if mismatches:
+            logger.info('streaming signals of algo {} differ from signal(df) on {} candles. signal(df) is used.'.format(
+                algo, mismatches))
+            registry.streaming_disabled.add(algo)
+            return None
+        signal = signal.iloc[warmup_candles:]
+
+    if rows:
+        save_state(algo, state, rows[-1]['date'])
+    return signal
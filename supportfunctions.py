@@ -6,120 +6,80 @@ Created on Mon Apr 12 03:14:33 2021
 
 This module contains custom functions designed to support the operations.
 The functions defined here perform two tasks:
-1. writes the order information in appropriate txt file.
-2. writes the signal in appropriate file.
+1. writes the order information in the order store.
+2. writes the signal in the signal journal of the algo.
 
 The functions defined in this module are called in other modules, such as multiprocess_functions.py, ordermanagement.py
 """
 
-import _pickle as pickle
-from datetime import datetime, time
+import logsetup
+import signaljournal
+import orderstore
+
 import socket
 import pytz
-import logging
 import os
 
 
-# set working directory and logging file
+# set working directory
 # use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
 # dir_path = os.path.dirname(os.path.realpath(__file__))
 dir_path = os.getcwd()
-logfilename = 'logs_' + datetime.strftime(datetime.now(), '%Y-%m-%d') + '.log'
-logfile = os.path.join(dir_path, logfilename)
 
-logging.basicConfig(filename=logfile, format="%(asctime)s %(levelname)s %(message)s", level= logging.DEBUG)
-logger = logging.getLogger()
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
 
 
 # define ist time zone
 IST = pytz.timezone('Asia/Kolkata')
 
+# journal of the signals of all algos
+signal_journal = signaljournal.SignalJournal()
 
-def writesignal(signal_data, algo):
-    """ write signal data in pickle file """
+# order info of all algos
+order_store = orderstore.order_store
 
-    # read the data stored in pickle
-    filename = 'signal_' + algo + datetime.today().strftime('%Y%m%d') + '.pickle'
-    if os.path.isfile(filename):
-        with open(filename, 'rb') as file:
-            existing_signal_data = pickle.load(file)
-            file.close()
-    else:
-        existing_signal_data = {}
 
-    existing_signal_data[datetime.now(IST)] = signal_data
+def writesignal(signal_data, algo):
+    """ write signal data in the signal journal of the algo """
 
-    with open(filename, 'wb') as file:
-        pickle.dump(existing_signal_data, file)
-        file.close()
+    # only the candles which are not yet in the journal are appended
+    n_rows = signal_journal.append(algo, signal_data)
+    logger.info('{} new candles written in the signal journal of algo {}'.format(n_rows, algo))
 
 
 def writeorderinfo(kiteorder, algo, signal_type):
     # signal type can be: "LE", "LX", "SE", "SX" and "none"
-
-    sample_order = {'order_id': 'none',
-                    'order_type': 'none',
-                    'status': 'none',
-                    'tradingsymbol': 'none',
-                    'instrument_token': 'none',
-                    'quantity': 0,
-                    'order_time': datetime.now(IST),
-                    'execution_time': datetime.now(IST),
-                    'signal': 'none'}
+    # only the rows of the algo being updated are written in the order store
 
     if signal_type == 'LX' or signal_type == 'SX':
         # update the current position with none values if the position has been exited
         closing_signal_type = 'LE' if signal_type == 'LX' else 'SE'
 
         if kiteorder['status'] == 'COMPLETE':
-            with open('order_info.txt', 'rb') as file:
-                order_info = pickle.load(file)
-                file.close()
-
-            with open('order_info.txt', 'wb') as file:
-                order_info[algo][closing_signal_type] = sample_order
-                order_info[algo][signal_type] = sample_order
-                file.write(pickle.dumps(order_info))
-                file.close()
-                logger.info(
-                    'order info updated. Exit order for algo {algo} completed. No {sig} order for {algo} exists.'.format(
-                        algo=algo, sig=closing_signal_type))
-
-        # update the open exit order if exit order is still open
-        elif kiteorder['status'] != 'REJECTED':
-            exit_order = kiteorder
-            with open('order_info.txt', 'rb') as file:
-                order_info = pickle.load(file)
-                file.close()
-
-            with open('order_info.txt', 'wb') as file:
-                order_info[algo][signal_type] = exit_order
-                order_info[algo][signal_type]['signal'] = signal_type
-                file.write(pickle.dumps(order_info))
-                file.close()
-                logger.info('order info updated. {} order for algo {} placed.'.format(signal_type, algo))
+            order_store.reset(algo, closing_signal_type, signal_type)
+            logger.info(
+                'order info updated. Exit order for algo {algo} completed. No {sig} order for {algo} exists.'.format(
+                    algo=algo, sig=closing_signal_type))
 
-        # No action if the exit order is rejected. log the info.
-        elif kiteorder['status'] == 'REJECTED':
-            logger.info('{} exit order info for algo {} is rejected. The entry order remains open.'.format(signal_type, algo))
+        # the exit order is stored. the entry order remains open if the exit order is rejected or cancelled.
         else:
-            logger.info('order info for algo {} not updated. check for errors.'.format(algo))
+            exit_order = kiteorder
+            exit_order['signal'] = signal_type
+            order_store.put(algo, signal_type, exit_order)
+            if kiteorder['status'] in ('REJECTED', 'CANCELLED'):
+                logger.info('{} exit order info for algo {} is {}. The entry order remains open.'.format(
+                    signal_type, algo, kiteorder['status'].lower()))
+            else:
+                logger.info('order info updated. {} order for algo {} placed.'.format(signal_type, algo))
 
     # writing signal for entry order [LE, SE]
     if signal_type == 'LE' or signal_type == 'SE':
         # update the entry order
         entry_order = kiteorder
-        with open('order_info.txt', 'rb') as file:
-            order_info = pickle.load(file)
-            file.close()
-
-        with open('order_info.txt', 'wb') as file:
-            order_info[algo][signal_type] = entry_order
-            order_info[algo][signal_type]['signal'] = signal_type
-
-            file.write(pickle.dumps(order_info))
-            file.close()
-            logger.info('order info updated. {} order for algo {} placed.'.format(signal_type, algo))
+        entry_order['signal'] = signal_type
+        order_store.put(algo, signal_type, entry_order)
+        logger.info('order info updated. {} order for algo {} placed.'.format(signal_type, algo))
 
 
 # function to check internet connection
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the latency tracing of the trading loop, from the candle close to the acknowledgement of the order.
+Each stage of the processing of an algo (e.g. fetch of historical data, strategy signal, order placement) is timed as a
+span. The spans are keyed by the algo and the bar (the candle close which started the run) and appended to the metrics
+file of the day, metrics/trace_<yyyy-mm-dd>.jsonl, one json line per span. The main process and the workers append to
+the same file.
+The purpose of this module is:
+1. trace() sets the algos and bar of the spans of the current thread. span() times a stage of them.
+2. record() adds a span measured elsewhere, e.g. the delay of the scheduler or the time to the acknowledgement of the
+   order, which are measured from the bar close on the clock of the process.
+3. summary() gives the count and the 50th, 95th and 99th percentiles of each stage for a day, and prometheus() gives
+   the same in the text format of Prometheus. serve() answers them over http at /metrics.
+
+usage: python tracing.py [--day 2024-03-15] [--serve 9108]
+"""
+
+import logsetup
+import clock
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+import threading
+import argparse
+import json
+import time
+import pytz
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# define ist time zone
+IST = pytz.timezone('Asia/Kolkata')
+
+# folder of the metrics files
+metrics_dir = os.path.join(dir_path, 'metrics')
+
+# stages in the order of the trading loop
+stages = ['scheduler_wake', 'ltp', 'wait', 'historical', 'signal', 'writesignal', 'get_symbol', 'get_price',
+          'place_order', 'confirm', 'bar_to_ack']
+
+# percentiles of the summary
+quantiles = (0.5, 0.95, 0.99)
+
+# algos and bar of the spans of each thread
+context = threading.local()
+
+# metrics file opened by the process, as (pid, filename, file descriptor)
+metrics_file = None
+file_lock = threading.Lock()
+
+
+def bar_key(bar):
+    # the bar as a string of the minute of the candle close in IST
+    if bar.tzinfo is None:
+        bar = IST.localize(bar)
+    return bar.astimezone(IST).strftime('%Y-%m-%d %H:%M')
+
+
+def current_bar():
+    """bar of a run which was not started by the scheduler: the current minute"""
+
+    return clock.now(IST).replace(second=0, microsecond=0)
+
+
+def filename(day):
+    return os.path.join(metrics_dir, 'trace_{}.jsonl'.format(day.strftime('%Y-%m-%d')))
+
+
+def write(rows):
+    # one write per span on a file opened in append mode, so the lines of the processes are not mixed
+    global metrics_file
+
+    day = clock.now(IST)
+    with file_lock:
+        if metrics_file is None or metrics_file[0] != os.getpid() or metrics_file[1] != filename(day):
+            os.makedirs(metrics_dir, exist_ok=True)
+            name = filename(day)
+            metrics_file = (os.getpid(), name, os.open(name, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644))
+        for row in rows:
+            os.write(metrics_file[2], (json.dumps(row) + '\n').encode())
+
+
+def record(stage, seconds, algos, bar, started=None):
+    """adds a span of the stage for each of the algos"""
+
+    if isinstance(algos, str):
+        algos = [algos]
+    key = bar_key(bar)
+    started = started if started is not None else time.time() - seconds
+    try:
+        write([{'algo': algo, 'bar': key, 'stage': stage, 'start': round(started, 6), 'seconds': round(seconds, 6),
+                'pid': os.getpid()} for algo in algos])
+    except OSError as e:
+        logger.info('span {} not written: {}'.format(stage, e))
+
+
+@contextmanager
+def trace(algos, bar=None):
+    """sets the algos and the bar of the spans timed in the current thread inside the block"""
+
+    if isinstance(algos, str):
+        algos = [algos]
+    previous = getattr(context, 'current', None)
+    context.current = (list(algos), bar or current_bar())
+    try:
+        yield
+    finally:
+        context.current = previous
+
+
+@contextmanager
+def span(stage):
+    """times the block as a stage of the algos and bar of the current trace. Nothing is recorded outside a trace."""
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        current = getattr(context, 'current', None)
+        if current is not None:
+            record(stage, time.time() - started, current[0], current[1], started)
+
+
+def since_bar(stage, algos, bar):
+    """records the time from the bar close till now on the clock of the process, e.g. the delay of the scheduler"""
+
+    record(stage, max((clock.now(IST) - bar).total_seconds(), 0.0), algos, bar)
+
+
+def read(day):
+    """returns the spans of the day as a list of dicts"""
+
+    name = filename(day)
+    if not os.path.isfile(name):
+        return []
+    with open(name, 'r') as file:
+        rows = [json.loads(line) for line in file if line.strip()]
+        file.close()
+    return rows
+
+
+def summary(day):
+    """returns a dict of stage: count, total seconds and the percentiles of the seconds of the spans of the day"""
+
+    durations = {}
+    for row in read(day):
+        durations.setdefault(row['stage'], []).append(row['seconds'])
+
+    result = {}
+    for stage in sorted(durations, key=lambda name: stages.index(name) if name in stages else len(stages)):
+        values = np.array(durations[stage])
+        result[stage] = {'count': len(values), 'sum': round(float(values.sum()), 6)}
+        for quantile in quantiles:
+            result[stage]['p{}'.format(int(quantile * 100))] = round(float(np.quantile(values, quantile)), 6)
+    return result
+
+
+def prometheus(day):
+    """returns the summary of the day in the text format of Prometheus"""
+
+    lines = ['# HELP phithebot_stage_seconds Seconds spent in each stage from the candle close to the order '
+             'acknowledgement.',
+             '# TYPE phithebot_stage_seconds summary']
+    for stage, values in summary(day).items():
+        for quantile in quantiles:
+            lines.append('phithebot_stage_seconds{{stage="{}",quantile="{}"}} {}'.format(
+                stage, quantile, values['p{}'.format(int(quantile * 100))]))
+        lines.append('phithebot_stage_seconds_sum{{stage="{}"}} {}'.format(stage, values['sum']))
+        lines.append('phithebot_stage_seconds_count{{stage="{}"}} {}'.format(stage, values['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def log_summary(day=None):
+    """logs the percentiles of each stage of the day"""
+
+    day = day or clock.now(IST)
+    for stage, values in summary(day).items():
+        logger.info('stage {}: {count} spans, p50 {p50:.3f} s, p95 {p95:.3f} s, p99 {p99:.3f} s'.format(stage,
+                                                                                                   **values))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # answers /metrics with the summary of the current day
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = prometheus(clock.now(IST)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=9108, background=True):
+    """serves the metrics of the day at http://localhost:port/metrics. Returns the server."""
+
+    server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='latency of the stages of the trading loop')
+    parser.add_argument('--day', default=None, help='date of the metrics (yyyy-mm-dd), today by default')
+    parser.add_argument('--serve', type=int, default=None, help='serve the metrics of today at this port')
+    args = parser.parse_args()
+
+    if args.serve:
+        print('serving the metrics at http://127.0.0.1:{}/metrics'.format(args.serve))
+        serve(args.serve, background=False)
+        return
+
+    day = datetime.strptime(args.day, '%Y-%m-%d') if args.day else datetime.now(IST)
+    print('{:<16}{:>8}{:>12}{:>12}{:>12}'.format('stage', 'count', 'p50 s', 'p95 s', 'p99 s'))
+    for stage, values in summary(day).items():
+        print('{:<16}{:>8}{:>12.4f}{:>12.4f}{:>12.4f}'.format(stage, values['count'], values['p50'], values['p95'],
+                                                             values['p99']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the pre-market warm-up of the trading day, run after the login.
+The caches used by the first candle of the day (instrument master, candle store, instrument tokens, worker pool) are
+loaded in parallel before 09:15, so that the first run of the algos is as fast as the later ones.
+The purpose of this module is:
+1. Warmup: runs a set of named tasks in threads. A task starts as soon as the tasks it depends on are done, and is
+   skipped if one of them failed. The tasks which fork processes run first, before the threads of the other tasks
+   start.
+2. The tasks of the day: validate the kite session, load the instrument master, build the option chains of the
+   underlyings, resolve the tokens of the securities, backfill the candles of every security and interval of the
+   algos, and reconcile the orders and positions of kite with the order store. main_chrome.py adds the start of the market data feed and of the worker pool.
+3. A readiness report with the status and time of each task, which is logged when the warm-up ends.
+"""
+
+import logsetup
+import instrumentmaster
+import optionchain
+import zerodhafunctions
+import orderstore
+import orderbook
+import supportfunctions
+
+import concurrent.futures
+import time
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# days of candles backfilled, same as the history fetched by multiprocess_functions.completed_candles
+history_days = 25
+
+# instrument tokens of the securities of the algos, resolved by resolve_tokens
+tokens = {}
+
+
+class Task:
+    """a task of the warm-up and its result"""
+
+    def __init__(self, name, function, args, after, first=False):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.after = list(after)
+        self.first = first
+        self.status = 'pending'
+        self.detail = ''
+        self.seconds = 0.0
+
+
+class Warmup:
+    """This class runs the tasks of the warm-up in parallel.
+    add() registers a task with the names of the tasks it runs after. A task added with first=True runs before the
+    other tasks start, so that the processes forked by it do not inherit a lock held by the thread of another task
+    (e.g. the lock of the order store or of sqlite). run() runs all the tasks and returns the readiness report."""
+
+    def __init__(self):
+        self.tasks = {}
+        self.seconds = 0.0
+
+    def add(self, name, function, *args, after=(), first=False):
+        for dependency in after:
+            if dependency not in self.tasks:
+                raise ValueError('task {} runs after unknown task {}'.format(name, dependency))
+            if first and not self.tasks[dependency].first:
+                raise ValueError('task {} runs first, after task {} which does not'.format(name, dependency))
+        self.tasks[name] = Task(name, function, args, after, first)
+
+    def run_task(self, task, futures):
+        # waits for the tasks it depends on, then runs the task. returns its status.
+        if any(futures[dependency].result() != 'ok' for dependency in task.after):
+            task.status = 'skipped'
+            task.detail = 'a task it depends on failed'
+            return task.status
+
+        start = time.time()
+        try:
+            detail = task.function(*task.args)
+            task.status = 'ok'
+            task.detail = detail if detail is not None else ''
+        except Exception as e:
+            task.status = 'failed'
+            task.detail = str(e)
+            logger.info('warm-up task {} failed: {}'.format(task.name, e))
+        task.seconds = time.time() - start
+        return task.status
+
+    def run(self):
+        """runs the tasks and returns the readiness report. Every task has its own thread, so a task waiting for
+        another one does not hold a thread needed by it."""
+
+        start = time.time()
+        futures = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.tasks), 1),
+                                                   thread_name_prefix='warmup') as executor:
+            # the tasks are submitted in the order they were added, so the tasks they depend on are submitted first.
+            # the other tasks are submitted when the tasks which run first are done.
+            for first in (True, False):
+                for task in self.tasks.values():
+                    if task.first == first:
+                        futures[task.name] = executor.submit(self.run_task, task, futures)
+                concurrent.futures.wait(list(futures.values()))
+        self.seconds = time.time() - start
+
+        report = self.report()
+        log_report(report)
+        return report
+
+    def report(self):
+        """returns the readiness report: whether all the tasks are done, the total time and the rows of the tasks"""
+
+        rows = [{'task': task.name, 'status': task.status, 'seconds': round(task.seconds, 3), 'detail': task.detail}
+                for task in self.tasks.values()]
+        return {'ready': all(row['status'] == 'ok' for row in rows),
+                'seconds': round(self.seconds, 3),
+                'task_seconds': round(sum(row['seconds'] for row in rows), 3),
+                'tasks': rows}
+
+
+def log_report(report):
+    """logs the readiness report"""
+
+    logger.info('warm-up {} in {:.2f} seconds ({:.2f} seconds of tasks run in parallel).'.format(
+        'completed' if report['ready'] else 'INCOMPLETE', report['seconds'], report['task_seconds']))
+    for row in report['tasks']:
+        logger.info('  {task:<30}{status:<10}{seconds:>8.2f} s  {detail}'.format(**row))
+
+
+def check_session(kite):
+    # a call which needs a valid access token
+    profile = kite.profile()
+    return 'logged in as {}'.format(profile.get('user_id'))
+
+
+def load_instruments():
+    master = instrumentmaster.refresh()
+    return '{} instruments'.format(len(master.token_index))
+
+
+def resolve_tokens(kite, algo_config):
+    # the tokens are read from the instrument master. kite.ltp is called only for the securities not found in it.
+    # a security which can not be resolved fails only its own backfill.
+    master = instrumentmaster.get_master()
+    securities = sorted(set(algo_details['security'] for algo_details in algo_config))
+    missing = []
+    for security in securities:
+        record = master.by_symbol(security)
+        if record is None:
+            missing.append(security)
+        else:
+            tokens[security] = record['instrument_token']
+
+    unresolved = []
+    for security in missing:
+        try:
+            tokens[security] = kite.ltp([security])[security]['instrument_token']
+        except Exception as e:
+            logger.info('token of {} not resolved: {}'.format(security, e))
+            unresolved.append(security)
+    return '{} securities, {} resolved by kite, not resolved: {}'.format(len(securities), len(missing) - len(unresolved),
+                                                                        unresolved or 'none')
+
+
+def backfill(kite, security, interval, ndays=history_days):
+    # the candles missing in the candle store are fetched from kite and stored
+    if security not in tokens:
+        raise ValueError('token of {} is not resolved'.format(security))
+    df = zerodhafunctions.candle_store.sync(kite, tokens[security], interval, ndays)
+    return '{} candles'.format(len(df))
+
+
+def reconcile(kite):
+    """updates the orderbook and the order store with the orders of kite. The open orders of the order store which were
+    completed, rejected or cancelled while the program was not running are closed. Their prices are not modified
+    before the market opens."""
+
+    orderbook.order_book.prune()
+
+    kite_orders = kite.orders()
+    orderbook.order_book.update(kite_orders)
+    kite_orders = {str(order['order_id']): order for order in kite_orders}
+
+    open_orders = orderstore.order_store.open_orders()
+    closed = 0
+    for algo, signal_type, order in open_orders:
+        trade_details = kite_orders.get(str(order['order_id']))
+        if trade_details is not None and trade_details['status'] in ('COMPLETE', 'REJECTED', 'CANCELLED'):
+            supportfunctions.writeorderinfo(trade_details, algo, signal_type)
+            closed += 1
+
+    positions = [position for position in kite.positions()['net'] if position['quantity'] != 0]
+    return '{} open positions in kite, {} open orders in the order store, {} closed'.format(len(positions),
+                                                                                          len(open_orders), closed)
+
+
+def day_tasks(kite, algo_config):
+    """returns the warm-up of the day with the tasks which need only kite and the algos"""
+
+    warmup = Warmup()
+    # the session runs first, as the worker pool started by main_chrome.py runs after it
+    warmup.add('session', check_session, kite, first=True)
+    warmup.add('instrument master', load_instruments)
+    warmup.add('option chains', optionchain.build, algo_config, after=['instrument master'])
+    warmup.add('tokens', resolve_tokens, kite, algo_config, after=['instrument master'])
+    for security, interval in sorted(set((algo['security'], algo['interval']) for algo in algo_config)):
+        warmup.add('candles {} {}'.format(security, interval), backfill, kite, security, interval, after=['tokens'])
+    warmup.add('reconcile orders', reconcile, kite, after=['session'])
+    return warmup
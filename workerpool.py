@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the persistent worker pool used by main_chrome.py for multiprocessing of the algos.
+The purpose of this module is:
+1. Start the worker processes once before trading begins, with the configured strategies and heavy packages already
+   imported.
+2. Hand the client of the broker gateway to each worker once. The workers call kite through the gateway process and
+   hold no kite session of their own.
+3. Reuse the same workers for every candle of the day.
+4. Send the orders of each algo to the order gateway of the main process as soon as the algo is processed.
+5. Report how long each run waited on the pool versus the time spent processing the algos.
+"""
+
+import logsetup
+import multiprocess_functions
+import marketdata
+import ordergateway
+import strategies
+import tracing
+
+import concurrent.futures
+import time
+import os
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+
+def init_worker(kite, tick_table_name, algos, log_queue=None):
+    """This function runs once in every worker process when the pool starts.
+    It imports the heavy packages and the strategies of the given algos, stores the kite client for use_signal and
+    attaches the tick table of the feed and the queue of the log listener."""
+
+    # packages and strategies are loaded here so that the first candle does not pay for it.
+    import pandas
+    import numpy
+    strategies.registry.preload(algos)
+
+    multiprocess_functions.kite = kite
+    marketdata.attach(tick_table_name)
+    logsetup.attach(log_queue)
+
+
+def warm_worker(delay):
+    """Dummy task used to force the pool to spawn all its workers before trading begins."""
+
+    time.sleep(delay)
+    return os.getpid()
+
+
+def run_algo_timed(algo_details, submitted_at, tick_table_name=None):
+    """Runs use_signal for one algo and returns the orders of the algo, the time it waited in the queue and the time it
+    worked. The orders are placed by the main process.
+    The worker attaches the tick table of the feed if the feed was started after the pool."""
+
+    marketdata.attach(tick_table_name)
+    started_at = time.time()
+    with tracing.trace(algo_details['algo'], algo_details.get('bar')):
+        orders = multiprocess_functions.use_signal(algo_details, place_orders=False)
+    finished_at = time.time()
+
+    return {'algo': algo_details['algo'],
+            'orders': orders,
+            'wait': started_at - submitted_at,
+            'work': finished_at - started_at}
+
+
+class WorkerPool:
+    """This class keeps a process pool alive for the whole trading day.
+    start() spawns and warms the workers.
+    run_cycle() processes all the algos, sends their orders to the order gateway and logs the timings of the run.
+    shutdown() stops the workers at the end of the day."""
+
+    def __init__(self, kite, gateway=None, max_workers=None, algos=()):
+        self.kite = kite
+        self.algos = list(algos)
+        self.gateway = gateway or ordergateway.get_gateway(kite)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = None
+
+    def start(self):
+        # spawn the workers and wait till every one of them has finished its imports
+        start = time.time()
+        tick_table_name = marketdata.tick_table.name if marketdata.tick_table is not None else None
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                               initializer=init_worker,
+                                                               initargs=(self.kite, tick_table_name, self.algos,
+                                                                         logsetup.queue))
+        warm_tasks = [self.executor.submit(warm_worker, 0.2) for _ in range(self.max_workers)]
+        pids = set(task.result() for task in warm_tasks)
+        logger.info('Worker pool started with %s workers in %.2f seconds.', len(pids), time.time() - start)
+
+    def run_cycle(self, algo_config):
+        # process all algos in the pool. returns the timings of each algo.
+        if self.executor is None:
+            self.start()
+
+        cycle_start = time.time()
+        tick_table_name = marketdata.tick_table.name if marketdata.tick_table is not None else None
+        futures = {self.executor.submit(run_algo_timed, algo, time.time(), tick_table_name): algo
+                   for algo in algo_config}
+
+        # the orders of an algo are sent as soon as the algo is processed, without waiting for the other algos
+        timings = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                timing = future.result()
+            except Exception as e:
+                logger.info('processing of algo %s failed: %s', futures[future]['algo'], e)
+                continue
+
+            timings.append(timing)
+            for order in timing['orders']:
+                confirmation = self.gateway.submit(order)
+                confirmation.add_done_callback(self.log_confirmation(order, cycle_start))
+
+        cycle_time = time.time() - cycle_start
+        for timing in timings:
+            logger.info('algo %(algo)s waited %(wait).3f seconds on the pool and worked %(work).3f seconds.', timing)
+
+        total_wait = sum(timing['wait'] for timing in timings)
+        total_work = sum(timing['work'] for timing in timings)
+        logger.info('Cycle completed in %.3f seconds. Waited on pool: %.3f seconds, work: %.3f seconds.',
+                    cycle_time, total_wait, total_work)
+
+        return timings
+
+    def log_confirmation(self, order, cycle_start):
+        # callback of the order confirmation. logs the time from the start of the cycle to the confirmation.
+        def log(confirmation):
+            logger.info('%s order of algo %s confirmed %.3f seconds after start of cycle: %s', order['signal_type'],
+                        order['algo'], time.time() - cycle_start, confirmation.result())
+        return log
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            logger.info('Worker pool shut down.')
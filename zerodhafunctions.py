@@ -5,43 +5,57 @@ Created on Fri Apr  9 21:27:08 2021
 @author: aamir
 """
 
+import logsetup
+import candlestore
+import optionchain
+import greeks
+import marketdata
+import clock
+
 from datetime import datetime, time, timedelta
 import pandas as pd
 import os
 import math
 import pytz
-from time import sleep
-import logging
 
-# set working directory and logging file
+# set working directory
 # use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
 # dir_path = os.path.dirname(os.path.realpath(__file__))
 dir_path = os.getcwd()
-logfilename = 'logs_' + datetime.strftime(datetime.now(), '%Y-%m-%d') + '.log'
-logfile = os.path.join(dir_path, logfilename)
 
-logging.basicConfig(filename=logfile, format="%(asctime)s %(levelname)s %(message)s", level= logging.DEBUG)
-logger = logging.getLogger()
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
 
 
 #define ist time zone
 IST = pytz.timezone('Asia/Kolkata')
 
+# local store of candles. only the candles since the last stored candle are fetched from kite.
+candle_store = candlestore.CandleStore()
+
 
 # function to fetch historical data of last 100 days
 # this historical data would contain the current UNFINISHED candle
 def get_historical(kite, token, ndays, interval):
-    to_date = datetime.today().strftime('%Y-%m-%d')
-    from_date = datetime.strftime(datetime.today() - timedelta(ndays), '%Y-%m-%d')
+    to_date = clock.now().strftime('%Y-%m-%d')
+    from_date = datetime.strftime(clock.now() - timedelta(ndays), '%Y-%m-%d')
     records = kite.historical_data(token, from_date = from_date, to_date = to_date, interval = interval)
     df = pd.DataFrame(records)
     return df
 
 
+# function to get historical data of last ndays using the local candle store
+# only the candles missing in the store are fetched from kite
+# this historical data would contain the current UNFINISHED candle, same as get_historical
+def get_candles(kite, token, ndays, interval):
+    df = candle_store.sync(kite, token, interval, ndays)
+    return df
+
+
 def get_price(kite, symbol, interval, order_type):
     """function to determine the price at which limit order should be placed"""
 
-    symbol_fetch = kite.ltp(['NFO:' + str(symbol)])
+    symbol_fetch = marketdata.ltp(kite, ['NFO:' + str(symbol)])
     symbol_token = symbol_fetch['NFO:' + str(symbol)]['instrument_token']
     symbol_ltp = symbol_fetch['NFO:' + str(symbol)]['last_price']
     
@@ -60,20 +74,20 @@ def get_price(kite, symbol, interval, order_type):
         logger.info('order not placed')
         return 0
     
-    if datetime.now(IST).time() < cool_time:
+    if clock.now(IST).time() < cool_time:
         # wait for 1 minute before processing the order.
-        sleep(60)
+        clock.sleep(60)
         if order_type == 'buy':
             price_order = math.ceil(10 * 0.97 * symbol_ltp) / 10
         elif order_type == 'sell':
             price_order = math.floor(10 * 1.03 * symbol_ltp) / 10
-    elif time_threshold > datetime.now(IST).time() > cool_time:
+    elif time_threshold > clock.now(IST).time() > cool_time:
         if order_type == 'buy':
             price_order = symbol_ltp - 0.20
         elif order_type == 'sell':
             price_order = symbol_ltp + 0.20
     else:
-        symbol_hist = get_historical(kite, symbol_token, 2, interval)
+        symbol_hist = get_candles(kite, symbol_token, 2, interval)
         symbol_lastcandle = symbol_hist['close'].iloc[-1]
         if order_type == 'buy':
             price_order = min(symbol_ltp, symbol_lastcandle) - 0.20
@@ -84,50 +98,59 @@ def get_price(kite, symbol, interval, order_type):
 
 
 # this function is meant to shortlist the possible list of instruments which will be traded today
-# this function should be called in the beginning of code run
-# returns a dict whose key is the instrument_token while value is the symbol name of the instrument
-# the shortlist of these possible instruments is meant to speed up the process of searching the instrument to place the order
-# it is based on NIFTY INDEX
-
-def get_symbol(kite, signal_type, qty, lot_size, boost_status, days_before_expiry):
-    """get symbol and quantity of the instrument to place order"""
-
-    # read instruments csv saved in working directory
-    instruments = pd.read_csv("instruments.csv")
+# the option is chosen from the option chain of the underlying, built from the instrument master at the warm-up
+# by default: the in the money strike of the nearest 100 (CE for long, PE for short) of the monthly expiry, or of the
+# next monthly expiry when it is within days_before_expiry days. An algo can instead target a delta or a premium, which
+# are computed over the chain of the expiry by greeks.py
+
+def get_symbol(kite, signal_type, qty, lot_size, boost_status, days_before_expiry, expiry_rule='monthly',
+               moneyness='ITM', strike_offset=0, strike_step=100, underlying='NIFTY', spot_symbol='NSE:NIFTY 50',
+               target_delta=None, target_premium=None):
+    """get symbol and quantity of the instrument to place order.
+    expiry_rule is 'monthly' or 'weekly'. moneyness is 'ITM', 'ATM' or 'OTM', strike_offset strikes further from the
+    spot. Only the strikes which are multiples of strike_step are traded (all the strikes if None).
+    With target_delta (e.g. 0.5, for calls and puts alike) or target_premium, the strike is the one whose delta or last
+    price is nearest to the target, and moneyness and strike_offset are used only if no option meets the target
+    (e.g. no option near the spot has a price)."""
+
+    # option chain built once per day from the instrument master
+    chain = optionchain.get_chain(underlying)
     
-    nifty_ltp = kite.ltp(['NSE:NIFTY 50'])['NSE:NIFTY 50']['last_price']
+    spot_ltp = marketdata.ltp(kite, [spot_symbol])[spot_symbol]['last_price']
     
     symbol_qty = 0
-    # lower strike price for CE in the money option for long signals, opposite for short
+    # in the money CE for long signals, PE for short
     if signal_type == 'LE':
-        strike = 100 * math.floor(nifty_ltp / 100)
         option_type = "CE"
         
         # determine quantity
         symbol_qty = 2 * qty * lot_size if boost_status == 1 else qty * lot_size
             
     elif signal_type == 'SE':
-        strike = 100 * math.ceil(nifty_ltp / 100)
         option_type = "PE"
         
         # determine quantity
         symbol_qty = 2 * qty * lot_size if boost_status == -1 else qty * lot_size
         
-    expiry = str(datetime.today().strftime('%y%b').upper())
-    
-    # formulate the symbol as per NSE norms
-    symbol = "NIFTY" + expiry + str(strike) + option_type
-    
-    # using the above symbol, check if the current month expiry is already past or is due in next 4 days
-    # if yes, move to next month expiry
-    symbolexpiry = instruments[instruments['tradingsymbol'] == symbol]['expiry'].to_list()[0]
-    symbolexpiry = datetime.strptime(symbolexpiry, '%d-%m-%Y')
-    
-    if (symbolexpiry - datetime.today()).days <= days_before_expiry:
-        expiry = str((datetime.today() + timedelta(20)).strftime('%y%b').upper())
-        # arbitrarily added 20 days to get next month
-        symbol = "NIFTY" + expiry + str(strike) + option_type
-
-    symbol_dict = {'tradingsymbol': symbol, 'quantity': symbol_qty}
+    # the expiries of the rule within days_before_expiry days are skipped
+    contract = None
+    if target_delta is not None or target_premium is not None:
+        contract = greeks.select(kite, chain, spot_ltp, option_type, expiry_rule, days_before_expiry, target_delta,
+                                 target_premium, strike_step)
+        if contract is not None:
+            logger.info('%s chosen for target delta %s premium %s: delta %.3f, last price %s, volatility %.3f',
+                        contract['tradingsymbol'], target_delta, target_premium, contract['delta'],
+                        contract['last_price'], contract['volatility'])
+        else:
+            logger.info('no %s option for target delta %s premium %s, the %s strike is chosen',
+                        option_type, target_delta, target_premium, moneyness)
+    if contract is None:
+        contract = chain.contract(spot_ltp, option_type, expiry_rule, days_before_expiry, moneyness, strike_offset,
+                                  strike_step)
+    if contract is None:
+        raise ValueError('no {} {} {} option of {} for spot {}'.format(expiry_rule, moneyness, option_type, underlying,
+                                                                      spot_ltp))
+
+    symbol_dict = {'tradingsymbol': contract['tradingsymbol'], 'quantity': symbol_qty}
 
     return symbol_dict
@@ -11,39 +11,37 @@ Required files:
     Request token: request_token.txt
 
 For first login of the day, both access_token.txt and request_token.txt should contain "first login".
+An access token in access_token.txt is checked with a profile call before it is used, and a new login is done if kite
+rejects it.
+The login is done over http (zerodhalogin_http.py). Chrome is started only if the http login fails.
 """
 
+import logsetup
+import zerodhalogin_http
+
 from kiteconnect import KiteConnect
-from selenium import webdriver
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import NoSuchElementException
-from selenium.common.exceptions import StaleElementReferenceException
+from kiteconnect import exceptions as kite_exceptions
 import time
 import urllib.parse as urlparse
 import os
-import logging
-from datetime import datetime
 import pyotp
 
 
-# set working directory and logging file
+# set working directory
 # use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
 # dir_path = os.path.dirname(os.path.realpath(__file__))
 dir_path = os.getcwd()
-logfilename = 'logs_' + datetime.strftime(datetime.now(), '%Y-%m-%d') + '.log'
-logfile = os.path.join(dir_path, logfilename)
 os.chdir(dir_path)
 
-logging.basicConfig(filename=logfile, format="%(asctime)s %(levelname)s %(message)s", level= logging.DEBUG)
-logger = logging.getLogger()
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
 
 
 
 class ZerodhaAccessToken:
-    def __init__(self):
+    # root is the url of the kite connect api and login_base the url of kite web. Both are kite by default; the mock
+    # login server of mocklogin.py is given in their place for tests.
+    def __init__(self, root=None, login_base=zerodhalogin_http.kite_web):
         self.logintexts = open('zerodha_credentials.txt', 'r').read().split('\n')
         self.access_token = open("access_token.txt", 'r').read()
         self.request_token = open("request_token.txt", 'r').read()
@@ -53,7 +51,8 @@ class ZerodhaAccessToken:
         self.uid = self.login_details['uid']
         self.pws = self.login_details['pws']
         self.totp_secret = self.login_details['totp']
-        self.kite = KiteConnect(api_key=self.api_key)
+        self.login_base = login_base
+        self.kite = KiteConnect(api_key=self.api_key, root=root)
 
     def get_login_details(self):
         # read the details in text file to be used for credentials
@@ -66,81 +65,126 @@ class ZerodhaAccessToken:
 
     def get_request_token(self):
         # This function returns request token by using login credentials.
+        # the login is done over http. chrome is started only if the http login fails.
 
         if self.request_token != 'first login':
             return self.request_token
-        else:
-            logger.info('starting chrome session for login')
-            try:
-                url_kite = self.kite.login_url()
-
-                # open chrome session
-                chrome_options = Options()
-                chrome_options.add_argument('--no-sandbox')
-                chrome_options.add_argument('--headless')
-                driver = webdriver.Chrome(options=chrome_options)
-                # driver = webdriver.Chrome()
-
-                # open url to get the login page
-                driver.get(url_kite)
-
-                # wait (Sec) for page to load
-                ignored_exceptions = (NoSuchElementException, StaleElementReferenceException,)
-                wait = WebDriverWait(driver, 10, ignored_exceptions=ignored_exceptions)
-
-                # enter the id
-                wait.until(EC.presence_of_element_located((By.XPATH, '//input[@type="text"]'))) \
-                    .send_keys(self.uid)
-
-                # enter the pws
-                wait.until(EC.presence_of_element_located((By.XPATH, '//input[@type="password"]'))) \
-                    .send_keys(self.pws)
-
-                ## click for submit
-                wait.until(EC.element_to_be_clickable((By.XPATH, '//button[@type="submit"]'))) \
-                    .submit()
-
-                # enter totp
-                # time.sleep(10)
-                totp = pyotp.TOTP(self.totp_secret)
-                # wait.until(EC.presence_of_element_located((By.XPATH, '//input[@type="password"]'))).click()
-                time.sleep(5)
-                driver.find_element_by_xpath('//*[@id="totp"]').send_keys(totp.now())
-
-                ## Final Submit
-                wait.until(EC.element_to_be_clickable((By.XPATH, '//button[@type="submit"]'))).submit()
-
-                ## wait for redirection
-                wait.until(EC.url_contains('status=success'))
-
-                # get the request token from url
-                tokenurl = driver.current_url
-                parsed = urlparse.urlparse(tokenurl)
-                driver.close()
-                r_token = urlparse.parse_qs(parsed.query)['request_token'][0]
-
-                # write request token
-                with open('request_token.txt', 'w') as file:
-                    file.write(r_token)
-                    logger.info('request token updated')
-                    file.close()
-
-                return r_token
-
-            except Exception as e:
-                logger.info(e)
+
+        start = time.time()
+        try:
+            r_token = zerodhalogin_http.HttpLogin(self.api_key, self.uid, self.pws, self.totp_secret,
+                                                  base=self.login_base).request_token()
+            logger.info('request token generated over http in {:.2f} seconds'.format(time.time() - start))
+        except Exception as e:
+            logger.info('http login failed: {}'.format(e))
+            start = time.time()
+            r_token = self.get_request_token_chrome()
+            if r_token is None:
                 return None
+            logger.info('request token generated with chrome in {:.2f} seconds'.format(time.time() - start))
+
+        # write request token
+        with open('request_token.txt', 'w') as file:
+            file.write(r_token)
+            logger.info('request token updated')
+            file.close()
+
+        return r_token
+
+    def get_request_token_chrome(self):
+        # This function returns request token by login through a headless chrome.
+        # selenium is imported here as it is needed only when the http login fails.
+        from selenium import webdriver
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.chrome.options import Options
+        from selenium.common.exceptions import NoSuchElementException
+        from selenium.common.exceptions import StaleElementReferenceException
+
+        logger.info('starting chrome session for login')
+        try:
+            url_kite = self.kite.login_url()
+
+            # open chrome session
+            chrome_options = Options()
+            chrome_options.add_argument('--no-sandbox')
+            chrome_options.add_argument('--headless')
+            driver = webdriver.Chrome(options=chrome_options)
+            # driver = webdriver.Chrome()
+
+            # open url to get the login page
+            driver.get(url_kite)
+
+            # wait (Sec) for page to load
+            ignored_exceptions = (NoSuchElementException, StaleElementReferenceException,)
+            wait = WebDriverWait(driver, 10, ignored_exceptions=ignored_exceptions)
+
+            # enter the id
+            wait.until(EC.presence_of_element_located((By.XPATH, '//input[@type="text"]'))) \
+                .send_keys(self.uid)
+
+            # enter the pws
+            wait.until(EC.presence_of_element_located((By.XPATH, '//input[@type="password"]'))) \
+                .send_keys(self.pws)
+
+            ## click for submit
+            wait.until(EC.element_to_be_clickable((By.XPATH, '//button[@type="submit"]'))) \
+                .submit()
+
+            # enter totp as soon as its field is shown
+            totp = pyotp.TOTP(self.totp_secret)
+            wait.until(EC.presence_of_element_located((By.ID, 'totp'))).send_keys(totp.now())
+
+            ## Final Submit
+            wait.until(EC.element_to_be_clickable((By.XPATH, '//button[@type="submit"]'))).submit()
+
+            ## wait for redirection
+            wait.until(EC.url_contains('status=success'))
+
+            # get the request token from url
+            tokenurl = driver.current_url
+            parsed = urlparse.urlparse(tokenurl)
+            driver.close()
+            r_token = urlparse.parse_qs(parsed.query)['request_token'][0]
+
+            return r_token
+
+        except Exception as e:
+            logger.info(e)
+            return None
+
+    def valid_access_token(self):
+        # checks the access token of the file with a profile call. Only a token rejected by kite is invalid; the token
+        # is kept if kite can not be reached.
+        try:
+            self.kite.set_access_token(self.access_token)
+            self.kite.profile()
+            return True
+        except kite_exceptions.TokenException as e:
+            logger.info('access token rejected by kite: {}'.format(e))
+            return False
+        except Exception as e:
+            logger.info('access token not checked: {}'.format(e))
+            return True
 
     def get_access_token(self):
         # this function fetches access token
-        # if access token already exists, the same is returned
+        # if access token already exists and is accepted by kite, the same is returned
 
         if self.access_token != 'first login':
-            logger.info("access token already exists!")
-            return self.access_token
+            start = time.time()
+            if self.valid_access_token():
+                logger.info("access token already exists! checked in {:.2f} seconds".format(time.time() - start))
+                return self.access_token
+
+            # the request token of the rejected session can not be used again
+            self.access_token = 'first login'
+            self.request_token = 'first login'
 
         # when request token exists, the same is used to generate access token
-        # when request token does not exist, login process via chrome is completed.
+        # when request token does not exist, login process over http (or chrome) is completed.
+        start = time.time()
         try:
             while self.request_token == 'first login':
                 self.request_token = self.get_request_token()
@@ -156,7 +200,7 @@ class ZerodhaAccessToken:
             with open("access_token.txt", 'w') as at:
                 at.write(data['access_token'])
 
-            logger.info('Access token written..')
+            logger.info('Access token written.. login completed in {:.2f} seconds'.format(time.time() - start))
             return data['access_token']
 
         except Exception as e:
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the login of the zerodha kite account over http, without a browser.
+The login form of kite is posted with a requests session (user id and password, then the totp), and the redirects of
+the kite connect login url are followed till the request token. zerodhalogin_chrome.py uses it first and starts chrome
+only if it fails.
+The purpose of this module is:
+1. HttpLogin: returns the request token of a login, and the time taken by each step of the login.
+
+The login can be tested without a kite account against the mock server of mocklogin.py.
+"""
+
+import logsetup
+
+import urllib.parse as urlparse
+import time
+import os
+import requests
+import pyotp
+
+
+# set working directory
+# use the  commented line to get dir_path instead of os.getcwd() if the module is run in google cloud compute engine.
+# dir_path = os.path.dirname(os.path.realpath(__file__))
+dir_path = os.getcwd()
+
+# the logging of the process is set up by logsetup.py
+logger = logsetup.get_logger()
+
+# kite web, which serves the login form and the connect login
+kite_web = 'https://kite.zerodha.com'
+
+# seconds to wait for each request of the login
+timeout = 10
+
+# redirects followed from the connect login url to the redirect url of the app
+max_redirects = 10
+
+
+class HttpLogin:
+    """This class logs in kite over http and returns the request token of the app.
+    base is the url of kite web; the mock server of mocklogin.py is used in its place for tests."""
+
+    def __init__(self, api_key, uid, pws, totp_secret, base=kite_web):
+        self.api_key = api_key
+        self.uid = uid
+        self.pws = pws
+        self.totp_secret = totp_secret
+        self.base = base.rstrip('/')
+        self.session = requests.Session()
+        self.session.headers['X-Kite-Version'] = '3'
+        self.timings = {}
+
+    def connect_url(self):
+        return '{}/connect/login?api_key={}&v=3'.format(self.base, self.api_key)
+
+    def step(self, name, function, *args):
+        # runs a step of the login and keeps its time
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.timings[name] = time.time() - start
+
+    def post(self, path, data):
+        # posts the form and returns the data of a successful json response
+        response = self.session.post(self.base + path, data=data, timeout=timeout)
+        try:
+            body = response.json()
+        except ValueError:
+            raise RuntimeError('{} answered {} without json'.format(path, response.status_code))
+        if body.get('status') != 'success':
+            raise RuntimeError('{} failed: {}'.format(path, body.get('message')))
+        return body['data']
+
+    def open_connect(self):
+        # the connect login page sets the session cookies of the app login
+        self.session.get(self.connect_url(), timeout=timeout).raise_for_status()
+
+    def password(self):
+        return self.post('/api/login', {'user_id': self.uid, 'password': self.pws})['request_id']
+
+    def totp(self, request_id):
+        self.post('/api/twofa', {'user_id': self.uid, 'request_id': request_id,
+                                 'twofa_value': pyotp.TOTP(self.totp_secret).now(), 'twofa_type': 'totp'})
+
+    def redirect(self):
+        # follows the redirects of the logged in session till the url with the request token. The redirect url of
+        # the app itself is not opened, it may not be served.
+        url = self.connect_url() + '&skip_session=true'
+        for _ in range(max_redirects):
+            response = self.session.get(url, allow_redirects=False, timeout=timeout)
+            if not response.is_redirect:
+                raise RuntimeError('login did not redirect to the app, status {}'.format(response.status_code))
+            url = urlparse.urljoin(url, response.headers['Location'])
+            query = urlparse.parse_qs(urlparse.urlparse(url).query)
+            if 'request_token' in query:
+                return query['request_token'][0]
+        raise RuntimeError('request token not found after {} redirects'.format(max_redirects))
+
+    def request_token(self):
+        """logs in and returns the request token. Raises an exception if a step fails."""
+
+        self.timings = {}
+        start = time.time()
+        try:
+            self.step('connect', self.open_connect)
+            request_id = self.step('password', self.password)
+            self.step('totp', self.totp, request_id)
+            return self.step('redirect', self.redirect)
+        finally:
+            self.timings['total'] = time.time() - start
+            logger.info('http login took {}'.format(
+                ', '.join('{} {:.3f} s'.format(name, seconds) for name, seconds in self.timings.items())))